@@ -0,0 +1,49 @@
+import argparse
+import random
+import time
+from typing import List
+
+from givematerial import recommendation
+
+
+def synthetic_corpus(
+        text_count: int, lemmas_per_text: int,
+        vocabulary: List[str]) -> List[List[str]]:
+    return [random.sample(vocabulary, lemmas_per_text)
+            for _ in range(text_count)]
+
+
+def time_classification(corpus: List[List[str]], known, learning) -> float:
+    start = time.perf_counter()
+    for learnables in corpus:
+        recommendation.classify_learnables(learnables, known, learning)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare list and set based status lookups on a '
+        'synthetic corpus')
+    parser.add_argument('--texts', type=int, default=500)
+    parser.add_argument('--lemmas-per-text', type=int, default=100)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--known', type=int, default=10000)
+    parser.add_argument('--learning', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    vocabulary = [f'lemma{i}' for i in range(args.vocabulary)]
+    corpus = synthetic_corpus(args.texts, args.lemmas_per_text, vocabulary)
+
+    status = random.sample(vocabulary, args.known + args.learning)
+    known_words = status[:args.known]
+    learning_words = status[args.known:]
+
+    list_time = time_classification(corpus, known_words, learning_words)
+    set_time = time_classification(
+        corpus, frozenset(known_words), frozenset(learning_words))
+
+    print(f'lists:      {list_time:.3f}s')
+    print(f'frozensets: {set_time:.3f}s')
+    print(f'speedup:    {list_time / set_time:.1f}x')
@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from givematerial import recommendation
+from givematerial.cache import LearnableCache, SqliteLearnableCache
+from givematerial.corpus import CorpusIndex, content_hash
+import givematerial.db.sqlite
+import givematerial.extractors
+
+
+# extractor id of the synthetic Croatian learnables, the web app reads them
+# with the NoopExtractor like real pre-parsed texts
+HR_EXTRACTOR_ID = 'hr-benchmark-v1'
+# first code point of the CJK unified ideographs block
+KANJI_START = 0x4e00
+KANJI_COUNT = 20000
+
+
+def timed(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Run `fn` several times and summarize the wall clock times"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeat': repeat,
+    }
+
+
+def synthetic_vocabulary(language: str, size: int) -> List[str]:
+    """Learnables of a language, most frequent first"""
+    if language == 'jp':
+        if size > KANJI_COUNT:
+            raise ValueError(f'At most {KANJI_COUNT} kanji are supported')
+        return [chr(KANJI_START + i) for i in range(size)]
+
+    return [f'lemma{i}' for i in range(size)]
+
+
+def synthetic_texts(
+        rng: random.Random, text_count: int, lemmas_per_text: int,
+        vocabulary: List[str]) -> List[List[str]]:
+    """Learnables of each text, drawn from a Zipf distribution"""
+    lemmas_per_text = min(lemmas_per_text, len(vocabulary))
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    texts = []
+    for _ in range(text_count):
+        learnables = {}
+        while len(learnables) < lemmas_per_text:
+            draw = rng.choices(
+                vocabulary, weights, k=lemmas_per_text - len(learnables))
+            learnables.update(dict.fromkeys(draw))
+        texts.append(list(learnables))
+
+    return texts
+
+
+def write_corpus(
+        texts_folder: Path, language: str,
+        texts: List[List[str]]) -> List[Tuple[str, List[str]]]:
+    """Store texts as JSON files, returns content hashes and learnables"""
+    folder = texts_folder / language
+    folder.mkdir(parents=True, exist_ok=True)
+    separator = '' if language == 'jp' else ' '
+
+    entries = []
+    for i, learnables in enumerate(texts):
+        text = separator.join(learnables)
+        with open(folder / f'{i}.json', 'w') as f:
+            json.dump({
+                'collection': 'benchmark',
+                'title': f'{language} text {i}',
+                'text': text,
+                'language': language,
+                'url': f'https://example.com/{language}/{i}',
+            }, f)
+        entries.append((content_hash(text), learnables))
+
+    return entries
+
+
+def create_extractor(language: str):
+    if language == 'jp':
+        return givematerial.extractors.JapaneseKanjiExtractor()
+    # classla is not needed, all texts are in the cache
+    return givematerial.extractors.NoopExtractor()
+
+
+def bench_language(
+        language: str, args: argparse.Namespace,
+        rng: random.Random) -> Dict[str, Any]:
+    texts_folder = Path('data') / 'texts'
+    cache_folder = Path('data') / language / 'cache'
+    learnable_extractor = create_extractor(language)
+    extractor_id = learnable_extractor.extractor_id or HR_EXTRACTOR_ID
+
+    vocabulary = synthetic_vocabulary(language, args.vocabulary)
+    texts = synthetic_texts(
+        rng, args.texts, args.lemmas_per_text, vocabulary)
+    entries = write_corpus(texts_folder, language, texts)
+
+    # learners know the most frequent learnables first
+    known_count = int(len(vocabulary) * args.known_ratio)
+    learning_count = int(len(vocabulary) * args.learning_ratio)
+    known_words = vocabulary[:known_count]
+    learning_words = vocabulary[known_count:known_count + learning_count]
+
+    results = {}
+
+    results['iterate_texts'] = timed(
+        lambda: list(recommendation.iterate_texts(texts_folder, language)),
+        args.repeat)
+
+    def refresh_cold():
+        (texts_folder / 'index.sqlite').unlink()
+        corpus = CorpusIndex(texts_folder)
+        corpus.refresh()
+        corpus.close()
+
+    CorpusIndex(texts_folder).close()
+    results['corpus_refresh_cold'] = timed(refresh_cold, args.repeat)
+
+    corpus = CorpusIndex(texts_folder)
+    results['corpus_refresh_unchanged'] = timed(corpus.refresh, args.repeat)
+    results['corpus_texts'] = timed(
+        lambda: corpus.texts(language), args.repeat)
+
+    cache = LearnableCache(cache_folder)
+
+    def write_cache():
+        for text_hash, learnables in entries:
+            cache.write_cache(text_hash, extractor_id, learnables)
+
+    def lookup_cache():
+        for text_hash, _ in entries:
+            cache.lookup(text_hash, extractor_id)
+
+    # also fills the cache for the benchmarks below
+    results['cache_write'] = timed(write_cache, args.repeat)
+    results['cache_lookup'] = timed(lookup_cache, args.repeat)
+
+    results['recommend'] = timed(
+        lambda: recommendation.recommend(
+            known_words, learning_words, cache_folder, corpus, language,
+            learnable_extractor, count=20, common_words_count=100),
+        args.repeat)
+
+    results['index_build'] = timed(
+        lambda: recommendation.LearnableIndex.build(
+            corpus, language, cache_folder, learnable_extractor),
+        args.repeat)
+    index = recommendation.LearnableIndex.build(
+        corpus, language, cache_folder, learnable_extractor)
+
+    for name, ranking in recommendation.RANKINGS.items():
+        def score_full():
+            scores = recommendation.create_text_scores(
+                language, index, ranking())
+            scores.update(known_words, learning_words)
+            scores.recommend(count=20, common_words_count=100)
+
+        results[f'scores_full_{name}'] = timed(score_full, args.repeat)
+
+        scores = recommendation.create_text_scores(
+            language, index, ranking())
+        scores.update(known_words, learning_words)
+        # a few learning words become known between two requests
+        changed = learning_words[:args.changed_words]
+        still_learning = learning_words[len(changed):]
+
+        def score_incremental():
+            scores.update(known_words + changed, still_learning)
+            scores.recommend(count=20, common_words_count=100)
+            scores.update(known_words, learning_words)
+            scores.recommend(count=20, common_words_count=100)
+
+        results[f'scores_incremental_{name}'] = {
+            # each run contains two updates
+            key: value / 2 if key != 'repeat' else value
+            for key, value in timed(score_incremental, args.repeat).items()}
+
+    corpus.close()
+
+    if not args.skip_web:
+        results.update(bench_web(language, known_words, learning_words, args))
+
+    return results
+
+
+def bench_web(
+        language: str, known_words: List[str], learning_words: List[str],
+        args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        # the web app creates its database in the working directory on
+        # import, so it can only be imported in the benchmark folder
+        from givematerial.web import main
+    except ImportError as e:
+        return {'web_home': {'skipped': str(e)}}
+
+    token = f'benchmark-{language}'
+    conn = givematerial.db.sqlite.connect()
+    conn.execute(
+        'INSERT OR IGNORE INTO user (token, language) VALUES (?, ?)',
+        (token, language))
+    conn.commit()
+    status = SqliteLearnableCache(conn, token)
+    status.update_cache(learning_words, known_words)
+
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['wktoken'] = token
+
+    def home():
+        response = client.get('/')
+        if response.status_code != 200:
+            raise RuntimeError(f'Home page returned {response.status_code}')
+
+    def home_cold():
+        main.result_cache.entries.clear()
+        main.user_scores.clear()
+        main.learnable_indexes.clear()
+        home()
+
+    changed = learning_words[:args.changed_words]
+    state = {'known': False}
+
+    def home_status_change():
+        # alternate between two states, so that every request is a miss
+        state['known'] = not state['known']
+        new_status = 'known' if state['known'] else 'learning'
+        status.apply_changes({word: new_status for word in changed})
+        home()
+
+    results = {
+        'web_home_cold': timed(home_cold, args.repeat),
+        'web_home_cached': timed(home, args.repeat),
+        'web_home_status_change': timed(home_status_change, args.repeat),
+    }
+    conn.close()
+
+    # the next language deletes the corpus index the web app keeps open
+    for corpus in main.corpus_indexes.values():
+        corpus.close()
+    main.corpus_indexes.clear()
+
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the recommendation engine on synthetic corpora')
+    parser.add_argument(
+        '--languages', nargs='+', default=['hr', 'jp'],
+        choices=['hr', 'jp'])
+    parser.add_argument('--texts', type=int, default=2000)
+    parser.add_argument('--lemmas-per-text', type=int, default=150)
+    parser.add_argument(
+        '--vocabulary', type=int, default=5000,
+        help=f'Number of learnables, at most {KANJI_COUNT} for jp')
+    parser.add_argument(
+        '--known-ratio', type=float, default=0.3,
+        help='Share of the vocabulary the user knows')
+    parser.add_argument(
+        '--learning-ratio', type=float, default=0.05,
+        help='Share of the vocabulary the user is learning')
+    parser.add_argument(
+        '--changed-words', type=int, default=10,
+        help='Words changing their status between two requests')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--skip-web', action='store_true',
+        help='Do not benchmark the home page of the web app')
+    parser.add_argument(
+        '--workdir', type=Path,
+        help='Folder for the synthetic data, a temporary folder by default')
+    parser.add_argument(
+        '--output', '-o', type=Path,
+        help='Write the results as JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.output is not None:
+        args.output = args.output.resolve()
+    os.environ.setdefault('FLASK_SECRET', 'benchmark')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir if args.workdir is not None else Path(tmp_dir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        # all paths of givematerial are relative to the working directory
+        os.chdir(workdir)
+
+        rng = random.Random(args.seed)
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'parameters': {
+                key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(args).items()},
+            'results': {
+                language: bench_language(language, args, rng)
+                for language in args.languages},
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
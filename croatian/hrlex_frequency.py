@@ -1,13 +1,60 @@
-import collections
-import json
+import argparse
+import os
+from pathlib import Path
+import sqlite3
+from typing import Iterable, Tuple
 
 
-if __name__ == '__main__':
-    with open('data/vocabulary/hrLex_v1.3') as f:
-        freqs = collections.defaultdict(float)
+def iterate_frequencies(hrlex_file: Path) -> Iterable[Tuple[str, float]]:
+    """Lemma and frequency per million of each word form in hrLex"""
+    with open(hrlex_file) as f:
         for line in f:
             _, lemma, _, _, _, _, _, per_million_freq = line.split('\t')
-            freqs[lemma] += float(per_million_freq)
+            yield lemma, float(per_million_freq)
+
+
+def build_frequencies(hrlex_file: Path, output_file: Path):
+    """Sum up the frequencies of all word forms per lemma
+
+    The forms are aggregated in the output database while reading the input,
+    so that hrLex is never loaded into memory. The result is a table sorted
+    by lemma, which can be queried without loading it into memory, see
+    givematerial.extractors.LemmaFrequencies
+    """
+    # processes using the old file keep reading it until it is replaced
+    tmp_file = output_file.with_suffix('.tmp')
+    if tmp_file.exists():
+        os.remove(tmp_file)
+
+    conn = sqlite3.connect(str(tmp_file))
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('''CREATE TABLE frequencies (
+        lemma TEXT PRIMARY KEY,
+        frequency REAL
+    ) WITHOUT ROWID''')
+    conn.executemany(
+        'INSERT INTO frequencies (lemma, frequency) VALUES (?, ?) '
+        'ON CONFLICT (lemma) DO UPDATE '
+        'SET frequency = frequency + excluded.frequency',
+        iterate_frequencies(hrlex_file))
+    conn.commit()
+    # rewrite the table without the free space of the many updates
+    conn.execute('VACUUM')
+    conn.close()
+
+    os.replace(tmp_file, output_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create a table of lemma frequencies from hrLex')
+    parser.add_argument(
+        '--input', '-i', dest='input', type=Path,
+        default=Path('data') / 'vocabulary' / 'hrLex_v1.3')
+    parser.add_argument(
+        '--output', '-o', dest='output', type=Path,
+        default=Path('data') / 'vocabulary' / 'word_frequencies.sqlite')
+    args = parser.parse_args()
 
-    with open('data/vocabulary/word_frequencies.json', 'wt') as f:
-        json.dump(freqs, f)
+    build_frequencies(args.input, args.output)
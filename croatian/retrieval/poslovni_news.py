@@ -1,12 +1,13 @@
 import argparse
 from dataclasses import dataclass
-import json
+import logging
 from pathlib import Path
-import requests
-import time
 from typing import List
 import xextract
 
+from givematerial import retrieval
+from givematerial.ingestion import TextIngestor
+
 
 @dataclass
 class Text:
@@ -15,14 +16,16 @@ class Text:
     url: str
 
 
-def fetch_article_urls(feed_url: str) -> List[str]:
-    r = requests.get(feed_url)
-    urls = xextract.String(css='rss channel item link').parse(r.text)
-    return urls
+def fetch_article_urls(
+        retriever: retrieval.Retriever, feed_url: str) -> List[str]:
+    def parse(r):
+        return xextract.String(css='rss channel item link').parse(r.text)
+
+    return retriever.links(feed_url, parse)
 
 
-def fetch_article(url: str) -> Text:
-    r = requests.get(url)
+def fetch_article(retriever: retrieval.Retriever, url: str) -> Text:
+    r = retriever.get(url, conditional=False)
     title = xextract.String(css='.single__title .title').parse(r.text)[0]
     content = xextract.String(css='.article__content', attr='_all_text').parse(r.text)[0]
 
@@ -33,28 +36,35 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-o', '--output', required=False,
-        help='Output folder for lyrics results, will be created. '
-        'Defaults to "lyrics"')
+        help='Output folder for articles inside data/texts, will be '
+        'created. Defaults to "data/texts"')
 
     args = parser.parse_args()
     outdir = Path(args.output) if args.output else Path('data/texts')
 
-    article_urls = fetch_article_urls('https://www.poslovni.hr/feed')
-    time.sleep(1)
+    logging.basicConfig(level=logging.INFO)
+    ingestor = TextIngestor()
+    retriever = retrieval.Retriever(
+        retrieval.default_state_file('poslovni'),
+        stored_urls=ingestor.urls())
+
+    article_urls = fetch_article_urls(
+        retriever, 'https://www.poslovni.hr/feed')
 
-    for url in article_urls:
-        article = fetch_article(url)
+    def store_article(url: str):
+        article = fetch_article(retriever, url)
         article_id = url.split('-')[-1]
 
         print(f'Writing text {article.title}')
-        with open(outdir / f'{article_id}.json', 'wt') as f:
-            data = {
+        ingestor.add(
+            outdir / f'{article_id}.json',
+            {
                 'collection': 'news',
                 'title': f'Poslovni - {article.title}',
                 'text': article.text,
                 'language': 'hr',
                 'url': article.url,
-            }
-            json.dump(data, f)
+            })
 
-        time.sleep(1)
+    retriever.run(article_urls, store_article)
+    ingestor.close()
@@ -1,14 +1,15 @@
 import argparse
 from dataclasses import dataclass
-import json
+import logging
 from pathlib import Path
 import re
-import requests
-import time
 from typing import List
 import urllib
 import xextract
 
+from givematerial import retrieval
+from givematerial.ingestion import TextIngestor
+
 
 @dataclass
 class Lyrics:
@@ -18,14 +19,17 @@ class Lyrics:
     url: str
 
 
-def fetch_lyrics_urls(artist_url: str) -> List[str]:
-    r = requests.get(artist_url)
-    urls = xextract.String(css='.artLyrList a', attr='href').parse(r.text)
-    return [urllib.parse.urljoin(artist_url, url) for url in urls]
+def fetch_lyrics_urls(
+        retriever: retrieval.Retriever, artist_url: str) -> List[str]:
+    def parse(r):
+        urls = xextract.String(css='.artLyrList a', attr='href').parse(r.text)
+        return [urllib.parse.urljoin(artist_url, url) for url in urls]
+
+    return retriever.links(artist_url, parse)
 
 
-def fetch_lyrics(lyrics_url: str) -> Lyrics:
-    r = requests.get(lyrics_url)
+def fetch_lyrics(retriever: retrieval.Retriever, lyrics_url: str) -> Lyrics:
+    r = retriever.get(lyrics_url, conditional=False)
     artist, title = \
         xextract.String(css='.lyricCapt', attr='_all_text').parse(r.text)
     lyrics = xextract.String(css='.lyric').parse(r.text)
@@ -44,7 +48,8 @@ if __name__ == '__main__':
     #
     # Please don't abuse their niceness. Only scrape for your own personal
     # use, remain polite (i.e. have sleeps between requests) and only scrape
-    # the lyrics you need.
+    # the lyrics you need. The retriever starts at most one request per
+    # second and skips lyrics we already have.
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -54,36 +59,40 @@ if __name__ == '__main__':
         'e.g. https://tekstovi.net/2,206,0.html')
     parser.add_argument(
         '-o', '--output', required=False,
-        help='Output folder for lyrics results, will be created. '
-        'Defaults to "lyrics"')
+        help='Output folder for lyrics results inside data/texts, will be '
+        'created. Defaults to "data/texts"')
 
     args = parser.parse_args()
     artist_pages = args.url
     outdir = Path(args.output) if args.output else Path('data/texts')
 
+    logging.basicConfig(level=logging.INFO)
+    ingestor = TextIngestor()
+    retriever = retrieval.Retriever(
+        retrieval.default_state_file('tekstovi'),
+        stored_urls=ingestor.urls())
+
     lyrics_urls = []
     for artist_page in artist_pages:
-        lyrics_urls += fetch_lyrics_urls(artist_page)
-        time.sleep(1)
+        lyrics_urls += fetch_lyrics_urls(retriever, artist_page)
 
-    for lyrics_url in lyrics_urls:
-        lyrics = fetch_lyrics(lyrics_url)
+    def store_lyrics(lyrics_url: str):
+        lyrics = fetch_lyrics(retriever, lyrics_url)
 
         # TODO: Improve replacement of special chars
         artist_dirname = re.sub('[^0-9a-zA-Z- ]+', '-', lyrics.artist)
         title_filename = re.sub('[^0-9a-zA-Z- ]+', '-', lyrics.title).strip()
-        artist_dir = outdir / artist_dirname
-        artist_dir.mkdir(exist_ok=True, parents=True)
 
         print(f'Writing lyrics for {lyrics.artist} - {lyrics.title}')
-        with open(artist_dir / f'{title_filename}.json', 'wt') as f:
-            data = {
+        ingestor.add(
+            outdir / artist_dirname / f'{title_filename}.json',
+            {
                 'collection': 'lyrics',
                 'title': f'{lyrics.artist} - {lyrics.title}',
                 'text': lyrics.text,
                 'language': 'hr',
                 'url': lyrics.url,
-            }
-            json.dump(data, f)
+            })
 
-        time.sleep(1)
+    retriever.run(lyrics_urls, store_lyrics)
+    ingestor.close()
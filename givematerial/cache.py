@@ -1,5 +1,11 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
 import sqlite3
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import givematerial.db.sqlite
 
 
 class SqliteLearnableCache:
@@ -11,30 +17,425 @@ class SqliteLearnableCache:
         cur = self.conn.cursor()
 
         cur.execute(
-            'SELECT learnable, status FROM user_status WHERE user_id = ?',
+            'SELECT l.learnable, s.status FROM user_status s '
+            'JOIN user u ON u.id = s.user_id '
+            'JOIN learnable l ON l.id = s.learnable_id '
+            'WHERE u.token = ?',
             (self.user_identifier,))
 
         learning = []
         known = []
         for row in cur.fetchall():
-            if row[1] == 'learning':
+            if row[1] == givematerial.db.sqlite.STATUS_LEARNING:
                 learning.append(row[0])
-            elif row[1] == 'known':
+            elif row[1] == givematerial.db.sqlite.STATUS_KNOWN:
                 known.append(row[0])
 
         return learning, known
 
-    def update_cache(self, learning: List[str], known: List[str]):
+    def status_version(self) -> int:
+        """Version of the status, increased with every change"""
         cur = self.conn.cursor()
+        cur.execute(
+            'SELECT status_version FROM user WHERE token = ?',
+            (self.user_identifier,))
+        row = cur.fetchone()
+
+        return (row[0] or 0) if row else 0
+
+    def update_cache(self, learning: List[str], known: List[str]):
+        """Replace the status of the user with a full snapshot
+
+        Only the difference to the stored status is written.
+        """
+        # read and write in one transaction
+        self._begin()
+
+        old_learning, old_known = self.read_cache()
+        removed = set(old_learning).union(old_known) \
+            .difference(learning).difference(known)
+
+        # known words win if a word occurs in both lists
+        changes = {learnable: 'learning' for learnable in learning}
+        changes.update({learnable: 'known' for learnable in known})
+        old_status = {learnable: 'learning' for learnable in old_learning}
+        old_status.update({learnable: 'known' for learnable in old_known})
+        changes = {
+            learnable: status for learnable, status in changes.items()
+            if old_status.get(learnable) != status}
+
+        self.apply_changes(changes, removed)
+
+    def apply_changes(
+            self, changes: Dict[str, str],
+            removed: Iterable[str] = ()) -> int:
+        """Set the status of some learnables and remove others
+
+        `changes` maps learnables to their new status (`learning` or
+        `known`). Returns the number of changed rows.
+        """
+        self._begin()
+        try:
+            changed = self._write_changes(changes, removed)
+            if changed:
+                self._increase_version()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
+        return changed
+
+    def apply_delta(
+            self, changes: Dict[str, str], removed: Iterable[str],
+            base_version: int) -> Optional[int]:
+        """Apply changes that were made on top of a known status version
+
+        Returns the new status version or None if the status was changed
+        since `base_version`, nothing is written in this case. The version
+        stays the same if the changes do not change the status.
+        """
+        self._begin()
+        try:
+            if self.status_version() != base_version:
+                self.conn.rollback()
+                return None
+
+            version = base_version
+            if self._write_changes(changes, removed):
+                version = self._increase_version()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        return version
+
+    def _begin(self):
+        # take the write lock right away, so that reading the status and
+        # writing changes cannot interleave with other writers
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+
+    def _increase_version(self) -> int:
+        cur = self.conn.cursor()
         cur.execute(
-            'DELETE FROM user_status WHERE user_id = ?', (self.user_identifier,))
+            'UPDATE user SET status_version = COALESCE(status_version, 0) + 1 '
+            'WHERE token = ?',
+            (self.user_identifier,))
+
+        return self.status_version()
+
+    def _write_changes(
+            self, changes: Dict[str, str], removed: Iterable[str]) -> int:
+        user_id = givematerial.db.sqlite.get_user_id(
+            self.conn, self.user_identifier, create=True)
+        learnable_ids = givematerial.db.sqlite.get_learnable_ids(
+            self.conn, changes.keys(), create=True)
+        cur = self.conn.cursor()
 
         cur.executemany(
-            'INSERT INTO user_status (user_id, learnable, status) VALUES (?, ?, "learning")',
-            [(self.user_identifier, learnable) for learnable in learning])
+            'INSERT INTO user_status (user_id, learnable_id, status) '
+            'VALUES (?, ?, ?) '
+            'ON CONFLICT (user_id, learnable_id) DO UPDATE '
+            'SET status = excluded.status WHERE status != excluded.status',
+            [(user_id, learnable_ids[learnable],
+              givematerial.db.sqlite.STATUS_CODES[status])
+             for learnable, status in changes.items()])
+        changed = cur.rowcount
+
+        removed_ids = givematerial.db.sqlite.get_learnable_ids(
+            self.conn, removed)
         cur.executemany(
-            'INSERT INTO user_status (user_id, learnable, status) VALUES (?, ?, "known")',
-            [(self.user_identifier, learnable) for learnable in known])
+            'DELETE FROM user_status WHERE user_id = ? AND learnable_id = ?',
+            [(user_id, learnable_id)
+             for learnable_id in removed_ids.values()])
+        changed += cur.rowcount
+
+        return changed
+
+
+# extractor of entries adopted from the legacy cache keyed by title, only
+# readers accepting any extractor use them, see `adopt_title_entry`
+LEGACY_EXTRACTOR_ID = 'legacy-title'
+
+
+def _title_key(title: str) -> str:
+    return str(hashlib.sha256(title.encode('utf-8')).hexdigest())
+
+
+class LearnableCache:
+    """Cache for the learnables extracted from texts
+
+    All entries are packed into a single SQLite file inside the cache
+    folder instead of one file per text. Entries are keyed by the hash of
+    the text content and the extractor that produced them, so that edited
+    texts or a new extractor version never use outdated results. Empty
+    results are cached as well.
+    """
+    def __init__(self, cache_folder: Path):
+        self.cache_folder = cache_folder
+
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        # the web app reads while extraction workers write to the cache
+        self.conn = givematerial.db.sqlite.connect(
+            str(cache_folder / 'learnables.sqlite'))
+        self._create_tables()
+
+    def close(self):
+        self.conn.close()
+
+    def _create_tables(self):
+        cur = self.conn.cursor()
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS learnables (
+            content_hash TEXT,
+            extractor TEXT,
+            learnables TEXT,
+            created DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (content_hash, extractor)
+        ) WITHOUT ROWID''')
+        # entries from older versions which were keyed by the text title,
+        # they are moved to the new table when they are hit
+        cur.execute('''CREATE TABLE IF NOT EXISTS title_learnables (
+            key TEXT PRIMARY KEY,
+            learnables TEXT
+        ) WITHOUT ROWID''')
+
+        cur.execute('PRAGMA table_info(learnables)')
+        columns = [row[1] for row in cur.fetchall()]
+        if 'key' in columns:
+            cur.execute(
+                'INSERT OR IGNORE INTO title_learnables (key, learnables) '
+                'SELECT key, learnables FROM learnables')
+            cur.execute('DROP TABLE learnables')
+            self.conn.commit()
+            self._create_tables()
+
+        self.conn.commit()
+
+    def lookup(
+            self, content_hash: str,
+            extractor: Optional[str]) -> Optional[Tuple[str, List[str]]]:
+        """Find cached learnables for a text content
+
+        If `extractor` is None, the newest entry of any extractor is
+        returned. Returns a tuple of extractor and learnables or None if
+        there is no entry.
+        """
+        cur = self.conn.cursor()
+        if extractor is None:
+            cur.execute(
+                'SELECT extractor, learnables FROM learnables '
+                'WHERE content_hash = ? ORDER BY created DESC LIMIT 1',
+                (content_hash,))
+        else:
+            cur.execute(
+                'SELECT extractor, learnables FROM learnables '
+                'WHERE content_hash = ? AND extractor = ?',
+                (content_hash, extractor))
+        row = cur.fetchone()
+
+        if row:
+            return row[0], json.loads(row[1])
+
+        return None
+
+    def check_cache(
+            self, content_hash: str, extractor: str) -> Optional[List[str]]:
+        """Cached learnables or None, an empty list is a valid result"""
+        entry = self.lookup(content_hash, extractor)
+        return entry[1] if entry else None
+
+    def write_cache(
+            self, content_hash: str, extractor: str, lemmas: List[str]):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO learnables '
+            '(content_hash, extractor, learnables) VALUES (?, ?, ?)',
+            (content_hash, extractor, json.dumps(lemmas)))
+        self.conn.commit()
 
+    def write_entries(
+            self, extractor: str, entries: List[Tuple[str, List[str]]]):
+        """Store the learnables of many texts in a single transaction"""
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO learnables '
+            '(content_hash, extractor, learnables) VALUES (?, ?, ?)',
+            [(content_hash, extractor, json.dumps(lemmas))
+             for content_hash, lemmas in entries])
         self.conn.commit()
+
+    def check_title_cache(self, title: str) -> Optional[List[str]]:
+        """Look up an entry from older versions keyed by the text title"""
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT learnables FROM title_learnables WHERE key = ?',
+            (_title_key(title),))
+        row = cur.fetchone()
+
+        # older versions also stored empty results if extraction failed
+        if row and row[0] != '[]':
+            return json.loads(row[0])
+
+        return None
+
+    def adopt_title_entry(
+            self, content_hash: str, title: str) -> Optional[List[str]]:
+        """Store the legacy entry of a title for a text content
+
+        Titles are not unique and the extractor of legacy entries is not
+        known, so the entry is stored with `LEGACY_EXTRACTOR_ID` and never
+        satisfies a lookup for a specific extractor.
+        """
+        lemmas = self.check_title_cache(title)
+        if lemmas is not None:
+            self.write_cache(content_hash, LEGACY_EXTRACTOR_ID, lemmas)
+
+        return lemmas
+
+    def write_title_entries(self, entries: List[Tuple[str, List[str]]]):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO title_learnables (key, learnables) '
+            'VALUES (?, ?)',
+            [(key, json.dumps(lemmas)) for key, lemmas in entries])
+        self.conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Number of entries per extractor"""
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT extractor, COUNT(*) FROM learnables GROUP BY extractor')
+        counts = dict(cur.fetchall())
+
+        cur.execute('SELECT COUNT(*) FROM title_learnables')
+        counts['title (legacy)'] = cur.fetchone()[0]
+
+        return counts
+
+    def stale_entries(
+            self, extractor: str, texts: Iterable[Tuple[str, str]]) -> int:
+        """Number of entries that are not needed for the indexed texts
+
+        `texts` are the content hash and title of all indexed texts.
+        """
+        texts = list(texts)
+        return sum(1 for _ in self._stale_keys(extractor, texts)) \
+            + len(self._stale_title_keys(texts))
+
+    def evict_stale(
+            self, extractor: str, texts: Iterable[Tuple[str, str]]) -> int:
+        """Remove stale entries, returns the number of removed entries
+
+        Entries of other extractors and for texts that are not indexed are
+        stale. Adopted legacy entries are kept until the text is extracted
+        with `extractor`, legacy title entries until they are adopted.
+        """
+        texts = list(texts)
+        stale = list(self._stale_keys(extractor, texts))
+        self.conn.executemany(
+            'DELETE FROM learnables WHERE content_hash = ? AND extractor = ?',
+            stale)
+
+        stale_titles = self._stale_title_keys(texts)
+        self.conn.executemany(
+            'DELETE FROM title_learnables WHERE key = ?',
+            [(key,) for key in stale_titles])
+        evicted = len(stale) + len(stale_titles)
+
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+        return evicted
+
+    def _stale_keys(
+            self, extractor: str,
+            texts: List[Tuple[str, str]]) -> Iterable[Tuple[str, str]]:
+        content_hashes = {content_hash for content_hash, _ in texts}
+
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT content_hash FROM learnables WHERE extractor = ?',
+            (extractor,))
+        extracted = {row[0] for row in cur.fetchall()}
+
+        cur.execute('SELECT content_hash, extractor FROM learnables')
+        for content_hash, entry_extractor in cur.fetchall():
+            if content_hash not in content_hashes:
+                yield content_hash, entry_extractor
+            elif entry_extractor == LEGACY_EXTRACTOR_ID:
+                if content_hash in extracted:
+                    yield content_hash, entry_extractor
+            elif entry_extractor != extractor:
+                yield content_hash, entry_extractor
+
+    def _stale_title_keys(self, texts: List[Tuple[str, str]]) -> List[str]:
+        """Title entries which are adopted or match no indexed text"""
+        cur = self.conn.cursor()
+        cur.execute('SELECT DISTINCT content_hash FROM learnables')
+        cached = {row[0] for row in cur.fetchall()}
+
+        # a title is still needed while one of its texts has no entry
+        needed = {_title_key(title) for content_hash, title in texts
+                  if content_hash not in cached}
+
+        cur.execute('SELECT key FROM title_learnables')
+        return [row[0] for row in cur.fetchall() if row[0] not in needed]
+
+
+class DirectoryLearnableCache:
+    """Legacy cache storing one JSON file per text, only used for migration"""
+    def __init__(self, cache_folder: Path):
+        self.cache_folder = cache_folder
+
+    def check_cache(self, title: str) -> List[str]:
+        cache_file = self._cache_file(title)
+
+        if cache_file.is_file():
+            with open(cache_file, 'rt') as f:
+                return json.load(f)
+
+        return []
+
+    def write_cache(self, title: str, lemmas: List[str]):
+        cache_file = self._cache_file(title)
+
+        with open(cache_file, 'wt') as f:
+            json.dump(lemmas, f)
+
+    def entries(self):
+        for cache_file in self.cache_folder.glob('*.json'):
+            with open(cache_file, 'rt') as f:
+                yield cache_file.stem, json.load(f)
+
+    def _cache_file(self, title: str) -> Path:
+        return self.cache_folder / f'{_title_key(title)}.json'
+
+
+def migrate_directory_cache(
+        cache_folder: Path, delete: bool = False,
+        batch_size: int = 1000) -> int:
+    """Move all entries of a directory cache into the packed cache
+
+    Returns the number of migrated entries.
+    """
+    legacy_cache = DirectoryLearnableCache(cache_folder)
+    cache = LearnableCache(cache_folder)
+
+    migrated = 0
+    batch = []
+    for key, lemmas in legacy_cache.entries():
+        batch.append((key, lemmas))
+        if len(batch) >= batch_size:
+            cache.write_title_entries(batch)
+            migrated += len(batch)
+            batch = []
+            logging.info(f'Migrated {migrated} cache entries')
+
+    cache.write_title_entries(batch)
+    migrated += len(batch)
+
+    if delete:
+        for cache_file in cache_folder.glob('*.json'):
+            cache_file.unlink()
+
+    return migrated
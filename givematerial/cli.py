@@ -1,8 +1,11 @@
 import argparse
 import logging
 import os
+from pathlib import Path
 
-from givematerial import recommendation
+from givematerial import cache, extractors, prepare, recommendation
+import givematerial.db.sqlite
+from givematerial.corpus import CorpusIndex
 
 
 def main():
@@ -14,16 +17,49 @@ def main():
     prepare_parser = subparsers.add_parser('prepare-text-cache')
     prepare_parser.add_argument(
         '--language', '-l', dest='language', required=True)
+    prepare_parser.add_argument(
+        '--workers', '-w', dest='workers', type=int, default=None,
+        help='Number of worker processes, each loads its own extractor. '
+        f'Defaults to {prepare.DEFAULT_WORKERS}')
+    prepare_parser.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=16,
+        help='Number of texts sent to a worker at once')
+    prepare_parser.add_argument(
+        '--async', dest='run_async', action='store_true',
+        help='Only submit missing texts to the extraction worker')
 
     recommend_parser = subparsers.add_parser('recommend')
     recommend_parser.add_argument(
         '--language', '-l', dest='language', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate-cache')
+    migrate_parser.add_argument(
+        '--language', '-l', dest='language', required=True)
+    migrate_parser.add_argument(
+        '--delete', action='store_true',
+        help='Delete the JSON cache files after migration')
+
+    cache_parser = subparsers.add_parser('cache')
+    cache_parser.add_argument(
+        '--language', '-l', dest='language', required=True)
+    cache_parser.add_argument(
+        '--evict', action='store_true',
+        help='Remove entries of other extractor versions and of texts that '
+        'are no longer in the corpus')
     args = parser.parse_args()
 
-    if args.subparser_name == 'prepare-text-cache':
-        # TODO: Call better functions for preparing the cache, not rely on
-        # calc_recommendations() creating the cache
-        recommendation.calc_recommendations(args.language)
+    if args.subparser_name == 'prepare-text-cache' and args.run_async:
+        count = prepare.submit_missing(
+            args.language, Path('data') / 'texts',
+            Path('data') / args.language / 'cache',
+            givematerial.db.sqlite.connect())
+        print(f'Submitted {count} texts to the extraction worker')
+    elif args.subparser_name == 'prepare-text-cache':
+        count = prepare.prepare_cache(
+            args.language, Path('data') / 'texts',
+            Path('data') / args.language / 'cache', workers=args.workers,
+            batch_size=args.batch_size, progress=prepare.ProgressPrinter())
+        print(f'Extracted learnables for {count} texts')
     elif args.subparser_name == 'recommend':
         for ts in recommendation.calc_recommendations(args.language):
             print(
@@ -34,6 +70,29 @@ def main():
             print(ts.text)
             print()
             print()
+    elif args.subparser_name == 'migrate-cache':
+        cache_folder = Path('data') / args.language / 'cache'
+        count = cache.migrate_directory_cache(cache_folder, args.delete)
+        print(f'Migrated {count} entries to the packed cache')
+    elif args.subparser_name == 'cache':
+        learnable_cache = cache.LearnableCache(
+            Path('data') / args.language / 'cache')
+        extractor_id = \
+            extractors.extractor_class(args.language).extractor_id
+        corpus = CorpusIndex(Path('data') / 'texts')
+        corpus.refresh()
+        texts = corpus.text_keys(args.language)
+
+        for extractor, count in learnable_cache.stats().items():
+            print(f'{extractor}: {count} entries')
+        print(f'Current extractor: {extractor_id}')
+
+        if args.evict:
+            count = learnable_cache.evict_stale(extractor_id, texts)
+            print(f'Evicted {count} stale entries')
+        else:
+            count = learnable_cache.stale_entries(extractor_id, texts)
+            print(f'Stale entries: {count}')
 
 
 def manage_read():
@@ -0,0 +1,340 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from givematerial.db.sqlite import connect
+
+
+# increase whenever the schema of the index changes
+INDEX_SCHEMA_VERSION = 2
+# number of changed files after which a refresh commits, so that other
+# processes do not wait for the lock during the whole scan
+REFRESH_BATCH_SIZE = 500
+
+
+@dataclasses.dataclass
+class IndexedText:
+    id: int
+    path: Path
+    collection: str
+    title: str
+    language: str
+    url: Optional[str]
+    content_hash: str
+    learnables: Optional[List[str]]
+    # the extractor the learnables were extracted with
+    extractor: Optional[str]
+
+    def load_text(self) -> str:
+        with open(self.path) as f:
+            return json.load(f)['text']
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CorpusIndex:
+    """Persistent index over the JSON texts stored in a folder
+
+    The index keeps the metadata and the extracted learnables of each text
+    in SQLite so that recommendations do not have to walk the folder and
+    parse every text file. Entries are keyed by the file path and are only
+    re-read if the modification time or size of the file changed.
+    """
+    def __init__(self, texts_folder: Path, index_file: Optional[Path] = None):
+        self.texts_folder = texts_folder
+        if index_file is None:
+            index_file = texts_folder / 'index.sqlite'
+
+        texts_folder.mkdir(parents=True, exist_ok=True)
+        # WAL mode lets the web app read while workers and scrapers write,
+        # scrapers add texts from several threads and synchronize access
+        self.conn = connect(str(index_file))
+        self._create_tables()
+        self._dirty = False
+
+    def _create_tables(self):
+        cur = self.conn.cursor()
+        # an index with the current schema is opened without writing to it
+        cur.execute('PRAGMA user_version')
+        if cur.fetchone()[0] >= INDEX_SCHEMA_VERSION:
+            return
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS texts (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE,
+            mtime INTEGER,
+            size INTEGER,
+            collection TEXT,
+            title TEXT,
+            language TEXT,
+            url TEXT,
+            content_hash TEXT,
+            learnables TEXT,
+            extractor TEXT
+        )''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_texts_language ON texts (language)')
+
+        cur.execute('PRAGMA table_info(texts)')
+        columns = [row[1] for row in cur.fetchall()]
+        if 'content_hash' not in columns:
+            cur.execute('ALTER TABLE texts ADD COLUMN content_hash TEXT')
+            cur.execute('ALTER TABLE texts ADD COLUMN extractor TEXT')
+            # re-read all files on the next refresh to calculate the hashes
+            cur.execute('UPDATE texts SET mtime = NULL')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_texts_content_hash ON texts (content_hash)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_texts_url ON texts (url)')
+
+        # the index version in which a text was changed last, NULL until
+        # the change is committed, see `changes`
+        if 'changed_version' not in columns:
+            cur.execute(
+                'ALTER TABLE texts ADD COLUMN changed_version INTEGER '
+                'DEFAULT 0')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_texts_changed_version ON texts (changed_version)')
+        cur.execute('''CREATE TABLE IF NOT EXISTS removed_texts (
+            id INTEGER PRIMARY KEY,
+            language TEXT,
+            changed_version INTEGER
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
+        )''')
+        cur.executemany(
+            'INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)',
+            [('version',), ('last_refresh',)])
+
+        cur.execute(f'PRAGMA user_version = {INDEX_SCHEMA_VERSION}')
+        self.conn.commit()
+
+    @property
+    def version(self) -> int:
+        """Counter that is increased whenever the indexed data changes"""
+        return self._get_meta('version')
+
+    def refresh(self, min_interval: Optional[float] = None) -> int:
+        """Synchronize the index with the texts folder
+
+        Only files that are new or have been modified since the last refresh
+        are parsed. If `min_interval` is given, the folder is not scanned at
+        all if the last refresh happened less than `min_interval` seconds ago.
+
+        Returns the number of added, updated and removed texts.
+        """
+        now = time.time()
+        if min_interval is not None \
+                and now - self._get_meta('last_refresh') < min_interval:
+            return 0
+
+        cur = self.conn.cursor()
+        cur.execute('SELECT path, mtime, size FROM texts')
+        indexed: Dict[str, Tuple[int, int]] = {
+            row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+        changes = 0
+        seen = set()
+        for text_file in self.texts_folder.rglob('*.json'):
+            path = str(text_file.relative_to(self.texts_folder))
+            seen.add(path)
+
+            stat = text_file.stat()
+            if indexed.get(path) == (stat.st_mtime_ns, stat.st_size):
+                continue
+
+            try:
+                with open(text_file) as f:
+                    text = json.load(f)
+            except (OSError, ValueError):
+                logging.exception(f'Could not index text file {text_file}')
+                continue
+
+            self._upsert_text(path, stat, text)
+            self._dirty = True
+            changes += 1
+            if changes % REFRESH_BATCH_SIZE == 0:
+                self.commit()
+
+        removed = [(path,) for path in indexed.keys() - seen]
+        cur.executemany(
+            'INSERT OR REPLACE INTO removed_texts (id, language) '
+            'SELECT id, language FROM texts WHERE path = ?',
+            removed)
+        cur.executemany('DELETE FROM texts WHERE path = ?', removed)
+        changes += len(removed)
+
+        if changes:
+            self._dirty = True
+        self._set_meta('last_refresh', now)
+        self.commit()
+
+        return changes
+
+    def add_text(
+            self, text_file: Path,
+            text: Dict[str, Any]) -> Optional[IndexedText]:
+        """Write a new text file and add it to the index right away
+
+        `text_file` must be inside the texts folder. Texts with a URL or
+        content that is already in the index are not added, None is
+        returned for them. Call `commit` to persist the new text.
+        """
+        text_hash = content_hash(text['text'])
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT COUNT(*) FROM texts '
+            'WHERE url = ? OR (language = ? AND content_hash = ?)',
+            (text.get('url'), text['language'], text_hash))
+        if cur.fetchone()[0] > 0:
+            return None
+
+        path = str(Path(text_file).resolve().relative_to(
+            self.texts_folder.resolve()))
+        text_file = self.texts_folder / path
+        text_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # a refresh at the same time must not see half-written files
+        tmp_file = text_file.with_suffix('.tmp')
+        with open(tmp_file, 'wt') as f:
+            json.dump(text, f)
+        os.replace(tmp_file, text_file)
+
+        self._upsert_text(path, text_file.stat(), text)
+        self._dirty = True
+
+        cur.execute(
+            'SELECT id, path, collection, title, language, url, '
+            'content_hash, learnables, extractor FROM texts WHERE path = ?',
+            (path,))
+        return self._text_from_row(cur.fetchone())
+
+    def _upsert_text(self, path: str, stat: os.stat_result, text: Dict):
+        self.conn.execute(
+            'INSERT INTO texts (path, mtime, size, collection, title, '
+            'language, url, content_hash, changed_version) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL) '
+            'ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, '
+            'size = excluded.size, collection = excluded.collection, '
+            'title = excluded.title, language = excluded.language, '
+            'url = excluded.url, content_hash = excluded.content_hash, '
+            'learnables = NULL, extractor = NULL, changed_version = NULL',
+            (path, stat.st_mtime_ns, stat.st_size, text['collection'],
+             text['title'], text['language'], text.get('url'),
+             content_hash(text['text'])))
+
+    def texts(self, language: str) -> List[IndexedText]:
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT id, path, collection, title, language, url, '
+            'content_hash, learnables, extractor '
+            'FROM texts WHERE language = ? ORDER BY id',
+            (language,))
+
+        return [self._text_from_row(row) for row in cur.fetchall()]
+
+    def changes(
+            self, language: str,
+            since_version: int) -> Tuple[List[IndexedText], List[int]]:
+        """Texts changed and ids of texts removed after `since_version`
+
+        Read the version before the changes, changes committed in between
+        may then be returned again on the next call, but are never missed.
+        """
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT id, path, collection, title, language, url, '
+            'content_hash, learnables, extractor '
+            'FROM texts WHERE language = ? AND changed_version > ? '
+            'ORDER BY id',
+            (language, since_version))
+        changed = [self._text_from_row(row) for row in cur.fetchall()]
+
+        cur.execute(
+            'SELECT id FROM removed_texts '
+            'WHERE language = ? AND changed_version > ?',
+            (language, since_version))
+        removed = [row[0] for row in cur.fetchall()]
+
+        return changed, removed
+
+    def texts_by_hash(
+            self, language: str, content_hash: str) -> List[IndexedText]:
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT id, path, collection, title, language, url, '
+            'content_hash, learnables, extractor '
+            'FROM texts WHERE language = ? AND content_hash = ?',
+            (language, content_hash))
+
+        return [self._text_from_row(row) for row in cur.fetchall()]
+
+    def _text_from_row(self, row) -> IndexedText:
+        return IndexedText(
+            id=row[0],
+            path=self.texts_folder / row[1],
+            collection=row[2],
+            title=row[3],
+            language=row[4],
+            url=row[5],
+            content_hash=row[6],
+            learnables=json.loads(row[7]) if row[7] is not None else None,
+            extractor=row[8])
+
+    def set_learnables(
+            self, text_id: int, learnables: List[str],
+            extractor: Optional[str]):
+        """Store the learnables of a text, call `commit` to persist them"""
+        self.conn.execute(
+            'UPDATE texts SET learnables = ?, extractor = ?, '
+            'changed_version = NULL WHERE id = ?',
+            (json.dumps(learnables), extractor, text_id))
+        self._dirty = True
+
+    def text_keys(self, language: str) -> List[Tuple[str, str]]:
+        """Content hash and title of all texts of a language"""
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT content_hash, title FROM texts WHERE language = ?',
+            (language,))
+        return cur.fetchall()
+
+    def urls(self) -> Set[str]:
+        cur = self.conn.cursor()
+        cur.execute('SELECT url FROM texts WHERE url IS NOT NULL')
+        return {row[0] for row in cur.fetchall()}
+
+    def commit(self):
+        if self._dirty:
+            self.conn.execute(
+                'UPDATE meta SET value = value + 1 WHERE key = ?',
+                ('version',))
+            # all writers hold the lock until here, so uncommitted changes
+            # are always from this connection
+            for table in ('texts', 'removed_texts'):
+                self.conn.execute(
+                    f'UPDATE {table} SET changed_version = '
+                    f'(SELECT value FROM meta WHERE key = ?) '
+                    f'WHERE changed_version IS NULL',
+                    ('version',))
+            self._dirty = False
+
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _get_meta(self, key: str):
+        cur = self.conn.cursor()
+        cur.execute('SELECT value FROM meta WHERE key = ?', (key,))
+        return cur.fetchone()[0]
+
+    def _set_meta(self, key: str, value):
+        self.conn.execute(
+            'UPDATE meta SET value = ? WHERE key = ?', (value, key))
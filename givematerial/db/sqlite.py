@@ -1,40 +1,344 @@
+import os
+import queue
 import sqlite3
+from typing import Dict, Iterable, Optional
+
+DB_NAME = 'givematerial.sqlite'
+# seconds to wait for a lock held by another process, e.g. the ingest worker
+BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', default=30))
+# compiled statements kept per connection
+STATEMENT_CACHE_SIZE = 256
+
+
+def connect(db_name: str = DB_NAME) -> sqlite3.Connection:
+    """Open a connection to the application database
+
+    The database runs in WAL mode, so that readers in the web app are not
+    blocked by the workers writing to it and vice versa. Concurrent writers
+    wait for each other up to `BUSY_TIMEOUT` instead of failing.
+    """
+    conn = sqlite3.connect(
+        db_name, timeout=BUSY_TIMEOUT,
+        cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # in WAL mode this is still safe against corruption, it only risks
+    # losing the last transactions on power loss
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}')
+
+    return conn
+
+
+class ConnectionPool:
+    """Reusable connections of a single worker process
+
+    Connections keep their compiled statements between requests. A pool
+    that is inherited through fork (e.g. by uwsgi workers) discards the
+    connections of the parent process and opens its own.
+    """
+    def __init__(self, db_name: str = DB_NAME, size: int = 8):
+        self.db_name = db_name
+        self.size = size
+
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> sqlite3.Connection:
+        self._check_pid()
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.db_name)
+
+    def release(self, conn: sqlite3.Connection):
+        # do not hand out a connection with a pending transaction
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self._pid != os.getpid():
+            conn.close()
+            return
+
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # connections must not be shared between processes, so they are
+            # dropped without closing them
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue(maxsize=self.size)
+
+
+# increase whenever the schema changes and add a migration step
+SCHEMA_VERSION = 8
+
+# status codes stored in user_status
+STATUS_LEARNING = 1
+STATUS_KNOWN = 2
+STATUS_CODES = {'learning': STATUS_LEARNING, 'known': STATUS_KNOWN}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+# maximum number of parameters in a single IN clause
+_MAX_VARIABLES = 500
 
 
 def create_tables(conn: sqlite3.Connection):
     cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    version = cur.fetchone()[0]
+
+    if version == 0 and _table_exists(cur, 'user_status'):
+        _migrate_to_integer_ids(conn)
+    else:
+        _create_schema(cur)
+
+    if version < 2:
+        _add_missing_column(cur, 'token_requests', 'requested', 'DATETIME')
+    if version < 3:
+        _add_missing_column(cur, 'user', 'wanikani_updated_after', 'TEXT')
+    if version < 4:
+        _add_missing_column(cur, 'user', 'last_sync', 'DATETIME')
+        _add_missing_column(
+            cur, 'token_requests', 'priority', 'INTEGER DEFAULT 0')
+        # older versions stored the literal string "now" as login time
+        cur.execute(
+            'UPDATE user SET last_login = NULL WHERE last_login = ?',
+            ('now',))
+    if version < 5:
+        _add_missing_column(
+            cur, 'user', 'status_version', 'INTEGER DEFAULT 0')
+    if version < 6:
+        _add_missing_column(
+            cur, 'user', 'reading_list_version', 'INTEGER DEFAULT 0')
+    if version < 7:
+        _add_missing_column(cur, 'user', 'last_attempt', 'DATETIME')
+        _add_missing_column(
+            cur, 'user', 'sync_failures', 'INTEGER DEFAULT 0')
+    if version < 8:
+        _migrate_token_requests(cur)
+
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.commit()
+
+
+def _create_schema(cur: sqlite3.Cursor):
+    # users are identified by a token, e.g. the Wanikani API token or
+    # a generated UUID, all other tables refer to the integer id
     cur.execute('''CREATE TABLE IF NOT EXISTS user (
-        user_id TEXT,
+        id INTEGER PRIMARY KEY,
+        token TEXT NOT NULL,
         language TEXT,
-        last_login DATETIME
+        last_login DATETIME,
+        -- time of the last successful Wanikani sync
+        last_sync DATETIME,
+        -- time of the last sync, successful or not, and the number of
+        -- failed syncs since the last successful one
+        last_attempt DATETIME,
+        sync_failures INTEGER DEFAULT 0,
+        wanikani_updated_after TEXT,
+        -- increased with every change of user_status
+        status_version INTEGER DEFAULT 0,
+        -- increased with every change of reading_list
+        reading_list_version INTEGER DEFAULT 0
     )''')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_user_user_id ON user (user_id)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_user_token ON user (token)')
 
-    # TODO: Use a numeric id for foreign key to user
     cur.execute('''CREATE TABLE IF NOT EXISTS srs (
-        user_id TEXT,
+        user_id INTEGER REFERENCES user (id),
         name TEXT,
         login TEXT
     )''')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_srs_user_id ON srs (user_id)')
 
-    cur.execute('''CREATE TABLE IF NOT EXISTS user_status (
-        learnable TEXT,
-        status TEXT,
-        user_id TEXT
+    # every learnable string is stored only once
+    cur.execute('''CREATE TABLE IF NOT EXISTS learnable (
+        id INTEGER PRIMARY KEY,
+        learnable TEXT NOT NULL
     )''')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_user_status_user_id ON user_status (user_id)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_learnable_learnable ON learnable (learnable)')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS user_status (
+        user_id INTEGER REFERENCES user (id),
+        learnable_id INTEGER REFERENCES learnable (id),
+        status INTEGER,
+        PRIMARY KEY (user_id, learnable_id)
+    ) WITHOUT ROWID''')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_user_status_user_id_status ON user_status (user_id, status)')
 
     cur.execute('''CREATE TABLE IF NOT EXISTS reading_list (
-        user_id TEXT,
+        user_id INTEGER REFERENCES user (id),
         text_url TEXT
     )''')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_reading_list_user_id ON reading_list (user_id)')
 
+    # requests refer to the token, so that logging in does not create a
+    # user, Wanikani users are created by their first successful download
     cur.execute('''CREATE TABLE IF NOT EXISTS token_requests (
-        user_id TEXT
+        token TEXT PRIMARY KEY,
+        requested DATETIME,
+        priority INTEGER DEFAULT 0
+    )''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS extraction_requests (
+        content_hash TEXT,
+        language TEXT
     )''')
-    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_token_requests_user_id ON token_requests (user_id)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_extraction_requests_hash_language ON extraction_requests (content_hash, language)')
+
+
+def _table_exists(cur: sqlite3.Cursor, name: str) -> bool:
+    cur.execute(
+        'SELECT COUNT(*) FROM sqlite_master WHERE type = ? AND name = ?',
+        ('table', name))
+    return cur.fetchone()[0] > 0
+
+
+def _add_missing_column(
+        cur: sqlite3.Cursor, table: str, column: str, definition: str):
+    cur.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cur.fetchall()]:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _migrate_token_requests(cur: sqlite3.Cursor):
+    """Refer to the token instead of the user id in download requests"""
+    cur.execute('PRAGMA table_info(token_requests)')
+    if 'user_id' not in [row[1] for row in cur.fetchall()]:
+        return
+
+    cur.execute('ALTER TABLE token_requests RENAME TO token_requests_old')
+    _create_schema(cur)
+    cur.execute('''INSERT INTO token_requests (token, requested, priority)
+        SELECT user.token, t.requested, t.priority FROM token_requests_old t
+        JOIN user ON user.id = t.user_id''')
+    cur.execute('DROP TABLE token_requests_old')
+
+
+def _migrate_to_integer_ids(conn: sqlite3.Connection):
+    """Move the data of the schema with text user ids to integer ids
+
+    The whole migration runs in a single transaction.
+    """
+    old_tables = ['user', 'srs', 'user_status', 'reading_list', 'token_requests']
+
+    cur = conn.cursor()
+    if conn.in_transaction:
+        conn.commit()
+    cur.execute('BEGIN')
+
+    for table in old_tables:
+        if not _table_exists(cur, table):
+            continue
+
+        # index names are reused by the new tables
+        cur.execute(
+            'SELECT name FROM sqlite_master WHERE type = ? AND tbl_name = ?',
+            ('index', table))
+        for (index_name,) in cur.fetchall():
+            cur.execute(f'DROP INDEX {index_name}')
+        cur.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+
+    _create_schema(cur)
+
+    # Wanikani users only exist in the tables of their data
+    if _table_exists(cur, 'user_old'):
+        cur.execute('''INSERT INTO user (token, language, last_login)
+            SELECT user_id, MAX(language), MAX(last_login) FROM user_old
+            WHERE user_id IS NOT NULL GROUP BY user_id''')
+    # tokens of download requests are not necessarily valid
+    for table in ['srs', 'user_status', 'reading_list']:
+        if _table_exists(cur, f'{table}_old'):
+            cur.execute(
+                f'INSERT OR IGNORE INTO user (token) '
+                f'SELECT DISTINCT user_id FROM {table}_old '
+                f'WHERE user_id IS NOT NULL')
+
+    cur.execute('''INSERT OR IGNORE INTO learnable (learnable)
+        SELECT DISTINCT learnable FROM user_status_old
+        WHERE learnable IS NOT NULL''')
+    # older versions could store a learnable twice for a user, the newest
+    # row is inserted last and wins
+    cur.execute('''INSERT OR REPLACE INTO user_status
+        (user_id, learnable_id, status)
+        SELECT user.id, learnable.id,
+            CASE s.status WHEN 'learning' THEN ? WHEN 'known' THEN ? END
+        FROM user_status_old s
+        JOIN user ON user.token = s.user_id
+        JOIN learnable ON learnable.learnable = s.learnable
+        WHERE s.status IN ('learning', 'known')
+        ORDER BY s.rowid''', (STATUS_LEARNING, STATUS_KNOWN))
+
+    if _table_exists(cur, 'reading_list_old'):
+        cur.execute('''INSERT INTO reading_list (user_id, text_url)
+            SELECT user.id, r.text_url FROM reading_list_old r
+            JOIN user ON user.token = r.user_id''')
+    if _table_exists(cur, 'srs_old'):
+        cur.execute('''INSERT INTO srs (user_id, name, login)
+            SELECT user.id, s.name, s.login FROM srs_old s
+            JOIN user ON user.token = s.user_id''')
+    if _table_exists(cur, 'token_requests_old'):
+        cur.execute('''INSERT OR IGNORE INTO token_requests (token)
+            SELECT user_id FROM token_requests_old
+            WHERE user_id IS NOT NULL''')
+
+    for table in old_tables:
+        cur.execute(f'DROP TABLE IF EXISTS {table}_old')
 
     conn.commit()
+
+
+def get_user_id(
+        conn: sqlite3.Connection, token: str,
+        create: bool = False) -> Optional[int]:
+    """Integer id of the user with a token
+
+    If `create` is set, users without an entry are created, e.g. Wanikani
+    users who log in with their token.
+    """
+    cur = conn.cursor()
+    if create:
+        cur.execute(
+            'INSERT INTO user (token) VALUES (?) ON CONFLICT DO NOTHING',
+            (token,))
+
+    cur.execute('SELECT id FROM user WHERE token = ?', (token,))
+    row = cur.fetchone()
+
+    return row[0] if row else None
+
+
+def get_learnable_ids(
+        conn: sqlite3.Connection, learnables: Iterable[str],
+        create: bool = False) -> Dict[str, int]:
+    """Integer ids of learnables, unknown learnables are added if `create`"""
+    learnables = list(set(learnables))
+    cur = conn.cursor()
+
+    if create:
+        cur.executemany(
+            'INSERT INTO learnable (learnable) VALUES (?) '
+            'ON CONFLICT DO NOTHING',
+            [(learnable,) for learnable in learnables])
+
+    ids = {}
+    for start in range(0, len(learnables), _MAX_VARIABLES):
+        chunk = learnables[start:start + _MAX_VARIABLES]
+        placeholders = ', '.join('?' * len(chunk))
+        cur.execute(
+            f'SELECT learnable, id FROM learnable '
+            f'WHERE learnable IN ({placeholders})',
+            chunk)
+        ids.update(cur.fetchall())
+
+    return ids
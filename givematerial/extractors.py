@@ -1,58 +1,192 @@
-import classla
+import importlib.metadata
 import json
 from pathlib import Path
 import re
-from typing import Dict, List, Optional
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Union
+
+
+def _package_version(package: str) -> str:
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+class LemmaFrequencies:
+    """Read-only lemma frequency table stored in SQLite
+
+    Lookups go directly to the memory-mapped database file, so the table
+    does not have to be loaded into memory. The file is created by
+    `croatian/hrlex_frequency.py`.
+    """
+    def __init__(self, freqs_file: Path):
+        self.conn = sqlite3.connect(
+            f'{Path(freqs_file).resolve().as_uri()}?mode=ro', uri=True,
+            check_same_thread=False)
+        self.conn.execute('PRAGMA mmap_size = 268435456')
+
+    def get(self, lemma: str, default=None) -> Optional[float]:
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT frequency FROM frequencies WHERE lemma = ?', (lemma,))
+        row = cur.fetchone()
+
+        return row[0] if row else default
+
+    def get_many(self, lemmas: Iterable[str]) -> Dict[str, float]:
+        """Frequencies of several lemmas, unknown lemmas are left out"""
+        lemmas = list(dict.fromkeys(lemmas))
+        frequencies = {}
+        cur = self.conn.cursor()
+        # stay below the SQLite limit of host parameters
+        for i in range(0, len(lemmas), 500):
+            chunk = lemmas[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cur.execute(
+                f'SELECT lemma, frequency FROM frequencies '
+                f'WHERE lemma IN ({placeholders})',
+                chunk)
+            frequencies.update(cur.fetchall())
+
+        return frequencies
+
+    def __contains__(self, lemma: str) -> bool:
+        return self.get(lemma) is not None
+
+    def __getitem__(self, lemma: str) -> float:
+        frequency = self.get(lemma)
+        if frequency is None:
+            raise KeyError(lemma)
+        return frequency
+
+
+def load_lemma_frequencies(
+        freqs_file: Path) -> Union[Dict[str, float], LemmaFrequencies]:
+    """Open a lemma frequency file
+
+    SQLite files are queried on demand, JSON files of older versions are
+    loaded into memory completely.
+    """
+    if Path(freqs_file).suffix == '.sqlite':
+        return LemmaFrequencies(freqs_file)
+
+    with open(freqs_file) as f:
+        return json.load(f)
+
+
+def lemma_frequencies(
+        freqs: Union[Dict[str, float], LemmaFrequencies],
+        lemmas: Iterable[str]) -> Dict[str, float]:
+    """Frequencies of the given lemmas which are in `freqs`"""
+    if isinstance(freqs, LemmaFrequencies):
+        return freqs.get_many(lemmas)
+
+    return {lemma: freqs[lemma] for lemma in lemmas if lemma in freqs}
 
 
 class NoopExtractor():
+    # does not extract anything itself, so it relies on cached learnables
+    # from any other extractor
+    extractor_id = None
+
     def extract_learnables(self, text: str) -> List[str]:
         return []
 
 
 class CroatianLemmatizer():
+    # identifies cached results, increase the version whenever the
+    # extraction logic changes
+    extractor_id = f'hr-classla-{_package_version("classla")}-v1'
+
     def __init__(self, word_freqs_file: Path):
-        self.freqs = self._load_lemma_frequencies(word_freqs_file)
+        self.word_freqs_file = word_freqs_file
+
+        # frequencies and pipeline are only loaded on the first cache miss,
+        # if all texts are cached we never need them
+        self._freqs = None
+        self._nlp = None
+
+    @property
+    def freqs(self) -> Union[Dict[str, float], LemmaFrequencies]:
+        if self._freqs is None:
+            self._freqs = load_lemma_frequencies(self.word_freqs_file)
+        return self._freqs
 
-        # restricting the processors to only "lemma" impairs prediction quality,
-        # thus we just load all default processors
-        self.nlp = classla.Pipeline('hr', type='nonstandard')
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            # importing classla takes several seconds
+            import classla
+
+            # restricting the processors to only "lemma" impairs prediction
+            # quality, thus we just load all default processors
+            self._nlp = classla.Pipeline('hr', type='nonstandard')
+        return self._nlp
 
     def extract_learnables(self, text: str) -> List[str]:
         lemmas = self._text_lemmas(text)
+        return self._relevant_lemmas(lemmas)
+
+    def extract_learnables_batch(self, texts: List[str]) -> List[List[str]]:
+        """Extract the learnables of several texts in one pipeline call"""
+        # older classla versions cannot process several documents at once
+        if not hasattr(self.nlp, 'bulk_process'):
+            return [self.extract_learnables(text) for text in texts]
 
-        relevant_lemmas = [
+        import classla
+
+        docs = [classla.Document([], text=self._normalize(text))
+                for text in texts]
+        docs = self.nlp.bulk_process(docs)
+
+        return [self._relevant_lemmas(self._doc_lemmas(doc)) for doc in docs]
+
+    @staticmethod
+    def _relevant_lemmas(lemmas: Dict[str, Optional[float]]) -> List[str]:
+        return [
             lemma for lemma, count in lemmas.items()
             # ignore special characters like dot or comma
             if count and not re.match('^[^a-z]+$', lemma)
         ]
 
-        return relevant_lemmas
-
     def _text_lemmas(self, text: str) -> Dict[str, Optional[float]]:
+        doc = self.nlp(self._normalize(text))
+        return self._doc_lemmas(doc)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
         text = text.replace('\r\n', '\n')
         text = re.sub(r'\n\s*\n+', '\n', text)
-        text = text.strip('\n')
+        return text.strip('\n')
 
-        doc = self.nlp(text)
-        lemmas = {}
-        for word in doc.iter_words():
-            if word.lemma in self.freqs:
-                lemmas[word.lemma] = self.freqs[word.lemma]
-            else:
-                lemmas[word.lemma] = None
+    def _doc_lemmas(self, doc) -> Dict[str, Optional[float]]:
+        lemmas = dict.fromkeys(word.lemma for word in doc.iter_words())
+        # one query per document instead of one per lemma
+        lemmas.update(lemma_frequencies(self.freqs, lemmas))
 
         return lemmas
 
-    @staticmethod
-    def _load_lemma_frequencies(freqs_file: Path):
-        with open(freqs_file) as f:
-            return json.load(f)
+
+KANJI_REGEX = re.compile(u'[\u4e00-\u9faf\u3400-\u4dbf]', re.U)
 
 
 class JapaneseKanjiExtractor:
+    extractor_id = 'jp-kanji-v1'
+
     def extract_learnables(self, text: str) -> List[str]:
-        regex = u'[\u4e00-\u9faf\u3400-\u4dbf]'
-        p = re.compile(regex, re.U)
-        # remove duplicates
-        return list(set(p.findall(text)))
+        # remove duplicates without a list of all occurrences
+        return list({match.group() for match in KANJI_REGEX.finditer(text)})
+
+    def extract_learnables_batch(self, texts: List[str]) -> List[List[str]]:
+        return [self.extract_learnables(text) for text in texts]
+
+
+def extractor_class(language: str):
+    if language == 'hr':
+        return CroatianLemmatizer
+    elif language == 'jp':
+        return JapaneseKanjiExtractor
+    else:
+        raise NotImplementedError(
+            f'Extractor for language "{language}" does not exist')
@@ -0,0 +1,60 @@
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Set
+
+from givematerial.corpus import CorpusIndex
+from givematerial.db.sqlite import connect, create_tables
+from givematerial.web import extraction
+
+
+class TextIngestor:
+    """Adds scraped texts to the corpus as soon as they are retrieved
+
+    New texts are written to the texts folder and added to the corpus index
+    right away, texts with a URL or content that is already in the corpus
+    are skipped. For languages the web app cannot extract itself, extraction
+    of their learnables is requested from the extraction worker, so that
+    they can be recommended without rebuilding the whole corpus. Can be used
+    by several threads at the same time.
+    """
+    def __init__(
+            self, texts_folder: Path = Path('data') / 'texts',
+            conn: Optional[sqlite3.Connection] = None):
+        self.texts_folder = texts_folder
+        self.corpus = CorpusIndex(texts_folder)
+        self.corpus.refresh()
+
+        if conn is None:
+            conn = connect()
+            create_tables(conn)
+        self.conn = conn
+
+        self.lock = threading.Lock()
+
+    def urls(self) -> Set[str]:
+        with self.lock:
+            return self.corpus.urls()
+
+    def add(self, text_file: Path, text: Dict[str, Any]) -> bool:
+        """Store a text in `text_file` inside the texts folder
+
+        `text` has the keys of the text JSON files. Returns False if the
+        text was already in the corpus.
+        """
+        with self.lock:
+            indexed = self.corpus.add_text(text_file, text)
+            if indexed is None:
+                logging.info(f'Skipping known text {text["title"]}')
+                return False
+
+            self.corpus.commit()
+            if indexed.language in extraction.WORKER_LANGUAGES:
+                extraction.add_extraction_requests(
+                    [indexed.content_hash], indexed.language, self.conn)
+
+        return True
+
+    def close(self):
+        self.corpus.close()
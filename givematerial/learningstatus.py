@@ -1,12 +1,18 @@
 import abc
+import hashlib
 import json
 import logging
+import os
 from pathlib import Path
+import random
 import requests
 import sqlite3
 import tempfile
+import threading
 import time
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import givematerial.db.sqlite
 
 
 class LearnableStatus(abc.ABC):
@@ -50,17 +56,19 @@ class SqliteBasedStatus(LearnableStatus):
         self.user_identifier = user_identifier
 
     def get_known_learnables(self) -> List[str]:
-        return self._get_by_status('known')
+        return self._get_by_status(givematerial.db.sqlite.STATUS_KNOWN)
 
     def get_learning_learnables(self) -> List[str]:
-        return self._get_by_status('learning')
+        return self._get_by_status(givematerial.db.sqlite.STATUS_LEARNING)
 
-    def _get_by_status(self, status: str) -> List[str]:
+    def _get_by_status(self, status: int) -> List[str]:
         cur = self.conn.cursor()
 
         cur.execute(
-            'SELECT learnable FROM user_status WHERE user_id = ? '
-            'AND status = ?',
+            'SELECT l.learnable FROM user_status s '
+            'JOIN user u ON u.id = s.user_id '
+            'JOIN learnable l ON l.id = s.learnable_id '
+            'WHERE u.token = ? AND s.status = ?',
             (self.user_identifier, status))
 
         return [row[0] for row in cur.fetchall()]
@@ -74,71 +82,199 @@ class SqliteBasedStatus(LearnableStatus):
             return []
 
 
+class WanikaniRateLimiter:
+    """Rate limit of a single Wanikani token
+
+    Follows the rate limit headers sent by Wanikani: once no requests are
+    remaining, all requests with the token wait until the limit resets.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # wall-clock time, since Wanikani sends the reset as epoch seconds
+        self.blocked_until = 0.0
+
+    def wait(self):
+        with self.lock:
+            delay = self.blocked_until - time.time()
+
+        if delay > 0:
+            logging.debug(f'Wanikani rate limit reached, wait {delay:.1f}s')
+            time.sleep(delay)
+
+    def update(self, headers: Dict[str, str]):
+        remaining = headers.get('RateLimit-Remaining')
+        reset = headers.get('RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+
+        if int(remaining) <= 0:
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, float(reset))
+
+
+_rate_limiters: Dict[str, WanikaniRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def wanikani_rate_limiter(token: str) -> WanikaniRateLimiter:
+    """Rate limiter of a token, shared by all threads of the process"""
+    with _rate_limiters_lock:
+        if token not in _rate_limiters:
+            _rate_limiters[token] = WanikaniRateLimiter()
+        return _rate_limiters[token]
+
+
 class WanikaniStatus(LearnableStatus):
-    """Reads kanji learning status from Wanikani"""
-    def __init__(self, token: str):
+    """Reads kanji learning status from Wanikani
+
+    If `updated_after` is given, only assignments changed since then are
+    fetched. Known and learning kanji are then only the changed ones, kanji
+    that are no longer in any of these stages are returned by
+    `get_removed_learnables`.
+    """
+    # SRS stages of kanji the user is still learning, higher stages are known
+    LEARNING_STAGES = [1, 2, 3, 4]
+    KNOWN_STAGES = [5, 6, 7, 8, 9]
+
+    API_URL = 'https://api.wanikani.com/v2'
+    MAX_RETRIES = 5
+    # check for changed subjects at most this often
+    SUBJECTS_MAX_AGE = 24 * 60 * 60
+
+    # the subjects cache is shared by all threads
+    _subjects_lock = threading.Lock()
+
+    def __init__(self, token: str, updated_after: Optional[str] = None):
         self.cache_file = \
             Path(tempfile.gettempdir()) / 'givematerial_wanikani.json'
 
         self.token = token
+        self.updated_after = updated_after
         self.headers = {
             'Wanikani-Revision': '20170710',
             'Authorization': f'Bearer {token}',
         }
+        self.session = requests.Session()
+        self.rate_limiter = wanikani_rate_limiter(token)
+
+        self._subjects = None
+
+        self.known_learnables = None
+        self.learning_learnables = None
+        self.removed_learnables = None
+        # time of the newest fetched change, use as `updated_after` for the
+        # next sync
+        self.data_updated_at = updated_after
 
-        self.subjects = self._fetch_subjects()
+    @property
+    def is_incremental(self) -> bool:
+        return self.updated_after is not None
 
-        self.known_learnables = []
-        self.learning_learnables = []
+    @property
+    def subjects(self) -> Dict[int, str]:
+        if self._subjects is None:
+            with self._subjects_lock:
+                self._subjects = self._fetch_subjects()
+
+        return self._subjects
 
     def get_known_learnables(self) -> List[str]:
-        if not self.known_learnables:
-            self.known_learnables = self._fetch_known_kanji()
+        if self.known_learnables is None:
+            self._fetch_status()
 
         return self.known_learnables
 
     def get_learning_learnables(self) -> List[str]:
-        if not self.learning_learnables:
-            self.learning_learnables = self._fetch_learning_kanji()
+        if self.learning_learnables is None:
+            self._fetch_status()
 
         return self.learning_learnables
 
-    def _fetch_subjects(self) -> Dict[int, str]:
-        subjects = self._load_local()
-        if subjects:
+    def get_removed_learnables(self) -> List[str]:
+        if self.removed_learnables is None:
+            self._fetch_status()
+
+        return self.removed_learnables
+
+    def _fetch_subjects(self, force_update: bool = False) -> Dict[int, str]:
+        subjects, updated_after, fetched = self._load_local()
+        if subjects and not force_update \
+                and time.time() - fetched < self.SUBJECTS_MAX_AGE:
             return subjects
 
-        start_url = 'https://api.wanikani.com/v2/subjects'
-        for data in self._iterate_wanikani(start_url):
-            for subject in data:
+        start_url = f'{self.API_URL}/subjects?types=kanji'
+        if subjects and updated_after:
+            start_url += f'&updated_after={updated_after}'
+        else:
+            subjects = {}
+
+        for page in self._iterate_wanikani(start_url):
+            updated_after = page.get('data_updated_at') or updated_after
+            for subject in page['data']:
                 if subject['object'] == 'kanji':
                     subject_id = subject['id']
                     kanji = subject['data']['characters']
 
                     subjects[subject_id] = kanji
 
-        self._store_local(subjects)
+        self._store_local(subjects, updated_after)
         return subjects
 
-    def _fetch_learning_kanji(self):
-        return self._fetch_kanji(levels=[1, 2, 3, 4])
-
-    def _fetch_known_kanji(self):
-        return self._fetch_kanji(levels=[5, 6, 7, 8, 9])
-
-    def _fetch_kanji(self, levels: List[int]):
-        levels_list = ','.join(map(str, levels))
-
-        kanji = []
-        start_url = \
-            f'https://api.wanikani.com/v2/assignments?srs_stages={levels_list}'
-        for data in self._iterate_wanikani(start_url):
-            for assignment in data:
-                if assignment['data']['subject_type'] == 'kanji':
-                    subject_id = assignment['data']['subject_id']
-                    kanji.append(self.subjects[subject_id])
-
-        return kanji
+    def _fetch_status(self):
+        """Fetch known and learning kanji with one pass over assignments"""
+        if self.is_incremental:
+            # changed assignments of all stages, so that we notice kanji
+            # that were reset
+            start_url = (
+                f'{self.API_URL}/assignments'
+                f'?subject_types=kanji&updated_after={self.updated_after}')
+        else:
+            stages = ','.join(
+                map(str, self.LEARNING_STAGES + self.KNOWN_STAGES))
+            start_url = (
+                f'{self.API_URL}/assignments'
+                f'?subject_types=kanji&srs_stages={stages}')
+
+        known = []
+        learning = []
+        removed = []
+        for page in self._iterate_wanikani(start_url):
+            self.data_updated_at = \
+                page.get('data_updated_at') or self.data_updated_at
+
+            for assignment in page['data']:
+                if assignment['data']['subject_type'] != 'kanji':
+                    continue
+
+                kanji = self._subject(assignment['data']['subject_id'])
+                if kanji is None:
+                    continue
+
+                stage = assignment['data']['srs_stage']
+                if assignment['data'].get('hidden'):
+                    removed.append(kanji)
+                elif stage in self.KNOWN_STAGES:
+                    known.append(kanji)
+                elif stage in self.LEARNING_STAGES:
+                    learning.append(kanji)
+                else:
+                    removed.append(kanji)
+
+        self.known_learnables = known
+        self.learning_learnables = learning
+        self.removed_learnables = removed
+
+    def _subject(self, subject_id: int) -> Optional[str]:
+        if subject_id not in self.subjects:
+            # the subject was probably added after our last update
+            with self._subjects_lock:
+                self._subjects = self._fetch_subjects(force_update=True)
+
+        if subject_id not in self.subjects:
+            logging.warning(f'Unknown Wanikani subject {subject_id}')
+            return None
+
+        return self.subjects[subject_id]
 
     def _iterate_wanikani(self, start_url: str) -> Iterable[Any]:
         next_url = start_url
@@ -146,45 +282,119 @@ class WanikaniStatus(LearnableStatus):
         while next_url:
             logging.debug(f'Fetching Wanikani URL {next_url}')
 
-            response = requests.get(next_url, headers=self.headers)
-            data = response.json()
-            yield data['data']
+            page = self._request(next_url)
+            yield page
+
+            next_url = page['pages']['next_url']
+
+    def _request(self, url: str) -> Any:
+        """GET request with retries on rate limits and server errors"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            last_attempt = attempt == self.MAX_RETRIES
+            self.rate_limiter.wait()
+
+            try:
+                response = self.session.get(
+                    url, headers=self.headers, timeout=30)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                logging.warning('Could not connect to Wanikani, retry')
+                self._backoff(attempt)
+                continue
+
+            self.rate_limiter.update(response.headers)
+
+            if response.status_code == 429 and not last_attempt:
+                # the rate limiter waits until the limit is reset
+                logging.warning('Wanikani rate limit exceeded, retry')
+                if 'RateLimit-Reset' not in response.headers:
+                    self._backoff(attempt)
+                continue
+            elif response.status_code >= 500 and not last_attempt:
+                logging.warning(
+                    f'Wanikani returned {response.status_code}, retry')
+                self._backoff(attempt)
+                continue
+
+            response.raise_for_status()
+            return response.json()
 
-            time.sleep(1)
-            next_url = data['pages']['next_url']
+    @staticmethod
+    def _backoff(attempt: int):
+        time.sleep(min(2 ** attempt, 60) + random.uniform(0, 1))
+
+    def _store_local(
+            self, subjects: Dict[int, str], updated_after: Optional[str]):
+        data = {
+            'updated_after': updated_after,
+            'fetched': time.time(),
+            'subjects': subjects,
+        }
 
-    def _store_local(self, subjects: Dict[int, str]):
-        with open(self.cache_file, 'wt') as f:
-            json.dump(subjects, f)
+        # write to a temporary file first, other processes might read the
+        # cache at the same time
+        tmp_file = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'wt') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.cache_file)
 
-    def _load_local(self) -> Dict[int, str]:
+    def _load_local(self) -> Tuple[Dict[int, str], Optional[str], float]:
+        """Cached subjects, the time of the newest change and fetch time"""
         try:
             with open(self.cache_file, 'rt') as f:
                 data = json.load(f)
-                # for some reason integer keys are converted to JSON strings
-                # when I save the cache with json.dump
-                return dict([(int(key), value) for key, value in data.items()])
         except FileNotFoundError:
-            return {}
+            return {}, None, 0.0
+
+        # caches of older versions only contain the subjects
+        if 'subjects' not in data:
+            data = {
+                'updated_after': None,
+                'fetched': self.cache_file.stat().st_mtime,
+                'subjects': data,
+            }
+
+        # for some reason integer keys are converted to JSON strings
+        # when I save the cache with json.dump
+        subjects = dict([
+            (int(key), value) for key, value in data['subjects'].items()])
+        return subjects, data['updated_after'], data['fetched']
+
+
+class AnkiConnectError(Exception):
+    pass
 
 
 class AnkiStatus(LearnableStatus):
-    """Reads learning status from Anki"""
+    """Reads learning status from Anki
+
+    Card details are kept in a local snapshot, later runs only fetch the
+    cards that were modified since then.
+    """
+    # number of cards per cardsInfo request
+    CHUNK_SIZE = 1000
+
     def __init__(self, deck_name: str):
         self.server = 'http://localhost:8765'
         self.deck_name = deck_name
+        self.session = requests.Session()
 
-        self.card_intervals = []
+        deck_key = hashlib.sha256(deck_name.encode('utf-8')).hexdigest()[:16]
+        self.snapshot_file = \
+            Path(tempfile.gettempdir()) / f'givematerial_anki_{deck_key}.json'
+
+        self.card_intervals = None
 
     def get_known_learnables(self) -> List[str]:
-        if not self.card_intervals:
+        if self.card_intervals is None:
             self.card_intervals = self._get_intervals()
 
         return [word for (word, interval) in self.card_intervals.items()
                 if interval >= 7]
 
     def get_learning_learnables(self) -> List[str]:
-        if not self.card_intervals:
+        if self.card_intervals is None:
             self.card_intervals = self._get_intervals()
 
         return [word for (word, interval) in self.card_intervals.items()
@@ -193,22 +403,79 @@ class AnkiStatus(LearnableStatus):
     def _get_intervals(self) -> Dict[str, int]:
         cards = self._perform_request(
             'findCards', {'query': f'deck:{self.deck_name}'})
-        card_infos = self._perform_request('cardsInfo', {'cards': cards})
 
-        intervals = {}
-        for card in card_infos:
-            word = card['fields']['Front']['value']
-            interval = card['interval']
+        # card id -> [modification time, word, interval]
+        snapshot = self._load_snapshot()
+        changed = self._changed_cards(cards, snapshot)
+        logging.debug(f'Fetching {len(changed)} of {len(cards)} Anki cards')
+
+        for start in range(0, len(changed), self.CHUNK_SIZE):
+            card_infos = self._perform_request(
+                'cardsInfo', {'cards': changed[start:start + self.CHUNK_SIZE]})
+            for card in card_infos:
+                # cards deleted in the meantime are returned empty
+                if 'cardId' not in card:
+                    continue
+                snapshot[card['cardId']] = [
+                    card['mod'], card['fields']['Front']['value'],
+                    card['interval']]
+
+        # forget deleted cards
+        snapshot = {
+            card_id: snapshot[card_id] for card_id in cards
+            if card_id in snapshot}
+        self._store_snapshot(snapshot)
 
-            intervals[word] = interval
+        intervals = {}
+        for card_id in cards:
+            if card_id in snapshot:
+                _, word, interval = snapshot[card_id]
+                intervals[word] = interval
 
         return intervals
 
+    def _changed_cards(
+            self, cards: List[int], snapshot: Dict[int, list]) -> List[int]:
+        if not snapshot:
+            return cards
+
+        try:
+            mod_times = {}
+            for start in range(0, len(cards), self.CHUNK_SIZE):
+                for card in self._perform_request(
+                        'cardsModTime',
+                        {'cards': cards[start:start + self.CHUNK_SIZE]}):
+                    mod_times[card['cardId']] = card['mod']
+        except AnkiConnectError:
+            # older versions of AnkiConnect do not support cardsModTime
+            logging.warning('Cannot read modification times, fetch all cards')
+            return cards
+
+        return [
+            card_id for card_id in cards
+            if card_id not in snapshot
+            or snapshot[card_id][0] != mod_times.get(card_id)]
+
+    def _load_snapshot(self) -> Dict[int, list]:
+        try:
+            with open(self.snapshot_file, 'rt') as f:
+                # JSON keys are always strings
+                return {int(key): value for key, value in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _store_snapshot(self, snapshot: Dict[int, list]):
+        with open(self.snapshot_file, 'wt') as f:
+            json.dump(snapshot, f)
+
     def _perform_request(self, action: str, params: Dict[str, Any]) -> Any:
         data = {
             'action': action,
             'version': 6,
             'params': params,
         }
-        result = requests.post(self.server, json=data)
-        return result.json()['result']
+        result = self.session.post(self.server, json=data).json()
+        if result.get('error'):
+            raise AnkiConnectError(f'{action} failed: {result["error"]}')
+
+        return result['result']
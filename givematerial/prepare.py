@@ -0,0 +1,169 @@
+import concurrent.futures
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from givematerial.cache import LearnableCache
+from givematerial.corpus import CorpusIndex, IndexedText
+import givematerial.db.sqlite
+import givematerial.extractors
+from givematerial import recommendation
+from givematerial.web import extraction
+
+# each worker process loads its own model, classla needs more than a GB of
+# memory per process
+DEFAULT_WORKERS = 2
+
+# extractor of a worker process, loaded once when the worker starts
+_worker_extractor = None
+
+
+def _init_worker(language: str):
+    global _worker_extractor
+    _worker_extractor = recommendation.create_extractor(language)
+
+
+def _extract_batch(
+        batch: List[Tuple[str, str]]) -> List[Tuple[str, List[str]]]:
+    content_hashes = [content_hash for content_hash, _ in batch]
+    texts = [text for _, text in batch]
+
+    learnables = _worker_extractor.extract_learnables_batch(texts)
+    return list(zip(content_hashes, learnables))
+
+
+def _batches(
+        texts: Iterable[IndexedText],
+        batch_size: int) -> Iterable[List[Tuple[str, str]]]:
+    batch = []
+    for text in texts:
+        batch.append((text.content_hash, text.load_text()))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def missing_texts(
+        corpus: CorpusIndex, cache: LearnableCache, language: str,
+        extractor_id: str) -> Dict[str, List[IndexedText]]:
+    """Texts without cached learnables, grouped by their content hash"""
+    texts_by_hash: Dict[str, List[IndexedText]] = {}
+    for text in corpus.texts(language):
+        # legacy entries keyed by title are not from this extractor and
+        # titles are not unique, so such texts are extracted again
+        if cache.lookup(text.content_hash, extractor_id) is not None:
+            continue
+
+        # texts with the same content only have to be extracted once
+        texts_by_hash.setdefault(text.content_hash, []).append(text)
+
+    return texts_by_hash
+
+
+def prepare_cache(
+        language: str, texts_folder: Path, cache_folder: Path,
+        workers: Optional[int] = None, batch_size: int = 16,
+        progress: Optional[Callable[[int, int], None]] = None) -> int:
+    """Extract the learnables of all texts that are not yet in the cache
+
+    Texts are sent in batches to a pool of worker processes, each worker
+    loads its own extractor once. Results are written to the cache as soon
+    as a batch is finished, so an interrupted run can simply be restarted.
+
+    Returns the number of extracted texts.
+    """
+    workers = workers or DEFAULT_WORKERS
+
+    corpus = CorpusIndex(texts_folder)
+    corpus.refresh()
+    cache = LearnableCache(cache_folder)
+    extractor_id = \
+        givematerial.extractors.extractor_class(language).extractor_id
+
+    texts_by_hash = missing_texts(corpus, cache, language, extractor_id)
+
+    total = len(texts_by_hash)
+    logging.info(f'{total} texts are missing in the cache')
+    if total == 0:
+        return 0
+
+    done = 0
+
+    def store(results: List[Tuple[str, List[str]]]):
+        nonlocal done
+
+        cache.write_entries(extractor_id, results)
+        for content_hash, learnables in results:
+            for text in texts_by_hash[content_hash]:
+                corpus.set_learnables(text.id, learnables, extractor_id)
+        corpus.commit()
+
+        done += len(results)
+        if progress:
+            progress(done, total)
+
+    first_texts = (texts[0] for texts in texts_by_hash.values())
+    batches = _batches(first_texts, batch_size)
+
+    if workers == 1:
+        _init_worker(language)
+        for batch in batches:
+            store(_extract_batch(batch))
+        return done
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker,
+            initargs=(language,)) as executor:
+        # limit the number of batches in flight, so that not all texts are
+        # loaded into memory at once
+        pending = set()
+        for batch in batches:
+            if len(pending) >= 2 * workers:
+                finished, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    store(future.result())
+
+            pending.add(executor.submit(_extract_batch, batch))
+
+        for future in concurrent.futures.as_completed(pending):
+            store(future.result())
+
+    return done
+
+
+def submit_missing(
+        language: str, texts_folder: Path, cache_folder: Path,
+        conn: sqlite3.Connection) -> int:
+    """Submit all texts missing in the cache to the extraction worker
+
+    Returns the number of submitted texts.
+    """
+    corpus = CorpusIndex(texts_folder)
+    corpus.refresh()
+    cache = LearnableCache(cache_folder)
+    extractor_id = \
+        givematerial.extractors.extractor_class(language).extractor_id
+
+    texts_by_hash = missing_texts(corpus, cache, language, extractor_id)
+    givematerial.db.sqlite.create_tables(conn)
+    extraction.add_extraction_requests(texts_by_hash.keys(), language, conn)
+
+    return len(texts_by_hash)
+
+
+class ProgressPrinter:
+    """Prints the progress and the throughput of a cache preparation"""
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def __call__(self, done: int, total: int):
+        elapsed = time.monotonic() - self.start
+        rate = done / elapsed if elapsed > 0 else 0
+        print(f'{done}/{total} texts extracted ({rate:.1f} texts/s)',
+              flush=True)
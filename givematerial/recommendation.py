@@ -1,18 +1,31 @@
+import abc
 import collections
-import hashlib
+import contextlib
 import json
+import logging
 import os
 from pathlib import Path
 import heapq
 import dataclasses
-import sqlite3
-import uuid
-from typing import List, Iterable, Optional, Tuple
+import math
+from typing import AbstractSet, Counter, Dict, List, Iterable, Mapping, \
+    Optional, Set, Tuple
 
+from givematerial.cache import LEGACY_EXTRACTOR_ID, LearnableCache
+from givematerial.corpus import CorpusIndex, IndexedText
+import givematerial.db.sqlite
 import givematerial.extractors
 import givematerial.learningstatus
 
 
+try:
+    popcount = int.bit_count
+except AttributeError:
+    # Python < 3.10
+    def popcount(value: int) -> int:
+        return bin(value).count('1')
+
+
 @dataclasses.dataclass
 class Text:
     collection: str
@@ -34,6 +47,12 @@ class TextStats:
     url: Optional[str]
 
 
+@dataclasses.dataclass
+class Recommendations:
+    texts: List[TextStats]
+    most_common_words: List[Tuple[str, int]]
+
+
 def iterate_texts(folder: Path, language: str) -> Iterable[Text]:
     for text_file in folder.rglob('*.json'):
         with open(text_file) as f:
@@ -50,37 +69,249 @@ def iterate_texts(folder: Path, language: str) -> Iterable[Text]:
             url=text['url'] if 'url' in text else None)
 
 
-class LearnableCache:
-    def __init__(self, cache_folder: Path):
-        self.cache_folder = cache_folder
+def text_learnables(
+        text: IndexedText, corpus: CorpusIndex, cache: LearnableCache,
+        learnable_extractor) -> List[str]:
+    """Get the learnables of an indexed text, extracting them if necessary
+
+    Extractors without an `extractor_id` cannot extract learnables on their
+    own, for them any cached result is used.
+    """
+    extractor_id = learnable_extractor.extractor_id
+    if text.learnables is not None \
+            and (extractor_id is None or text.extractor == extractor_id):
+        return text.learnables
+
+    entry = cache.lookup(text.content_hash, extractor_id)
+    if entry is None and extractor_id is None:
+        # entries from an older version of the cache are keyed by title,
+        # they are only good enough if we cannot extract ourselves
+        relevant_lemmas = cache.adopt_title_entry(
+            text.content_hash, text.title)
+        if relevant_lemmas is None:
+            # cannot extract learnables for this text right now, retry later
+            return []
+
+        entry = (LEGACY_EXTRACTOR_ID, relevant_lemmas)
+    elif entry is None:
+        relevant_lemmas = learnable_extractor.extract_learnables(
+            text.load_text())
+        cache.write_cache(text.content_hash, extractor_id, relevant_lemmas)
+        entry = (extractor_id, relevant_lemmas)
+
+    used_extractor, relevant_lemmas = entry
+    corpus.set_learnables(text.id, relevant_lemmas, used_extractor)
+    text.learnables = relevant_lemmas
+    text.extractor = used_extractor
+
+    return relevant_lemmas
+
+
+def classify_learnables(
+        learnables: Iterable[str], known_words: AbstractSet[str],
+        learning_words: AbstractSet[str]) \
+        -> Tuple[List[str], List[str], List[str]]:
+    """Split learnables into known, learning and unknown learnables
+
+    The status arguments should be sets, membership tests on lists are
+    linear in the size of the vocabulary.
+    """
+    known = []
+    learning = []
+    unknown = []
+    for learnable in learnables:
+        is_known = learnable in known_words
+        is_learning = learnable in learning_words
+
+        if is_known:
+            known.append(learnable)
+        if is_learning:
+            learning.append(learnable)
+        if not is_known and not is_learning:
+            unknown.append(learnable)
+
+    return known, learning, unknown
+
+
+def text_order(
+        unknown_count: int, learning_count: int,
+        text: IndexedText) -> Tuple[int, ...]:
+    """Sort key for recommendations, smaller is better"""
+    # the text id makes the order unique and deterministic
+    return (
+        abs(unknown_count - 5), -learning_count, -len(text.learnables),
+        text.id)
+
+
+class TextRanking(abc.ABC):
+    """Orders the texts of a recommendation, smaller orders are better
+
+    Orders must be unique tuples of numbers, see `TopN`.
+    """
+    # whether `order` needs the weight of the unknown learnables of a text
+    uses_weights = False
+
+    @abc.abstractmethod
+    def order(
+            self, text: IndexedText, unknown_count: int, learning_count: int,
+            unknown_weight: float) -> Tuple:
+        pass
+
+    def group(self, unknown_count: int, learning_count: int) -> int:
+        """First element of `order`, scores group their texts by it"""
+        return abs(unknown_count - 5)
+
+
+class CountRanking(TextRanking):
+    """Prefers texts with about five unknown and many learning learnables"""
+    def order(
+            self, text: IndexedText, unknown_count: int, learning_count: int,
+            unknown_weight: float) -> Tuple:
+        return text_order(unknown_count, learning_count, text)
+
+
+class FrequencyRanking(TextRanking):
+    """Like `CountRanking`, but prefers frequent unknown learnables
+
+    Of texts with the same distance to five unknown learnables, the ones
+    whose unknown learnables are the most frequent are recommended first,
+    they are the most useful to learn next.
+    """
+    uses_weights = True
+
+    def order(
+            self, text: IndexedText, unknown_count: int, learning_count: int,
+            unknown_weight: float) -> Tuple:
+        # rounding hides the error of incrementally updated weights
+        return (
+            abs(unknown_count - 5), -round(unknown_weight, 6),
+            -learning_count, -len(text.learnables), text.id)
+
+
+RANKINGS = {
+    'count': CountRanking,
+    'frequency': FrequencyRanking,
+}
+
+
+def create_ranking(name: str) -> TextRanking:
+    if name not in RANKINGS:
+        raise NotImplementedError(f'Unknown text ranking "{name}"')
+
+    return RANKINGS[name]()
+
+
+def text_stats(
+        text: IndexedText, known_words: AbstractSet[str],
+        learning_words: AbstractSet[str]) -> TextStats:
+    """Build the full statistics for a text, including the text itself"""
+    known, learning, unknown = classify_learnables(
+        text.learnables, known_words, learning_words)
+
+    return TextStats(
+        title=text.title,
+        text=text.load_text(),
+        collection=text.collection,
+        known=known,
+        unknown=unknown,
+        learning=learning,
+        total=len(text.learnables),
+        url=text.url)
+
+
+def load_text_stats(
+        texts: List[IndexedText], known_words: AbstractSet[str],
+        learning_words: AbstractSet[str],
+        skipped: Set[int]) -> Optional[List[TextStats]]:
+    """Build the statistics of the selected texts
+
+    Text files can be deleted before the next corpus refresh notices it.
+    Their ids are added to `skipped` and None is returned, the texts have to
+    be selected again without them.
+    """
+    stats = []
+    for text in texts:
+        try:
+            stats.append(text_stats(text, known_words, learning_words))
+        except FileNotFoundError:
+            logging.warning(f'Text file {text.path} does not exist anymore')
+            skipped.add(text.id)
+
+    if len(stats) < len(texts):
+        return None
+
+    return stats
+
 
-    def check_cache(self, title: str) -> List[str]:
-        cache_file = self._cache_file(title)
+class TopN:
+    """Streaming selection of the `count` items with the smallest order
+
+    Only the best `count` candidates are kept in memory. Orders must be
+    unique tuples of numbers so that items themselves are never compared.
+    """
+    def __init__(self, count: int):
+        self.count = count
+        # heapq is a min heap, with negated orders the worst candidate is
+        # always at the top and can be replaced cheaply
+        self._heap = []
 
-        if cache_file.is_file():
-            with open(cache_file, 'rt') as f:
-                return json.load(f)
+    def push(self, order: Tuple[int, ...], item):
+        if self.count <= 0:
+            return
+
+        entry = (tuple(-value for value in order), item)
+        if len(self._heap) < self.count:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def worst(self) -> Optional[Tuple[int, ...]]:
+        """Order an item needs to be selected, None while not yet full"""
+        if self.count <= 0 or len(self._heap) < self.count:
+            return None
+        return tuple(-value for value in self._heap[0][0])
+
+    def items(self) -> List:
+        """Selected items, best first"""
+        return [item for _, item in sorted(self._heap, reverse=True)]
+
+
+def frequencies_file(language: str) -> Path:
+    freqs_file = Path('data') / language / 'word_frequencies.sqlite'
+    if not freqs_file.is_file():
+        freqs_file = freqs_file.with_suffix('.json')
+    return freqs_file
 
-        return []
 
-    def write_cache(self, title: str, lemmas: List[str]):
-        cache_file = self._cache_file(title)
+def load_frequencies(language: str) -> Optional[Mapping[str, float]]:
+    """Frequencies of the learnables of a language, if there are any"""
+    freqs_file = frequencies_file(language)
+    if not freqs_file.is_file():
+        return None
+
+    return givematerial.extractors.load_lemma_frequencies(freqs_file)
 
-        with open(cache_file, 'wt') as f:
-            json.dump(lemmas, f)
 
-    def _cache_file(self, title: str) -> Path:
-        filename = str(hashlib.sha256(title.encode('utf-8')).hexdigest())
-        return self.cache_folder / f'{filename}.json'
+def create_extractor(language: str):
+    if language == 'hr':
+        return givematerial.extractors.CroatianLemmatizer(
+            frequencies_file(language))
+    elif language == 'jp':
+        return givematerial.extractors.JapaneseKanjiExtractor()
+    else:
+        raise NotImplementedError(
+            f'Extractor for language "{language}" does not exist')
 
 
 def calc_recommendations(language) -> List[TextStats]:
-    freqs_file = Path('data') / language / 'word_frequencies.json'
     texts_folder = Path('data') / 'texts'
     known_words_file = Path('data') / language / 'known'
     learning_words_file = Path('data') / language / 'learning'
     cache_folder = Path('data') / language / 'cache'
 
+    corpus = CorpusIndex(texts_folder)
+    corpus.refresh()
+
     learnable_provider = os.getenv('LEARNABLE_PROVIDER', 'files')
 
     known_learning_status = givematerial.learningstatus.FileBasedStatus(
@@ -100,7 +331,7 @@ def calc_recommendations(language) -> List[TextStats]:
             wanikani_token)
 
     elif learnable_provider == 'sqlite':
-        sqlite_conn = sqlite3.connect('givematerial.sqlite')
+        sqlite_conn = givematerial.db.sqlite.connect()
         user_identifier = os.getenv('USER_IDENTIFIER', 'local')
 
         learning_status = givematerial.learningstatus.SqliteBasedStatus(
@@ -110,89 +341,604 @@ def calc_recommendations(language) -> List[TextStats]:
         raise NotImplementedError(
             f'Unknown learnable provider "{learnable_provider}"')
 
-    if language == 'hr':
-        learnable_extractor = givematerial.extractors.CroatianLemmatizer(
-            freqs_file)
-    elif language == 'jp':
-        learnable_extractor = givematerial.extractors.JapaneseKanjiExtractor()
-    else:
-        raise NotImplementedError(
-            f'Extractor for language "{language}" does not exist')
+    learnable_extractor = create_extractor(language)
 
     known_words = learning_status.get_known_learnables() \
         + known_learning_status.get_known_learnables()
     learning_words = learning_status.get_learning_learnables()
 
     return get_recommendations(
-        known_words, learning_words, cache_folder, texts_folder, language,
+        known_words, learning_words, cache_folder, corpus, language,
         learnable_extractor)
 
 
 # TODO: Cleanup this function, far too many arguments
-def get_recommendations(
-        known_words: List[str], learning_words: List[str], cache_folder: Path,
-        texts_folder: Path, language: str,
-        learnable_extractor, count: int = 5) -> List[TextStats]:
-    recommendations = []
-
-    cache = LearnableCache(cache_folder)
-
-    for text in iterate_texts(texts_folder, language):
-        relevant_lemmas = cache.check_cache(text.title)
-        if len(relevant_lemmas) == 0:
-            relevant_lemmas = learnable_extractor.extract_learnables(text.text)
-            cache.write_cache(text.title, relevant_lemmas)
-
-        known_from_text = \
-            [lemma for lemma in relevant_lemmas if lemma in known_words]
-        learning_from_text = \
-            [lemma for lemma in relevant_lemmas if lemma in learning_words]
-        unknown_from_text = [
-            lemma for lemma in relevant_lemmas
-            if lemma not in known_words and lemma not in learning_words
-        ]
-
-        # add a uuid so that heapq never tries to compare TextStats to TextStats
-        order = (abs(len(unknown_from_text) - 5), -len(learning_from_text), -len(relevant_lemmas), uuid.uuid4())
-
-        # if we cannot extract data from a text, totally ignore it
-        if len(relevant_lemmas) == 0:
-            continue
+def recommend(
+        known_words: Iterable[str], learning_words: Iterable[str],
+        cache_folder: Path, corpus: CorpusIndex, language: str,
+        learnable_extractor, count: int = 5, common_words_count: int = 100,
+        exclude_urls: AbstractSet[str] = frozenset()) -> Recommendations:
+    """Calculate text recommendations and most common unknown words
+
+    Both results are computed in a single pass over the corpus. Texts with
+    an URL in `exclude_urls` (e.g. texts the user has already read) are
+    never recommended, but still count for the most common words.
+    """
+    known_words = frozenset(known_words)
+    learning_words = frozenset(learning_words)
+
+    # ids of texts whose file was deleted since the last corpus refresh
+    skipped = set()
+    texts = None
+    while texts is None:
+        best_texts = TopN(count)
+        counter = collections.Counter()
+
+        with contextlib.closing(LearnableCache(cache_folder)) as cache:
+            for text in corpus.texts(language):
+                relevant_lemmas = text_learnables(
+                    text, corpus, cache, learnable_extractor)
+
+                # if we cannot extract data from a text, totally ignore it
+                if len(relevant_lemmas) == 0:
+                    continue
+
+                unknown_from_text = [
+                    lemma for lemma in relevant_lemmas
+                    if lemma not in known_words
+                    and lemma not in learning_words
+                ]
+
+                if common_words_count:
+                    counter.update(set(unknown_from_text))
+
+                if text.id in skipped or (
+                        text.url is not None and text.url in exclude_urls):
+                    continue
+
+                learning_count = sum(
+                    1 for lemma in relevant_lemmas if lemma in learning_words)
+                best_texts.push(
+                    text_order(len(unknown_from_text), learning_count, text),
+                    text)
+
+        corpus.commit()
+
+        texts = load_text_stats(
+            best_texts.items(), known_words, learning_words, skipped)
+
+    return Recommendations(
+        texts=texts,
+        most_common_words=counter.most_common(common_words_count))
 
-        text_stats = TextStats(
-            title=text.title,
-            text=text.text,
-            collection=text.collection,
-            known=known_from_text,
-            unknown=unknown_from_text,
-            learning=learning_from_text,
-            total=len(relevant_lemmas),
-            url=text.url)
-        heapq.heappush(recommendations, (order, text_stats))
 
-    return [ts for _, ts in heapq.nsmallest(count, recommendations)]
+def get_recommendations(
+        known_words: Iterable[str], learning_words: Iterable[str],
+        cache_folder: Path, corpus: CorpusIndex, language: str,
+        learnable_extractor, count: int = 5) -> List[TextStats]:
+    return recommend(
+        known_words, learning_words, cache_folder, corpus, language,
+        learnable_extractor, count=count, common_words_count=0).texts
 
 
 def most_common_words(
-        known_words: List[str], learning_words: List[str], cache_folder: Path,
-        texts_folder: Path, language: str,
+        known_words: Iterable[str], learning_words: Iterable[str],
+        cache_folder: Path, corpus: CorpusIndex, language: str,
         learnable_extractor, count: int = 100) -> List[Tuple[str, int]]:
-    cache = LearnableCache(cache_folder)
-
-    counter = collections.Counter()
-
-    for text in iterate_texts(texts_folder, language):
-        relevant_lemmas = cache.check_cache(text.title)
-        if len(relevant_lemmas) == 0:
-            relevant_lemmas = learnable_extractor.extract_learnables(text.text)
-            cache.write_cache(text.title, relevant_lemmas)
-
-        not_unknown_words = known_words + learning_words
-        yet_unknown_words = set(relevant_lemmas).difference(not_unknown_words)
-
-        counter.update(yet_unknown_words)
+    return recommend(
+        known_words, learning_words, cache_folder, corpus, language,
+        learnable_extractor, count=0,
+        common_words_count=count).most_common_words
+
+
+class LearnableIndex:
+    """Inverted index from learnables to the texts of a language
+
+    The index is kept up to date with `refresh`, which only applies the
+    texts that changed in the corpus. Scores of users learn from `changes`
+    which texts they have to score again.
+    """
+    # number of refreshes after which scores of users are rebuilt instead
+    MAX_CHANGES = 100
+
+    def __init__(
+            self, texts: Iterable[IndexedText], version: int = 0,
+            frequencies: Optional[Mapping[str, float]] = None):
+        # the corpus version this index was built from
+        self.version = version
+        # frequencies of learnables, e.g. from hrLex, if not given the
+        # number of texts containing a learnable is used
+        self.frequencies = frequencies
+
+        self.texts = {}
+        # content hashes of texts for which no learnables could be extracted
+        # yet, e.g. because the extractor only reads from the cache
+        self.missing = set()
+        self.postings = collections.defaultdict(list)
+
+        self._by_text_count = None
+        self._bit_positions = None
+        self._text_bitsets = None
+        self._weights = None
+        self._text_weights = None
+
+        # (version, ids of changed texts) of each refresh, scores of an
+        # older version than `_changes_start` have to be rebuilt
+        self._changes: List[Tuple[int, Set[int]]] = []
+        self._changes_start = version
+
+        for text in texts:
+            self._add_text(text)
+
+    @property
+    def by_text_count(self) -> List[str]:
+        """Learnables sorted by the number of texts they occur in"""
+        if self._by_text_count is None:
+            self._by_text_count = sorted(
+                self.postings,
+                key=lambda learnable: -len(self.postings[learnable]))
+
+        return self._by_text_count
+
+    @property
+    def text_bitsets(self) -> Dict[int, int]:
+        """Bitset of the learnables of each text, created on first use"""
+        if self._text_bitsets is None:
+            self._bit_positions = {
+                learnable: position
+                for position, learnable in enumerate(self.by_text_count)}
+            self._text_bitsets = {
+                text_id: self.bitset(text.learnables)
+                for text_id, text in self.texts.items()}
+
+        return self._text_bitsets
+
+    def bitset(self, learnables: Iterable[str]) -> int:
+        """Bitset of learnables, learnables not in any text are ignored"""
+        if self._bit_positions is None:
+            self.text_bitsets
+
+        bits = 0
+        for learnable in learnables:
+            position = self._bit_positions.get(learnable)
+            if position is not None:
+                bits |= 1 << position
+
+        return bits
+
+    @property
+    def weights(self) -> Dict[str, float]:
+        """Weight of each learnable, created on first use
+
+        Frequencies are heavy-tailed, the logarithm keeps a few very common
+        learnables from dominating the weight of a text. Weights do not
+        change when texts are added later, so that the weights of unchanged
+        texts stay valid.
+        """
+        if self._weights is None:
+            self._weights = self._learnable_weights(self.postings)
+
+        return self._weights
+
+    @property
+    def text_weights(self) -> Dict[int, float]:
+        """Summed weight of the learnables of each text"""
+        if self._text_weights is None:
+            self._text_weights = {
+                text_id: self._text_weight(text)
+                for text_id, text in self.texts.items()}
+
+        return self._text_weights
+
+    def changes(self, since_version: int) -> Optional[Set[int]]:
+        """Ids of the texts changed after `since_version`
+
+        Returns None if the changes are not known anymore.
+        """
+        if since_version < self._changes_start:
+            return None
+
+        changed = set()
+        for version, text_ids in self._changes:
+            if version > since_version:
+                changed |= text_ids
+
+        return changed
+
+    def refresh(
+            self, corpus: CorpusIndex, language: str, cache_folder: Path,
+            learnable_extractor) -> Set[str]:
+        """Apply the texts that changed in the corpus since the last refresh
+
+        Returns the content hashes of changed texts without learnables.
+        """
+        version = corpus.version
+        changed, removed = corpus.changes(language, self.version)
+
+        missing = [text for text in changed if text.learnables is None]
+        if missing:
+            with contextlib.closing(LearnableCache(cache_folder)) as cache:
+                for text in missing:
+                    text_learnables(text, corpus, cache, learnable_extractor)
+        corpus.commit()
+
+        self.update(changed, removed, version)
+
+        return {text.content_hash for text in changed
+                if text.learnables is None}
+
+    def update(
+            self, changed: List[IndexedText], removed: Iterable[int],
+            version: int):
+        """Replace changed texts and drop removed texts"""
+        text_ids = {text.id for text in changed} | set(removed)
+        for text_id in text_ids:
+            self._remove_text(text_id)
+        for text in changed:
+            self._add_text(text)
+
+        self._by_text_count = None
+        if self._weights is not None:
+            new_learnables = {
+                learnable
+                for text in changed if text.learnables
+                for learnable in text.learnables
+                if learnable not in self._weights}
+            self._weights.update(self._learnable_weights(new_learnables))
+
+        for text in changed:
+            if text.id not in self.texts:
+                continue
+            if self._text_bitsets is not None:
+                # new learnables get the next free bits
+                for learnable in text.learnables:
+                    self._bit_positions.setdefault(
+                        learnable, len(self._bit_positions))
+                self._text_bitsets[text.id] = self.bitset(text.learnables)
+            if self._text_weights is not None:
+                self._text_weights[text.id] = self._text_weight(text)
+
+        self.version = version
+        self._changes.append((version, text_ids))
+        if len(self._changes) > self.MAX_CHANGES:
+            self._changes_start = self._changes.pop(0)[0]
+
+    def _add_text(self, text: IndexedText):
+        if text.learnables is None:
+            self.missing.add(text.content_hash)
+            return
+
+        self.missing.discard(text.content_hash)
+        if not text.learnables:
+            return
+
+        self.texts[text.id] = text
+        for learnable in set(text.learnables):
+            self.postings[learnable].append(text.id)
+
+    def _remove_text(self, text_id: int):
+        text = self.texts.pop(text_id, None)
+        if text is None:
+            return
+
+        for learnable in set(text.learnables):
+            text_ids = self.postings[learnable]
+            text_ids.remove(text_id)
+            if not text_ids:
+                del self.postings[learnable]
+
+        if self._text_bitsets is not None:
+            del self._text_bitsets[text_id]
+        if self._text_weights is not None:
+            del self._text_weights[text_id]
+
+    def _learnable_weights(
+            self, learnables: Iterable[str]) -> Dict[str, float]:
+        if self.frequencies is None:
+            frequencies = {
+                learnable: len(self.postings.get(learnable, []))
+                for learnable in learnables}
+        else:
+            frequencies = givematerial.extractors.lemma_frequencies(
+                self.frequencies, learnables)
+
+        return {
+            learnable: math.log1p(frequencies.get(learnable) or 0.0)
+            for learnable in learnables}
+
+    def _text_weight(self, text: IndexedText) -> float:
+        return sum(
+            self.weights[learnable] for learnable in set(text.learnables))
+
+    @classmethod
+    def build(
+            cls, corpus: CorpusIndex, language: str, cache_folder: Path,
+            learnable_extractor,
+            frequencies: Optional[Mapping[str, float]] = None) \
+            -> 'LearnableIndex':
+        # read the version first, texts committed in the meantime are then
+        # applied again by the next refresh instead of being missed
+        version = corpus.version
+        texts = corpus.texts(language)
+        with contextlib.closing(LearnableCache(cache_folder)) as cache:
+            for text in texts:
+                text_learnables(text, corpus, cache, learnable_extractor)
+        corpus.commit()
+
+        return cls(texts, version, frequencies)
+
+
+class TextScores(abc.ABC):
+    """Scores of all texts in an index for the status of a single user"""
+    def __init__(
+            self, index: LearnableIndex,
+            ranking: Optional[TextRanking] = None):
+        self.index = index
+        self.ranking = ranking if ranking is not None else CountRanking()
+
+        self.known = frozenset()
+        self.learning = frozenset()
+
+    @abc.abstractmethod
+    def update(
+            self, known_words: Iterable[str],
+            learning_words: Iterable[str]) -> int:
+        """Apply the current status of a user, returns number of changed words"""
+        pass
+
+    @abc.abstractmethod
+    def _text_counts(self, text: IndexedText) -> Tuple[int, int]:
+        """Number of unknown and learning learnables of a text"""
+        pass
+
+    def _unknown_weight(self, text: IndexedText) -> float:
+        """Summed weight of the unknown learnables of a text"""
+        status = self.known | self.learning
+        return sum(
+            self.index.weights[learnable]
+            for learnable in set(text.learnables) if learnable not in status)
+
+    def _candidates(self, best_texts: TopN) -> Iterable[IndexedText]:
+        """Texts to consider, may stop early depending on `best_texts`"""
+        return self.index.texts.values()
+
+    def recommend(
+            self, count: int = 5, common_words_count: int = 100,
+            exclude_urls: AbstractSet[str] = frozenset()) -> Recommendations:
+        # ids of texts whose file was deleted since the last corpus refresh
+        skipped = set()
+        texts = None
+        while texts is None:
+            best_texts = TopN(count)
+            for text in self._candidates(best_texts):
+                if text.id in skipped or (
+                        text.url is not None and text.url in exclude_urls):
+                    continue
+
+                unknown_count, learning_count = self._text_counts(text)
+                unknown_weight = self._unknown_weight(text) \
+                    if self.ranking.uses_weights else 0.0
+                best_texts.push(
+                    self.ranking.order(
+                        text, unknown_count, learning_count, unknown_weight),
+                    text)
+
+            texts = load_text_stats(
+                best_texts.items(), self.known, self.learning, skipped)
+
+        return Recommendations(
+            texts=texts,
+            most_common_words=self._most_common_words(common_words_count))
+
+    def _most_common_words(self, count: int) -> List[Tuple[str, int]]:
+        words = []
+        for learnable in self.index.by_text_count:
+            if len(words) >= count:
+                break
+
+            if learnable not in self.known and learnable not in self.learning:
+                words.append(
+                    (learnable, len(self.index.postings[learnable])))
+
+        return words
+
+
+class UserTextScores(TextScores):
+    """Per-user counters of known and learning learnables for each text
+
+    The counters are updated incrementally, if the status of a learnable
+    changes only the texts containing this learnable are re-scored, if the
+    index changes only the changed texts. Texts are grouped by the first
+    element of their order, so that recommendations only visit the groups
+    with the best texts.
+    """
+    def __init__(
+            self, index: LearnableIndex,
+            ranking: Optional[TextRanking] = None):
+        super().__init__(index, ranking)
+        self._reset()
+
+    def _reset(self):
+        self.known = frozenset()
+        self.learning = frozenset()
+
+        self.known_counts = collections.Counter()
+        self.learning_counts = collections.Counter()
+        # number of learnables per text that are either known or learning
+        self.status_counts = collections.Counter()
+        # their summed weights, only kept if the ranking needs them
+        self.status_weights = collections.Counter() \
+            if self.ranking.uses_weights else None
+
+        # text ids by the group of their order and the group of each text
+        self.groups: Dict[int, Set[int]] = collections.defaultdict(set)
+        self.text_groups: Dict[int, int] = {}
+        self.index_version = self.index.version
+        for text_id in self.index.texts:
+            self._group_text(text_id)
+
+    def update(
+            self, known_words: Iterable[str],
+            learning_words: Iterable[str]) -> int:
+        self._apply_index_changes()
+
+        known = frozenset(known_words)
+        learning = frozenset(learning_words)
+
+        touched = set()
+        changed = self._apply_diff(
+            self.known, known, self.known_counts, touched)
+        changed |= self._apply_diff(
+            self.learning, learning, self.learning_counts, touched)
+        self._apply_diff(
+            self.known | self.learning, known | learning, self.status_counts,
+            touched, self.status_weights)
+
+        self.known = known
+        self.learning = learning
+        for text_id in touched:
+            self._group_text(text_id)
+
+        return len(changed)
+
+    def _apply_index_changes(self):
+        if self.index_version == self.index.version:
+            return
+
+        text_ids = self.index.changes(self.index_version)
+        self.index_version = self.index.version
+        if text_ids is None:
+            # too many changes were missed, score all texts again
+            self._reset()
+            return
+
+        for text_id in text_ids:
+            self._score_text(text_id)
+
+    def _score_text(self, text_id: int):
+        for counts in (self.known_counts, self.learning_counts,
+                       self.status_counts, self.status_weights):
+            if counts is not None:
+                counts.pop(text_id, None)
+
+        text = self.index.texts.get(text_id)
+        if text is not None:
+            learnables = set(text.learnables)
+            status = learnables & (self.known | self.learning)
+            self.known_counts[text_id] = len(learnables & self.known)
+            self.learning_counts[text_id] = len(learnables & self.learning)
+            self.status_counts[text_id] = len(status)
+            if self.status_weights is not None:
+                self.status_weights[text_id] = sum(
+                    self.index.weights[learnable] for learnable in status)
+
+        self._group_text(text_id)
+
+    def _group_text(self, text_id: int):
+        old_group = self.text_groups.pop(text_id, None)
+        if old_group is not None:
+            self.groups[old_group].discard(text_id)
+            if not self.groups[old_group]:
+                del self.groups[old_group]
+
+        text = self.index.texts.get(text_id)
+        if text is not None:
+            group = self.ranking.group(*self._text_counts(text))
+            self.groups[group].add(text_id)
+            self.text_groups[text_id] = group
+
+    def _candidates(self, best_texts: TopN) -> Iterable[IndexedText]:
+        if best_texts.count <= 0:
+            return
+
+        for group in sorted(self.groups):
+            # orders start with the group, later groups cannot be better
+            worst = best_texts.worst()
+            if worst is not None and group > worst[0]:
+                break
+
+            for text_id in self.groups[group]:
+                yield self.index.texts[text_id]
+
+    def _apply_diff(
+            self, old: AbstractSet[str], new: AbstractSet[str],
+            counts: Counter, touched: Set[int],
+            weights: Optional[Counter] = None) -> AbstractSet[str]:
+        changed = old.symmetric_difference(new)
+
+        for learnable in changed:
+            delta = 1 if learnable in new else -1
+            if weights is not None:
+                weight = delta * self.index.weights.get(learnable, 0.0)
+
+            text_ids = self.index.postings.get(learnable, [])
+            touched.update(text_ids)
+            for text_id in text_ids:
+                counts[text_id] += delta
+                if weights is not None:
+                    weights[text_id] += weight
+
+        return changed
+
+    def _text_counts(self, text: IndexedText) -> Tuple[int, int]:
+        unknown_count = len(text.learnables) - self.status_counts[text.id]
+        return unknown_count, self.learning_counts[text.id]
+
+    def _unknown_weight(self, text: IndexedText) -> float:
+        return self.index.text_weights[text.id] \
+            - self.status_weights[text.id]
+
+
+class BitsetTextScores(TextScores):
+    """Scores texts with bitsets over the learnable vocabulary
+
+    Suited for languages with a small learnable vocabulary like kanji. Each
+    text is a bitset of the learnables it contains, so counting the unknown
+    and learning learnables of a text are two bitwise operations against the
+    status of the user, without any per-text state.
+    """
+    def __init__(
+            self, index: LearnableIndex,
+            ranking: Optional[TextRanking] = None):
+        super().__init__(index, ranking)
+
+        self.known_bits = 0
+        self.learning_bits = 0
+
+    def update(
+            self, known_words: Iterable[str],
+            learning_words: Iterable[str]) -> int:
+        known = frozenset(known_words)
+        learning = frozenset(learning_words)
+        changed = len(self.known.symmetric_difference(known)) \
+            + len(self.learning.symmetric_difference(learning))
+
+        self.known = known
+        self.learning = learning
+        self.known_bits = self.index.bitset(known)
+        self.learning_bits = self.index.bitset(learning)
+
+        return changed
+
+    def _text_counts(self, text: IndexedText) -> Tuple[int, int]:
+        text_bits = self.index.text_bitsets[text.id]
+        status_bits = self.known_bits | self.learning_bits
+
+        unknown_count = popcount(text_bits & ~status_bits)
+        learning_count = popcount(text_bits & self.learning_bits)
+        return unknown_count, learning_count
+
+
+def create_text_scores(
+        language: str, index: LearnableIndex,
+        ranking: Optional[TextRanking] = None) -> TextScores:
+    # kanji are a small vocabulary, so scoring with bitsets is cheap, but
+    # bitsets cannot keep the weights of unknown learnables up to date
+    if language == 'jp' and (ranking is None or not ranking.uses_weights):
+        return BitsetTextScores(index, ranking)
+    else:
+        return UserTextScores(index, ranking)
 
-    return counter.most_common(count)
 
 # Not used at the moment, will implement later
 #def calc_artist_summary():
@@ -0,0 +1,197 @@
+import concurrent.futures
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HostLimiter:
+    """Limits concurrent requests and request rate for a single host"""
+    def __init__(self, max_concurrent: int, delay: float):
+        self.semaphore = threading.Semaphore(max_concurrent)
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+
+        # requests to a host start at least `delay` seconds apart
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + self.delay
+
+        if start > now:
+            time.sleep(start - now)
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+class CrawlState:
+    """Persistent state of a crawl, so that interrupted runs can resume
+
+    Stores cache validators (ETag, Last-Modified) and extracted links of
+    fetched pages as well as the URLs that were processed successfully.
+    """
+    def __init__(self, state_file: Optional[Path]):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+
+        self.validators: Dict[str, Dict[str, str]] = {}
+        self.links: Dict[str, List[str]] = {}
+        self.done: Set[str] = set()
+
+        if state_file is not None and state_file.is_file():
+            with open(state_file) as f:
+                data = json.load(f)
+            self.validators = data.get('validators', {})
+            self.links = data.get('links', {})
+            self.done = set(data.get('done', []))
+
+    def save(self):
+        if self.state_file is None:
+            return
+
+        with self.lock:
+            data = {
+                'validators': self.validators,
+                'links': self.links,
+                'done': sorted(self.done),
+            }
+
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.state_file)
+
+
+class Retriever:
+    """Shared HTTP client for the retrieval scripts
+
+    All requests go through one keep-alive session and are limited per host
+    to `per_host` concurrent requests starting at least `delay` seconds
+    apart. Pages are requested conditionally with the validators of the
+    last run, pages and URLs that were already stored are skipped.
+    """
+    def __init__(
+            self, state_file: Optional[Path] = None, workers: int = 4,
+            per_host: int = 2, delay: float = 1.0,
+            stored_urls: Iterable[str] = ()):
+        self.state = CrawlState(state_file)
+        self.workers = workers
+        self.per_host = per_host
+        self.delay = delay
+        self.stored_urls = set(stored_urls)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._limiters: Dict[str, HostLimiter] = {}
+        self._limiters_lock = threading.Lock()
+
+    def get(self, url: str, conditional: bool = True) \
+            -> Optional[requests.Response]:
+        """Fetch a URL, returns None if it was not modified since last run"""
+        headers = {}
+        validators = self.state.validators.get(url, {}) if conditional else {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        with self._limiter(url):
+            logging.debug(f'Fetching {url}')
+            response = self.session.get(url, headers=headers, timeout=30)
+
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['last_modified'] = response.headers['Last-Modified']
+        with self.state.lock:
+            self.state.validators[url] = validators
+
+        return response
+
+    def links(
+            self, url: str,
+            parse: Callable[[requests.Response], List[str]]) -> List[str]:
+        """Links of an overview page, unchanged pages are not parsed again"""
+        # without stored links we cannot handle a "not modified" response
+        response = self.get(url, conditional=url in self.state.links)
+        if response is None:
+            logging.debug(f'{url} not modified')
+            return self.state.links[url]
+
+        links = parse(response)
+        with self.state.lock:
+            self.state.links[url] = links
+        self.state.save()
+
+        return links
+
+    def is_stored(self, url: str) -> bool:
+        return url in self.stored_urls or url in self.state.done
+
+    def run(
+            self, urls: Iterable[str], handle: Callable[[str], Any],
+            save_every: int = 20) -> int:
+        """Call `handle` for all URLs that are not stored yet
+
+        URLs are handled concurrently by a thread pool, `handle` should
+        fetch its pages with `get(url, conditional=False)`. The crawl state
+        is saved regularly, so an interrupted run continues where it
+        stopped. Returns the number of handled URLs.
+        """
+        todo = [url for url in dict.fromkeys(urls) if not self.is_stored(url)]
+        logging.info(f'{len(todo)} URLs to fetch')
+
+        handled = 0
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            futures = {executor.submit(handle, url): url for url in todo}
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception(f'Could not retrieve {url}')
+                    continue
+
+                with self.state.lock:
+                    self.state.done.add(url)
+                handled += 1
+                if handled % save_every == 0:
+                    self.state.save()
+
+        self.state.save()
+        return handled
+
+    def _limiter(self, url: str) -> HostLimiter:
+        host = urllib.parse.urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.per_host, self.delay)
+            return self._limiters[host]
+
+
+def default_state_file(name: str) -> Path:
+    return Path('data') / 'retrieval' / f'{name}.json'
+
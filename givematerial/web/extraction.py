@@ -0,0 +1,118 @@
+import argparse
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Iterable, List
+
+from givematerial.cache import LearnableCache
+from givematerial.corpus import CorpusIndex
+from givematerial.db.sqlite import connect, create_tables
+from givematerial import recommendation
+
+# languages the web app cannot extract itself, a worker is deployed for each
+# of them, see hosting/givematerial_extraction.service
+WORKER_LANGUAGES = {'hr'}
+
+
+def add_extraction_requests(
+        content_hashes: Iterable[str], language: str,
+        conn: sqlite3.Connection):
+    c = conn.cursor()
+    # duplicates are ignored, each text only has to be extracted once
+    c.executemany(
+        'INSERT OR IGNORE INTO extraction_requests (content_hash, language) '
+        'VALUES (?, ?)',
+        [(content_hash, language) for content_hash in content_hashes])
+    conn.commit()
+
+
+def get_open_extraction_requests(
+        language: str, conn: sqlite3.Connection, limit: int) -> List[str]:
+    c = conn.cursor()
+    c.execute(
+        'SELECT content_hash FROM extraction_requests WHERE language = ? '
+        'LIMIT ?',
+        (language, limit))
+
+    return [row[0] for row in c.fetchall()]
+
+
+def finish_extraction_requests(
+        content_hashes: List[str], language: str, conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.executemany(
+        'DELETE FROM extraction_requests '
+        'WHERE content_hash = ? AND language = ?',
+        [(content_hash, language) for content_hash in content_hashes])
+    conn.commit()
+
+
+def extract(
+        content_hashes: List[str], language: str, corpus: CorpusIndex,
+        cache: LearnableCache, learnable_extractor):
+    """Extract learnables for texts and store them in cache and corpus"""
+    texts = []
+    for content_hash in content_hashes:
+        same_content = corpus.texts_by_hash(language, content_hash)
+        if same_content:
+            texts.append(same_content)
+        else:
+            logging.warning(f'No text with content hash {content_hash}')
+
+    learnables = learnable_extractor.extract_learnables_batch(
+        [same_content[0].load_text() for same_content in texts])
+
+    extractor_id = learnable_extractor.extractor_id
+    for same_content, text_learnables in zip(texts, learnables):
+        cache.write_cache(
+            same_content[0].content_hash, extractor_id, text_learnables)
+        for text in same_content:
+            corpus.set_learnables(text.id, text_learnables, extractor_id)
+
+    # a new corpus version lets the web app pick up the new learnables
+    corpus.commit()
+
+
+def loop(
+        conn: sqlite3.Connection, language: str, texts_folder: Path,
+        cache_folder: Path, batch_size: int):
+    # the extractor is loaded only once for the lifetime of the worker
+    learnable_extractor = recommendation.create_extractor(language)
+    corpus = CorpusIndex(texts_folder)
+    cache = LearnableCache(cache_folder)
+
+    while True:
+        content_hashes = get_open_extraction_requests(
+            language, conn, batch_size)
+        if not content_hashes:
+            time.sleep(1)
+            continue
+
+        logging.info(f'Extract learnables for {len(content_hashes)} texts')
+        try:
+            extract(
+                content_hashes, language, corpus, cache, learnable_extractor)
+        except:
+            logging.exception('Could not extract learnables')
+
+        # even on exception mark as finished so that broken texts do not
+        # block the queue, they are requested again by the next index build
+        finish_extraction_requests(content_hashes, language, conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Extract learnables for texts requested by the web app')
+    parser.add_argument('--language', '-l', dest='language', required=True)
+    parser.add_argument(
+        '--batch-size', dest='batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv('LOGLEVEL'))
+    sqlite_conn = connect()
+    create_tables(sqlite_conn)
+    loop(
+        sqlite_conn, args.language, Path('data') / 'texts',
+        Path('data') / args.language / 'cache', args.batch_size)
@@ -1,11 +1,14 @@
+import argparse
+import concurrent.futures
 import logging
 import os
 import sqlite3
 import time
+from typing import List, Optional, Tuple
 
 from givematerial.learningstatus import LearnableStatus, WanikaniStatus
 from givematerial.cache import SqliteLearnableCache
-from givematerial.db.sqlite import create_tables
+from givematerial.db.sqlite import connect, create_tables, get_user_id
 
 
 def ingest(
@@ -14,54 +17,294 @@ def ingest(
     known = learnable_status_provider.get_known_learnables()
     learning = learnable_status_provider.get_learning_learnables()
 
-    cache.update_cache(learning, known)
+    if isinstance(learnable_status_provider, WanikaniStatus) \
+            and learnable_status_provider.is_incremental:
+        changes = {learnable: 'learning' for learnable in learning}
+        changes.update({learnable: 'known' for learnable in known})
+        cache.apply_changes(
+            changes, learnable_status_provider.get_removed_learnables())
+    else:
+        cache.update_cache(learning, known)
 
 
-def add_download_request(token: str, conn: sqlite3.Connection):
+# download requests of users who just logged in are processed first
+PRIORITY_SCHEDULED = 0
+PRIORITY_LOGIN = 1
+
+# users are refreshed more often the more recently they logged in, as
+# (days since last login, hours between refreshes)
+REFRESH_INTERVALS = [
+    (1, 1),
+    (7, 6),
+    (30, 24),
+]
+# check for users to refresh every this many seconds
+SCHEDULE_INTERVAL = 60
+# the refresh interval doubles with every failed sync, after this many
+# failures in a row users are only synced again when they log in
+MAX_SYNC_FAILURES = 5
+
+
+def add_download_request(
+        token: str, conn: sqlite3.Connection,
+        priority: int = PRIORITY_LOGIN):
     c = conn.cursor()
-    try:
-        c.execute('INSERT INTO token_requests (user_id) VALUES (?)', (token,))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        # just ignore duplicate errors
-        pass
+    # an existing request keeps its position, but gets the higher priority
+    c.execute(
+        'INSERT INTO token_requests (token, requested, priority) '
+        'VALUES (?, datetime(\'now\'), ?) '
+        'ON CONFLICT (token) DO UPDATE '
+        'SET priority = MAX(priority, excluded.priority)',
+        (token, priority))
+    conn.commit()
 
 
 def get_open_download_requests(conn: sqlite3.Connection):
     c = conn.cursor()
-    c.execute('SELECT user_id FROM token_requests')
+    c.execute('SELECT token FROM token_requests')
 
     return [row[0] for row in c.fetchall()]
 
 
+def get_prioritized_download_requests(
+        conn: sqlite3.Connection) -> List[Tuple[str, float, int]]:
+    """Open download requests with their age in seconds and priority
+
+    Requests with the highest priority come first, then the oldest.
+    """
+    c = conn.cursor()
+    c.execute(
+        'SELECT token, (julianday(\'now\') - julianday(requested)) * 86400, '
+        'priority FROM token_requests ORDER BY priority DESC, requested')
+
+    return [(token, age or 0.0, priority or PRIORITY_SCHEDULED)
+            for token, age, priority in c.fetchall()]
+
+
+def is_download_pending(token: str, conn: sqlite3.Connection) -> bool:
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM token_requests WHERE token = ?', (token,))
+
+    return c.fetchone()[0] > 0
+
+
 def finish_download_request(token: str, conn: sqlite3.Connection):
     c = conn.cursor()
-    c.execute('DELETE FROM token_requests WHERE user_id = ?', (token,))
+    c.execute('DELETE FROM token_requests WHERE token = ?', (token,))
+    conn.commit()
+
+
+def schedule_refreshes(conn: sqlite3.Connection, limit: int) -> int:
+    """Add download requests for users whose status is due for a refresh
+
+    Only users that were synced successfully before are refreshed, others
+    are only downloaded when they log in. Users whose last syncs failed are
+    refreshed less often and not at all after `MAX_SYNC_FAILURES` failures.
+    At most `limit` users with the oldest sync attempt are added at once,
+    so that refreshes are spread over time. Returns the number of added
+    requests.
+    """
+    refresh_interval = 'CASE '
+    for login_days, refresh_hours in REFRESH_INTERVALS:
+        refresh_interval += (
+            f'WHEN julianday(\'now\') - julianday(last_login) < {login_days} '
+            f'THEN {refresh_hours / 24} ')
+    # users who did not log in for a long time are not refreshed
+    refresh_interval += 'ELSE NULL END'
+
+    failures = 'COALESCE(sync_failures, 0)'
+    # users synced before failures were recorded have no attempt yet
+    last_attempt = 'COALESCE(last_attempt, last_sync)'
+
+    c = conn.cursor()
+    c.execute(
+        f'SELECT token FROM user '
+        f'WHERE last_sync IS NOT NULL AND last_login IS NOT NULL '
+        f'AND {failures} < ? '
+        f'AND token NOT IN (SELECT token FROM token_requests) '
+        f'AND julianday(\'now\') - julianday({last_attempt}) '
+        f'> {refresh_interval} * (1 << {failures}) '
+        f'ORDER BY {last_attempt} LIMIT ?',
+        (MAX_SYNC_FAILURES, limit))
+    tokens = [row[0] for row in c.fetchall()]
+
+    c.executemany(
+        'INSERT OR IGNORE INTO token_requests (token, requested, priority) '
+        'VALUES (?, datetime(\'now\'), ?)',
+        [(token, PRIORITY_SCHEDULED) for token in tokens])
+    conn.commit()
+
+    return len(tokens)
+
+
+def get_wanikani_updated_after(
+        token: str, conn: sqlite3.Connection) -> Optional[str]:
+    c = conn.cursor()
+    c.execute(
+        'SELECT wanikani_updated_after FROM user WHERE token = ?', (token,))
+    row = c.fetchone()
+
+    return row[0] if row else None
+
+
+def set_synced(
+        token: str, updated_after: Optional[str], conn: sqlite3.Connection):
+    """Remember a successful sync and the time of the newest change
+
+    Wanikani users are created by their first successful sync, which
+    follows their login.
+    """
+    get_user_id(conn, token, create=True)
+    conn.execute(
+        'UPDATE user SET wanikani_updated_after = ?, '
+        'last_sync = datetime(\'now\'), last_attempt = datetime(\'now\'), '
+        'last_login = COALESCE(last_login, datetime(\'now\')), '
+        'sync_failures = 0 WHERE token = ?',
+        (updated_after, token))
     conn.commit()
 
 
-def loop(conn: sqlite3.Connection):
-    while True:
-        for token in get_open_download_requests(conn):
-            logging.info(f'Fetch info for token {token} from Wanikani')
-            try:
-                status = WanikaniStatus(token)
-                cache = SqliteLearnableCache(conn, token)
+def set_sync_failed(token: str, conn: sqlite3.Connection):
+    """Remember a failed sync, so that the user is retried later"""
+    conn.execute(
+        'UPDATE user SET last_attempt = datetime(\'now\'), '
+        'sync_failures = COALESCE(sync_failures, 0) + 1 WHERE token = ?',
+        (token,))
+    conn.commit()
+
+
+def fetch_status(
+        token: str, updated_after: Optional[str] = None) -> WanikaniStatus:
+    """Download the status of a token, runs in a worker thread"""
+    status = WanikaniStatus(token, updated_after)
+    status.get_known_learnables()
+    status.get_learning_learnables()
+
+    return status
+
+
+class QueueMetrics:
+    """Counters of the download queue, logged in regular intervals"""
+    def __init__(self, interval: float = 60):
+        self.interval = interval
+        self.last_log = time.monotonic()
+
+        self.processed = 0
+        self.failed = 0
+        self.fetch_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def finished(self, fetch_seconds: float, wait_seconds: float, ok: bool):
+        self.processed += 1
+        self.failed += 0 if ok else 1
+        self.fetch_seconds += fetch_seconds
+        self.wait_seconds += wait_seconds
 
-                ingest(status, cache)
-            except:
-                logging.exception('Could not update learning status')
+    def maybe_log(self, queued: int, in_flight: int):
+        if time.monotonic() - self.last_log < self.interval:
+            return
+        self.last_log = time.monotonic()
 
-            # even on exception mark as finished due to invalid tokens
-            # TODO: Check invalid tokens in advance and re-try other failures
-            # a few times
-            finish_download_request(token, conn)
+        processed = max(self.processed, 1)
+        logging.info(
+            f'Download queue: {queued} queued, {in_flight} in flight, '
+            f'{self.processed} processed, {self.failed} failed, '
+            f'avg fetch {self.fetch_seconds / processed:.1f}s, '
+            f'avg wait {self.wait_seconds / processed:.1f}s')
 
-        time.sleep(1)
+
+def loop(
+        conn: sqlite3.Connection, workers: int = 4,
+        scheduled_workers: Optional[int] = None):
+    """Download the status of several tokens concurrently
+
+    Downloads run in a thread pool, results are written to the database
+    by this thread only. Scheduled refreshes use at most
+    `scheduled_workers` threads, so that users who log in do not have to
+    wait for them.
+    """
+    if scheduled_workers is None:
+        scheduled_workers = max(1, workers // 2)
+
+    metrics = QueueMetrics()
+    # token -> (future, start time, seconds the request was queued, priority)
+    in_flight = {}
+    last_schedule = 0.0
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while True:
+            for token, (future, started, waited, priority) \
+                    in list(in_flight.items()):
+                if not future.done():
+                    continue
+
+                del in_flight[token]
+                ok = False
+                try:
+                    status = future.result()
+                    cache = SqliteLearnableCache(conn, token)
+                    ingest(status, cache)
+                    # the next sync only fetches later changes
+                    set_synced(token, status.data_updated_at, conn)
+                    ok = True
+                except Exception:
+                    logging.exception(
+                        f'Could not update learning status of {token}')
+                    set_sync_failed(token, conn)
+
+                # even on exception mark as finished due to invalid tokens,
+                # temporary failures were already retried by the download
+                finish_download_request(token, conn)
+                metrics.finished(time.monotonic() - started, waited, ok)
+
+            if time.monotonic() - last_schedule >= SCHEDULE_INTERVAL:
+                last_schedule = time.monotonic()
+                scheduled = schedule_refreshes(conn, workers)
+                if scheduled:
+                    logging.info(f'Scheduled refresh of {scheduled} users')
+
+            open_requests = get_prioritized_download_requests(conn)
+            for token, age, priority in open_requests:
+                # the other requests wait in the table, so that the queue
+                # length is visible in the metrics
+                if len(in_flight) >= workers:
+                    break
+                if token in in_flight:
+                    continue
+
+                scheduled_in_flight = sum(
+                    1 for *_, p in in_flight.values()
+                    if p == PRIORITY_SCHEDULED)
+                if priority == PRIORITY_SCHEDULED \
+                        and scheduled_in_flight >= scheduled_workers:
+                    # requests are sorted by priority, only scheduled
+                    # refreshes follow
+                    break
+
+                logging.info(f'Fetch info for token {token} from Wanikani')
+                future = executor.submit(
+                    fetch_status, token,
+                    get_wanikani_updated_after(token, conn))
+                in_flight[token] = (future, time.monotonic(), age, priority)
+
+            metrics.maybe_log(
+                len(open_requests) - len(in_flight), len(in_flight))
+            time.sleep(0.2 if in_flight else 1)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Download the learning status of users from Wanikani')
+    parser.add_argument(
+        '--workers', '-w', dest='workers', type=int, default=4,
+        help='Number of tokens downloaded at the same time')
+    parser.add_argument(
+        '--scheduled-workers', dest='scheduled_workers', type=int,
+        help='Number of scheduled refreshes running at the same time, '
+        'defaults to half of the workers')
+    args = parser.parse_args()
+
     logging.basicConfig(level=os.getenv('LOGLEVEL'))
-    sqlite_conn = sqlite3.connect('givematerial.sqlite')
+    sqlite_conn = connect()
     create_tables(sqlite_conn)
-    loop(sqlite_conn)
+    loop(sqlite_conn, args.workers, args.scheduled_workers)
@@ -1,22 +1,93 @@
+import collections
+import contextlib
 from flask import Flask, render_template, request, session, g, redirect, \
     url_for, jsonify
+import json
 import os
 from pathlib import Path
 import sqlite3
+import threading
+from typing import Any, Dict, Optional, Tuple
 import uuid
+import zlib
 
 from givematerial.cache import SqliteLearnableCache
+from givematerial.corpus import CorpusIndex
 import givematerial.db.sqlite
 import givematerial.extractors
 import givematerial.learningstatus
 from givematerial import recommendation
-from givematerial.web import ingest
+from givematerial.web import extraction, ingest
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET')
 
-DB_NAME = 'givematerial.sqlite'
-givematerial.db.sqlite.create_tables(sqlite3.connect(DB_NAME))
+# do not scan the texts folder for new files more often than this
+CORPUS_REFRESH_INTERVAL = int(os.getenv('CORPUS_REFRESH_INTERVAL', default=60))
+# number of users for which text scores are kept in memory
+SCORES_CACHE_SIZE = int(os.getenv('SCORES_CACHE_SIZE', default=100))
+# number of users for which the recommendations are kept in memory
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', default=1000))
+# maximum size of a decompressed learning status upload in bytes
+MAX_STATUS_SIZE = int(os.getenv('MAX_STATUS_SIZE', default=32 * 1024 * 1024))
+# order of recommended texts, see recommendation.RANKINGS
+TEXT_RANKING = recommendation.create_ranking(
+    os.getenv('TEXT_RANKING', default='count'))
+
+db_pool = givematerial.db.sqlite.ConnectionPool()
+with contextlib.closing(givematerial.db.sqlite.connect()) as conn:
+    givematerial.db.sqlite.create_tables(conn)
+
+# the corpus index of each worker process, see get_corpus
+corpus_indexes: Dict[int, CorpusIndex] = {}
+# requests must not use the corpus connection at the same time
+corpus_lock = threading.Lock()
+learnable_indexes = {}
+user_scores = collections.OrderedDict()
+
+
+class ResultCache:
+    """Recommendations of the last request of each user
+
+    An entry is only valid for the same key, i.e. the versions of the
+    user status, the reading list and the corpus. The least recently used
+    users are evicted.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+            self, user_id: str,
+            key: Tuple) -> Optional[recommendation.Recommendations]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] != key:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        return entry[1]
+
+    def put(
+            self, user_id: str, key: Tuple,
+            result: recommendation.Recommendations):
+        self.entries[user_id] = (key, result)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> str:
+        lookups = max(self.hits + self.misses, 1)
+        return (
+            f'{len(self.entries)} entries, {self.hits} hits, '
+            f'{self.misses} misses ({self.hits / lookups:.0%} hit rate)')
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE)
 
 
 def public_registration():
@@ -34,16 +105,38 @@ def get_conn():
     if 'sqlite_conn' in g:
         return g.sqlite_conn
     else:
-        sqlite_conn = sqlite3.connect(DB_NAME)
+        sqlite_conn = db_pool.acquire()
         g.sqlite_conn = sqlite_conn
         return sqlite_conn
 
 
+@app.teardown_appcontext
+def release_conn(exception):
+    sqlite_conn = g.pop('sqlite_conn', None)
+    if sqlite_conn is not None:
+        db_pool.release(sqlite_conn)
+
+
+def get_corpus() -> CorpusIndex:
+    """The corpus index of this process, opened on first use
+
+    Processes inherited through fork (e.g. by uwsgi workers) open their own
+    index instead of sharing the connection of the parent.
+    """
+    corpus = corpus_indexes.get(os.getpid())
+    if corpus is None:
+        corpus = CorpusIndex(Path('data') / 'texts')
+        corpus_indexes[os.getpid()] = corpus
+
+    return corpus
+
+
 def user_language(user_id: str, conn: sqlite3.Connection) -> str:
     c = conn.cursor()
-    c.execute('SELECT language FROM user WHERE user_id = ?', (user_id,))
+    c.execute('SELECT language FROM user WHERE token = ?', (user_id,))
     row = c.fetchone()
-    if not row:
+    # Wanikani users log in with their token and have no language
+    if not row or row[0] is None:
         language = 'jp'
     else:
         language = row[0]
@@ -51,6 +144,95 @@ def user_language(user_id: str, conn: sqlite3.Connection) -> str:
     return language
 
 
+def user_last_sync(user_id: str, conn: sqlite3.Connection) -> Optional[str]:
+    """UTC time of the last download of the user's learning status"""
+    c = conn.cursor()
+    c.execute('SELECT last_sync FROM user WHERE token = ?', (user_id,))
+    row = c.fetchone()
+
+    return row[0] if row else None
+
+
+def user_versions(user_id: str, conn: sqlite3.Connection) -> Tuple[int, int]:
+    """Versions of the learning status and the reading list of a user"""
+    c = conn.cursor()
+    c.execute(
+        'SELECT status_version, reading_list_version FROM user '
+        'WHERE token = ?',
+        (user_id,))
+    row = c.fetchone()
+
+    return (row[0] or 0, row[1] or 0) if row else (0, 0)
+
+
+def get_user_scores(
+        user_id: str, language: str, index: recommendation.LearnableIndex) \
+        -> recommendation.TextScores:
+    """Get the cached text scores of a user, least recently used are evicted"""
+    scores = user_scores.get(user_id)
+    if scores is None or scores.index is not index:
+        scores = recommendation.create_text_scores(
+            language, index, TEXT_RANKING)
+
+    user_scores[user_id] = scores
+    user_scores.move_to_end(user_id)
+    while len(user_scores) > SCORES_CACHE_SIZE:
+        user_scores.popitem(last=False)
+
+    return scores
+
+
+def get_learnable_index(
+        corpus: CorpusIndex, language: str, cache_folder: Path,
+        learnable_extractor) -> recommendation.LearnableIndex:
+    index = learnable_indexes.get(language)
+    if index is None:
+        # text weights are computed once per index, not per request
+        frequencies = recommendation.load_frequencies(language) \
+            if TEXT_RANKING.uses_weights else None
+        index = recommendation.LearnableIndex.build(
+            corpus, language, cache_folder, learnable_extractor, frequencies)
+        learnable_indexes[language] = index
+        missing = index.missing
+    elif index.version != corpus.version:
+        # only changed texts are applied, scores of users stay valid
+        missing = index.refresh(
+            corpus, language, cache_folder, learnable_extractor)
+    else:
+        return index
+
+    # let the extraction worker process texts we cannot handle here
+    extraction.add_extraction_requests(missing, language, get_conn())
+
+    return index
+
+
+def calc_home_recommendations(
+        user_id: str, language: str, corpus: CorpusIndex, cache_folder: Path,
+        learnable_extractor,
+        conn: sqlite3.Connection) -> recommendation.Recommendations:
+    learning_status = givematerial.learningstatus.SqliteBasedStatus(
+        conn, user_id)
+    known_words = learning_status.get_known_learnables()
+    learning_words = learning_status.get_learning_learnables()
+
+    # TODO: Better (generic) scheme for hiding already finished texts
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT r.text_url FROM reading_list r '
+        'JOIN user u ON u.id = r.user_id WHERE u.token = ?',
+        (user_id,))
+    already_read = {item[0] for item in cur.fetchall()}
+
+    index = get_learnable_index(
+        corpus, language, cache_folder, learnable_extractor)
+    scores = get_user_scores(user_id, language, index)
+    # only texts containing words with a changed status are re-scored
+    scores.update(known_words, learning_words)
+    return scores.recommend(
+        count=20, common_words_count=100, exclude_urls=already_read)
+
+
 @app.route("/", methods=['get', 'post'])
 def home():
     sqlite_conn = get_conn()
@@ -61,102 +243,159 @@ def home():
         session['wktoken'] = wk_token
         if user_language(wk_token, sqlite_conn) == 'jp':
             ingest.add_download_request(wk_token, sqlite_conn)
-        else:
-            sqlite_conn.execute(
-                'UPDATE user SET last_login = "now" WHERE user_id = ?',
-                (wk_token,))
-            sqlite_conn.commit()
+
+        # the ingest worker refreshes recently active users more often, new
+        # Wanikani users are created by their first sync
+        sqlite_conn.execute(
+            'UPDATE user SET last_login = datetime(\'now\') WHERE token = ?',
+            (wk_token,))
+        sqlite_conn.commit()
 
         # redirect to same URL (to allow F5 refresh)
         return redirect(url_for('home'))
     else:
         wk_token = session.get('wktoken', default=None)
 
-    token_finished_downloading = None
+    last_sync = None
+    sync_pending = False
     most_common_words = []
     if wk_token:
         language = user_language(wk_token, sqlite_conn)
 
-        # Check if the token data has already been downloaded
-        open_dl_requests = ingest.get_open_download_requests(sqlite_conn)
-        token_finished_downloading = wk_token not in open_dl_requests
+        last_sync = user_last_sync(wk_token, sqlite_conn)
+        if last_sync is None:
+            sync_pending = ingest.is_download_pending(wk_token, sqlite_conn)
 
-        learning_status = givematerial.learningstatus.SqliteBasedStatus(
-            sqlite_conn, wk_token)
-        known_words = learning_status.get_known_learnables()
-        learning_words = learning_status.get_learning_learnables()
         if language == 'jp':
             learnable_extractor = \
                 givematerial.extractors.JapaneseKanjiExtractor()
         elif language == 'hr':
             # Classla does not work inside flask, so we have to rely on
-            # pre-parsed data from the cache
+            # pre-parsed data from the cache, missing texts are extracted
+            # by the extraction worker
             learnable_extractor = givematerial.extractors.NoopExtractor()
         else:
             raise NotImplementedError('Unsupported language')
 
         # TODO: Cleanup these definitions
-        texts_folder = Path('data') / 'texts'
         cache_folder = Path('data') / language / 'cache'
 
-        recommendations = recommendation.get_recommendations(
-            known_words, learning_words, cache_folder, texts_folder, language,
-            learnable_extractor, count=20)
-        most_common_words = recommendation.most_common_words(
-            known_words, learning_words,
-            cache_folder, texts_folder, language, learnable_extractor,
-            count=100)
-
-        # TODO: Better (generic) scheme for hiding already finished texts
-        cur = sqlite_conn.cursor()
-        cur.execute(
-            'SELECT text_url FROM reading_list WHERE user_id = ?', (wk_token,))
-        already_read = [item[0] for item in cur.fetchall()]
-        recommendations = [rec for rec in recommendations
-                           if rec.url not in already_read]
+        with corpus_lock:
+            corpus = get_corpus()
+            corpus.refresh(min_interval=CORPUS_REFRESH_INTERVAL)
+
+            # recommendations only change if the status, the reading list or
+            # the corpus change
+            cache_key = (language, *user_versions(wk_token, sqlite_conn),
+                         corpus.version)
+            result = result_cache.get(wk_token, cache_key)
+            if result is None:
+                result = calc_home_recommendations(
+                    wk_token, language, corpus, cache_folder,
+                    learnable_extractor, sqlite_conn)
+                # storing extracted learnables increases the corpus version,
+                # the result already contains them
+                cache_key = (*cache_key[:-1], corpus.version)
+                result_cache.put(wk_token, cache_key, result)
+                app.logger.debug(f'Result cache: {result_cache.stats()}')
+
+        recommendations = result.texts
+        most_common_words = result.most_common_words
 
     else:
         recommendations = []
 
-    if token_finished_downloading is None:
-        auto_refresh = False
-    else:
-        auto_refresh = not token_finished_downloading
-
     return render_template(
         "home.html",
         recommendations=recommendations,
         most_common_words=[word for word, count in most_common_words],
         wk_token=wk_token,
-        token_finished_downloading=token_finished_downloading,
-        auto_refresh=auto_refresh)
+        last_sync=last_sync,
+        sync_pending=sync_pending)
+
+
+class InvalidBody(Exception):
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+def decompress_gzip(body: bytes, max_size: int) -> bytes:
+    """Decompress a gzip body without inflating more than `max_size`"""
+    # wbits 31 expects a gzip header
+    decompressor = zlib.decompressobj(wbits=31)
+    try:
+        data = decompressor.decompress(body, max_size)
+    except zlib.error:
+        raise InvalidBody('invalid gzip body', 400)
+
+    if decompressor.unconsumed_tail:
+        raise InvalidBody('body too large', 413)
+    if not decompressor.eof:
+        raise InvalidBody('truncated gzip body', 400)
+
+    return data
+
+
+def request_json() -> Any:
+    """JSON body of the request, which may be gzip-compressed"""
+    body = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = decompress_gzip(body, MAX_STATUS_SIZE)
+
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise InvalidBody('invalid JSON body', 400)
 
 
 @app.route("/learning-status", methods=['post'])
 def push_learning_status():
-    data = request.json
+    """Update the learning status of a user
+
+    Clients that send `base_version` only send the changes since the
+    status with that version, they receive a 409 if the status was changed
+    by someone else in the meantime and must then send their full status
+    with `full` set. Request bodies may be gzip-compressed.
+    """
+    try:
+        data = request_json()
+    except InvalidBody as e:
+        return jsonify({'error': str(e)}), e.status
+    if not isinstance(data, dict) or 'token' not in data:
+        return jsonify({'error': 'token is missing'}), 400
     user_id = data['token']
 
     sqlite_conn = get_conn()
     # check whether user exists
     c = sqlite_conn.cursor()
-    c.execute('SELECT COUNT(*) FROM user WHERE user_id = ?', (user_id,))
+    c.execute('SELECT COUNT(*) FROM user WHERE token = ?', (user_id,))
     count = c.fetchone()[0]
     if count == 0:
         return jsonify({'error': 'user does not exist'}), 401
 
     cache = SqliteLearnableCache(sqlite_conn, user_id)
-    learning, known = cache.read_cache()
-
-    # remove older state
-    learning = list(set(learning).difference(data['known']))
-    known = list(set(known).difference(data['learning']))
-    learning += data['learning']
-    known += data['known']
-
-    cache.update_cache(learning, known)
+    if data.get('full'):
+        cache.update_cache(data['learning'], data['known'])
+        return jsonify({'version': cache.status_version()})
+
+    # only the pushed learnables are written, a learnable moves from one
+    # status to the other
+    changes = {learnable: 'learning' for learnable in data['learning']}
+    changes.update({learnable: 'known' for learnable in data['known']})
+
+    if 'base_version' in data:
+        version = cache.apply_delta(
+            changes, data.get('removed', []), data['base_version'])
+        if version is None:
+            return jsonify({
+                'error': 'status has changed',
+                'version': cache.status_version()}), 409
+    else:
+        cache.apply_changes(changes, data.get('removed', []))
+        version = cache.status_version()
 
-    return jsonify({})
+    return jsonify({'version': version})
 
 
 @app.route("/redirect/read")
@@ -169,10 +408,21 @@ def redirect_read():
 
     wk_token = session.get('wktoken', default=None)
 
+    # users are only created by the registration or a Wanikani sync, other
+    # tokens cannot have a reading list
+    user_id = None
     if mark_read and wk_token:
+        user_id = givematerial.db.sqlite.get_user_id(sqlite_conn, wk_token)
+
+    if user_id is not None:
         cur.execute(
             'INSERT INTO reading_list (user_id, text_url) VALUES (?, ?)',
-            (wk_token, url))
+            (user_id, url))
+        # invalidates cached recommendations of the user
+        cur.execute(
+            'UPDATE user SET reading_list_version = '
+            'COALESCE(reading_list_version, 0) + 1 WHERE id = ?',
+            (user_id,))
         sqlite_conn.commit()
 
     return redirect(url)
@@ -192,7 +442,7 @@ def register():
         sqlite_conn = get_conn()
         cur = sqlite_conn.cursor()
         cur.execute(
-            'INSERT INTO user (user_id, language) VALUES (?, ?)',
+            'INSERT INTO user (token, language) VALUES (?, ?)',
             (token, language))
         sqlite_conn.commit()
 
@@ -1,11 +1,58 @@
 #!/usr/bin/env python3
 
 import argparse
+import gzip
+import json
+from pathlib import Path
 import requests
+from typing import Any, Dict, Optional
 
 from givematerial.learningstatus import AnkiStatus, FileBasedStatus
 
 
+def load_state(state_file: Path) -> Dict[str, Any]:
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def store_state(state_file: Path, state: Dict[str, Any]):
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+
+
+def delta_message(
+        last_push: Optional[Dict[str, Any]], known: set,
+        learning: set) -> Dict[str, Any]:
+    """Changes since the last successful push or the full status"""
+    if last_push is None:
+        return {'full': True, 'known': sorted(known),
+                'learning': sorted(learning)}
+
+    last_known = set(last_push['known'])
+    last_learning = set(last_push['learning'])
+
+    return {
+        'base_version': last_push['version'],
+        'known': sorted(known - last_known),
+        'learning': sorted(learning - last_learning),
+        'removed': sorted(
+            (last_known | last_learning) - (known | learning)),
+    }
+
+
+def post(remote_url: str, message: Dict[str, Any]) -> requests.Response:
+    body = gzip.compress(json.dumps(message).encode('utf-8'))
+    return requests.post(
+        remote_url, data=body,
+        headers={
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+        })
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Upload local status to web site')
@@ -15,6 +62,10 @@ if __name__ == '__main__':
         '--server-port', '-p', dest='port', default='5000')
     parser.add_argument(
         '--username', '-u', dest='username', required=True)
+    parser.add_argument(
+        '--state-file', dest='state_file', type=Path,
+        default=Path.home() / '.givematerial_push.json',
+        help='Stores the last pushed status, so that only changes are sent')
 
     subparsers = parser.add_subparsers(dest='subparser_name')
 
@@ -27,18 +78,37 @@ if __name__ == '__main__':
 
     if args.subparser_name == 'anki':
         status_reader = AnkiStatus(args.deckname)
+        source = f'anki:{args.deckname}'
     elif args.subparser_name == 'file':
         status_reader = FileBasedStatus(args.filepath, None)
+        source = f'file:{Path(args.filepath).resolve()}'
     else:
         raise NotImplementedError('Unknown command')
 
-    update_msg = {'known': [], 'learning': []}
-    for known_word in status_reader.get_known_learnables():
-        update_msg['known'].append(known_word)
-    for learning_word in status_reader.get_learning_learnables():
-        update_msg['learning'].append(learning_word)
+    known = set(status_reader.get_known_learnables())
+    learning = set(status_reader.get_learning_learnables()) - known
 
-    update_msg['token'] = args.username
     remote_url = f'http://{args.host}:{args.port}/learning-status'
-    r = requests.post(remote_url, json=update_msg)
+    # the state of another source is not a valid base for a delta, each
+    # push replaces the status on the server with that of its source
+    state_key = f'{remote_url} {args.username} {source}'
+    state = load_state(args.state_file)
+
+    update_msg = delta_message(state.get(state_key), known, learning)
+    update_msg['token'] = args.username
+    r = post(remote_url, update_msg)
+
+    if r.status_code == 409:
+        # the status on the server was changed by someone else
+        update_msg = delta_message(None, known, learning)
+        update_msg['token'] = args.username
+        r = post(remote_url, update_msg)
+
     print(r.json())
+    if r.ok:
+        state[state_key] = {
+            'version': r.json()['version'],
+            'known': sorted(known),
+            'learning': sorted(learning),
+        }
+        store_state(args.state_file, state)
@@ -1,12 +1,14 @@
 import argparse
 from dataclasses import dataclass
 import json
+import logging
 from pathlib import Path
-import requests
-import time
 from typing import List, Tuple
 import xextract
 
+from givematerial import retrieval
+from givematerial.ingestion import TextIngestor
+
 
 @dataclass
 class Text:
@@ -14,21 +16,27 @@ class Text:
     text: str
 
 
-def fetch_texts_urls(main_url: str) -> List[Tuple[str, str]]:
-    r = requests.get(main_url)
-    data = json.loads(r.content.decode('utf-8-sig'))[0]
+def fetch_texts_urls(
+        retriever: retrieval.Retriever,
+        main_url: str) -> List[Tuple[str, str]]:
+    def parse(r):
+        data = json.loads(r.content.decode('utf-8-sig'))[0]
+
+        urls = []
+        for date in data:
+            for item in data[date]:
+                url = f'https://www3.nhk.or.jp/news/easy/{item["news_id"]}/{item["news_id"]}.html'
+                tup = (url, item['title'])
+                urls.append(tup)
+        return urls
 
-    urls = []
-    for date in data:
-        for item in data[date]:
-            url = f'https://www3.nhk.or.jp/news/easy/{item["news_id"]}/{item["news_id"]}.html'
-            tup = (url, item['title'])
-            urls.append(tup)
-    return urls
+    # the crawl state stores the links as JSON lists
+    return [tuple(link) for link in retriever.links(main_url, parse)]
 
 
-def fetch_text(text_url: str, title: str) -> Text:
-    r = requests.get(text_url)
+def fetch_text(
+        retriever: retrieval.Retriever, text_url: str, title: str) -> Text:
+    r = retriever.get(text_url, conditional=False)
     html = r.content.decode('utf-8-sig')
     sections = xextract.String(
         css='.article-main__body', attr='_all_text').parse(html)
@@ -42,28 +50,35 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-o', '--output', required=False,
-        help='Output folder for lyrics results, will be created. '
-        'Defaults to "lyrics"')
+        help='Output folder for texts inside data/texts, will be '
+        'created. Defaults to "data/texts"')
 
     args = parser.parse_args()
     outdir = Path(args.output) if args.output else Path('data/texts')
 
+    logging.basicConfig(level=logging.INFO)
+    ingestor = TextIngestor()
+    retriever = retrieval.Retriever(
+        retrieval.default_state_file('nhk-easy'),
+        stored_urls=ingestor.urls())
+
     main_page = 'https://www3.nhk.or.jp/news/easy/news-list.json'
-    texts_urls = fetch_texts_urls(main_page)
+    titles = dict(fetch_texts_urls(retriever, main_page))
 
-    for text_url, title in texts_urls:
+    def store_text(text_url: str):
         filename = text_url.split('/')[-1]
-        text = fetch_text(text_url, title)
+        text = fetch_text(retriever, text_url, titles[text_url])
 
         print(f'Writing text for {filename}')
-        with open(outdir / f'{filename}.json', 'wt') as f:
-            data = {
+        ingestor.add(
+            outdir / f'{filename}.json',
+            {
                 'collection': 'nhk-easy',
                 'title': f'{text.title}',
                 'text': text.text,
                 'language': 'jp',
                 'url': text_url,
-            }
-            json.dump(data, f)
+            })
 
-        time.sleep(1)
+    retriever.run(titles.keys(), store_text)
+    ingestor.close()
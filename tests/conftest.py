@@ -0,0 +1,164 @@
+import http.server
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import urllib.parse
+
+import pytest
+
+from givematerial import learningstatus
+from givematerial.learningstatus import WanikaniStatus
+
+
+class FakeWanikani:
+    """State and request log of the fake Wanikani API
+
+    Supports the parts of the API used by `WanikaniStatus`: paginated
+    subjects and assignments with the `types`, `subject_types`,
+    `srs_stages` and `updated_after` filters.
+    """
+    def __init__(self, page_size: int = 2):
+        self.page_size = page_size
+        self.url = ''
+
+        # subject id -> (characters, updated at)
+        self.subjects: Dict[int, Tuple[str, str]] = {}
+        # subject id -> assignment data including `updated_at`
+        self.assignments: Dict[int, Dict[str, Any]] = {}
+        # responses sent instead of the next requests, as (status, headers)
+        self.failures: List[Tuple[int, Dict[str, str]]] = []
+        # path and query of all received requests
+        self.requests: List[str] = []
+
+    def add_subject(self, subject_id: int, characters: str, updated_at: str):
+        self.subjects[subject_id] = (characters, updated_at)
+
+    def set_assignment(
+            self, subject_id: int, srs_stage: int, updated_at: str,
+            hidden: bool = False):
+        self.assignments[subject_id] = {
+            'subject_id': subject_id,
+            'subject_type': 'kanji',
+            'srs_stage': srs_stage,
+            'hidden': hidden,
+            'updated_at': updated_at,
+        }
+
+    def requested(self, resource: str) -> List[Dict[str, List[str]]]:
+        """Query parameters of all requests of a resource"""
+        queries = []
+        for request in self.requests:
+            url = urllib.parse.urlsplit(request)
+            if url.path == f'/v2/{resource}':
+                queries.append(urllib.parse.parse_qs(url.query))
+
+        return queries
+
+    def handle(self, path: str) -> Tuple[int, Dict[str, str], Optional[Any]]:
+        self.requests.append(path)
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return status, headers, None
+
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/v2/subjects':
+            items = self._subject_items(query)
+        elif url.path == '/v2/assignments':
+            items = self._assignment_items(query)
+        else:
+            return 404, {}, None
+
+        updated_after = query.get('updated_after', [''])[0]
+        items = [item for item in items if item[0] > updated_after]
+
+        page = int(query.get('page', ['0'])[0])
+        start = page * self.page_size
+        next_url = None
+        if start + self.page_size < len(items):
+            next_query = {key: value[0] for key, value in query.items()}
+            next_query['page'] = page + 1
+            next_url = \
+                f'{self.url}{url.path}?{urllib.parse.urlencode(next_query)}'
+
+        return 200, {}, {
+            'object': 'collection',
+            'pages': {'next_url': next_url},
+            'data_updated_at': max(
+                (updated_at for updated_at, _ in items), default=None),
+            'data': [data for _, data in items[start:start + self.page_size]],
+        }
+
+    def _subject_items(self, query: Dict[str, List[str]]) -> List[Tuple]:
+        return [
+            (updated_at, {
+                'id': subject_id,
+                'object': 'kanji',
+                'data_updated_at': updated_at,
+                'data': {'characters': characters},
+            })
+            for subject_id, (characters, updated_at)
+            in sorted(self.subjects.items())]
+
+    def _assignment_items(self, query: Dict[str, List[str]]) -> List[Tuple]:
+        stages = None
+        if 'srs_stages' in query:
+            stages = {
+                int(stage) for stage in query['srs_stages'][0].split(',')}
+
+        return [
+            (assignment['updated_at'], {
+                'id': 1000 + subject_id,
+                'object': 'assignment',
+                'data_updated_at': assignment['updated_at'],
+                'data': assignment,
+            })
+            for subject_id, assignment in sorted(self.assignments.items())
+            if stages is None or assignment['srs_stage'] in stages]
+
+
+class FakeWanikaniHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, headers, body = self.server.fake.handle(self.path)
+
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def wanikani(monkeypatch, tmp_path):
+    """A local fake Wanikani server used by all `WanikaniStatus` instances
+
+    The subjects cache is written to a temporary folder and retries do not
+    wait.
+    """
+    fake = FakeWanikani()
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), FakeWanikaniHandler)
+    server.fake = fake
+    fake.url = f'http://127.0.0.1:{server.server_port}'
+
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05},
+        daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(WanikaniStatus, 'API_URL', f'{fake.url}/v2')
+    monkeypatch.setattr(
+        WanikaniStatus, '_backoff', staticmethod(lambda attempt: None))
+    monkeypatch.setattr('tempfile.tempdir', str(tmp_path))
+    monkeypatch.setattr(learningstatus, '_rate_limiters', {})
+
+    yield fake
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,60 @@
+import contextlib
+
+import pytest
+
+from givematerial.cache import LearnableCache, SqliteLearnableCache
+from givematerial.db.sqlite import connect, create_tables, get_user_id
+
+TOKEN = 'test-user'
+
+
+@pytest.fixture
+def cache(tmp_path):
+    conn = connect(str(tmp_path / 'givematerial.sqlite'))
+    create_tables(conn)
+    get_user_id(conn, TOKEN, create=True)
+    conn.commit()
+    yield SqliteLearnableCache(conn, TOKEN)
+    conn.close()
+
+
+def test_apply_delta(cache):
+    cache.update_cache(['a'], ['b'])
+    version = cache.status_version()
+
+    new_version = cache.apply_delta(
+        {'a': 'known', 'c': 'learning'}, ['b'], version)
+
+    assert new_version == version + 1
+    learning, known = cache.read_cache()
+    assert (learning, known) == (['c'], ['a'])
+
+
+def test_apply_empty_delta_keeps_version(cache):
+    cache.update_cache(['a'], ['b'])
+    version = cache.status_version()
+
+    assert cache.apply_delta({}, [], version) == version
+    # changes that match the stored status are no changes either
+    assert cache.apply_delta({'a': 'learning'}, ['x'], version) == version
+    assert cache.status_version() == version
+
+
+def test_apply_delta_conflict(cache):
+    cache.update_cache(['a'], ['b'])
+    version = cache.status_version()
+    cache.apply_changes({'c': 'known'})
+
+    assert cache.apply_delta({'d': 'known'}, [], version) is None
+    assert sorted(cache.read_cache()[1]) == ['b', 'c']
+
+
+def test_learnable_cache_runs_in_wal_mode(tmp_path):
+    with contextlib.closing(LearnableCache(tmp_path)) as cache:
+        cache.write_cache('hash', 'extractor', ['a'])
+        mode = cache.conn.execute('PRAGMA journal_mode').fetchone()[0]
+
+    # extraction workers write while the web app reads
+    assert mode == 'wal'
+    with contextlib.closing(LearnableCache(tmp_path)) as cache:
+        assert cache.check_cache('hash', 'extractor') == ['a']
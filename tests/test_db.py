@@ -0,0 +1,118 @@
+import sqlite3
+
+import pytest
+
+from givematerial.db import sqlite as db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / 'givematerial.sqlite'))
+    yield conn
+    conn.close()
+
+
+def create_baseline_schema(conn: sqlite3.Connection):
+    """Schema of the first versions with text user ids"""
+    conn.executescript('''
+        CREATE TABLE user (user_id TEXT, language TEXT, last_login DATETIME);
+        CREATE INDEX idx_user_user_id ON user (user_id);
+        CREATE TABLE srs (user_id TEXT, name TEXT, login TEXT);
+        CREATE INDEX idx_srs_user_id ON srs (user_id);
+        CREATE TABLE user_status (learnable TEXT, status TEXT, user_id TEXT);
+        CREATE INDEX idx_user_status_user_id ON user_status (user_id);
+        CREATE TABLE reading_list (user_id TEXT, text_url TEXT);
+        CREATE INDEX idx_reading_list_user_id ON reading_list (user_id);
+        CREATE TABLE token_requests (user_id TEXT);
+        CREATE UNIQUE INDEX idx_token_requests_user_id
+            ON token_requests (user_id);
+    ''')
+
+
+def status(conn: sqlite3.Connection, token: str):
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT l.learnable, s.status FROM user_status s '
+        'JOIN user u ON u.id = s.user_id '
+        'JOIN learnable l ON l.id = s.learnable_id WHERE u.token = ?',
+        (token,))
+    return dict(cur.fetchall())
+
+
+def test_migrate_baseline_schema(conn):
+    create_baseline_schema(conn)
+    conn.executemany(
+        'INSERT INTO user (user_id, language, last_login) VALUES (?, ?, ?)',
+        [('registered', 'hr', 'now')])
+    # Wanikani users only have status rows, a learnable was stored twice
+    conn.executemany(
+        'INSERT INTO user_status (learnable, status, user_id) '
+        'VALUES (?, ?, ?)',
+        [('一', 'learning', 'wanikani'), ('二', 'known', 'wanikani'),
+         ('一', 'known', 'wanikani'), ('kuća', 'learning', 'registered'),
+         ('x', 'unknown', 'wanikani')])
+    conn.executemany(
+        'INSERT INTO reading_list (user_id, text_url) VALUES (?, ?)',
+        [('wanikani', 'https://example.com/1')])
+    conn.executemany(
+        'INSERT INTO token_requests (user_id) VALUES (?)',
+        [('wanikani',), ('typo',)])
+    conn.commit()
+
+    db.create_tables(conn)
+
+    cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    assert cur.fetchone()[0] == db.SCHEMA_VERSION
+
+    cur.execute('SELECT token, language, last_login FROM user ORDER BY token')
+    # tokens of download requests alone do not become users
+    assert cur.fetchall() == [
+        ('registered', 'hr', None), ('wanikani', None, None)]
+
+    assert status(conn, 'wanikani') == {
+        '一': db.STATUS_KNOWN, '二': db.STATUS_KNOWN}
+    assert status(conn, 'registered') == {'kuća': db.STATUS_LEARNING}
+
+    cur.execute(
+        'SELECT u.token, r.text_url FROM reading_list r '
+        'JOIN user u ON u.id = r.user_id')
+    assert cur.fetchall() == [('wanikani', 'https://example.com/1')]
+
+    cur.execute('SELECT token FROM token_requests ORDER BY token')
+    assert cur.fetchall() == [('typo',), ('wanikani',)]
+
+    cur.execute(
+        'SELECT name FROM sqlite_master WHERE name LIKE ?', ('%_old',))
+    assert cur.fetchall() == []
+
+    # running it again does not change anything
+    db.create_tables(conn)
+    assert status(conn, 'wanikani') == {
+        '一': db.STATUS_KNOWN, '二': db.STATUS_KNOWN}
+
+
+def test_migrate_download_requests_to_tokens(conn):
+    db.create_tables(conn)
+    user_id = db.get_user_id(conn, 'wanikani', create=True)
+    # download requests of schema version 7 referred to the user id
+    conn.executescript('''
+        DROP TABLE token_requests;
+        CREATE TABLE token_requests (
+            user_id INTEGER PRIMARY KEY REFERENCES user (id),
+            requested DATETIME,
+            priority INTEGER DEFAULT 0
+        );
+        PRAGMA user_version = 7;
+    ''')
+    conn.execute(
+        'INSERT INTO token_requests (user_id, requested, priority) '
+        'VALUES (?, ?, ?)',
+        (user_id, '2024-01-01 00:00:00', 1))
+    conn.commit()
+
+    db.create_tables(conn)
+
+    cur = conn.cursor()
+    cur.execute('SELECT token, requested, priority FROM token_requests')
+    assert cur.fetchall() == [('wanikani', '2024-01-01 00:00:00', 1)]
@@ -0,0 +1,100 @@
+import pytest
+
+from givematerial.db.sqlite import connect, create_tables, get_user_id
+from givematerial.web import ingest
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = connect(str(tmp_path / 'givematerial.sqlite'))
+    create_tables(conn)
+    yield conn
+    conn.close()
+
+
+def add_user(conn, token: str, login_hours: float, sync_hours: float):
+    conn.execute(
+        'INSERT INTO user (token, last_login, last_sync) VALUES (?, '
+        'datetime(\'now\', ?), datetime(\'now\', ?))',
+        (token, f'-{login_hours} hours', f'-{sync_hours} hours'))
+    conn.commit()
+
+
+def age_attempt(conn, token: str, hours: float):
+    conn.execute(
+        'UPDATE user SET last_attempt = datetime(\'now\', ?) WHERE token = ?',
+        (f'-{hours} hours', token))
+    conn.commit()
+
+
+def scheduled(conn):
+    tokens = ingest.get_open_download_requests(conn)
+    for token in tokens:
+        ingest.finish_download_request(token, conn)
+    return sorted(tokens)
+
+
+def test_schedule_due_users(conn):
+    # refreshed every hour after a login on the same day
+    add_user(conn, 'due', 2, 2)
+    add_user(conn, 'fresh', 2, 0.5)
+    # refreshed every six hours after a login in the last week
+    add_user(conn, 'week', 48, 5)
+    # not refreshed after a month
+    add_user(conn, 'inactive', 24 * 40, 24 * 39)
+
+    assert ingest.schedule_refreshes(conn, 10) == 1
+    assert scheduled(conn) == ['due']
+
+
+def test_schedule_oldest_first(conn):
+    add_user(conn, 'older', 3, 3)
+    add_user(conn, 'old', 3, 2)
+
+    assert ingest.schedule_refreshes(conn, 1) == 1
+    assert scheduled(conn) == ['older']
+
+
+def test_failed_syncs_back_off(conn):
+    add_user(conn, 'failing', 12, 12)
+    add_user(conn, 'ok', 12, 2)
+
+    ingest.set_sync_failed('failing', conn)
+    # the failed attempt is recent, so the next refresh is not yet due
+    assert ingest.schedule_refreshes(conn, 1) == 1
+    assert scheduled(conn) == ['ok']
+    ingest.set_synced('ok', None, conn)
+
+    # one failure doubles the interval of one hour
+    age_attempt(conn, 'failing', 1.5)
+    assert ingest.schedule_refreshes(conn, 1) == 0
+    age_attempt(conn, 'failing', 2.5)
+    assert ingest.schedule_refreshes(conn, 1) == 1
+    assert scheduled(conn) == ['failing']
+
+    for _ in range(ingest.MAX_SYNC_FAILURES - 1):
+        ingest.set_sync_failed('failing', conn)
+    age_attempt(conn, 'failing', 11)
+    assert ingest.schedule_refreshes(conn, 1) == 0
+
+    # a successful sync after a login resets the failures
+    ingest.set_synced('failing', None, conn)
+    age_attempt(conn, 'failing', 1.5)
+    assert ingest.schedule_refreshes(conn, 1) == 1
+    assert scheduled(conn) == ['failing']
+
+
+def test_first_sync_creates_user(conn):
+    ingest.add_download_request('new', conn)
+    ingest.set_sync_failed('invalid', conn)
+    assert get_user_id(conn, 'new') is None
+    assert get_user_id(conn, 'invalid') is None
+
+    ingest.set_synced('new', '2024-01-01T00:00:00.000000Z', conn)
+
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT wanikani_updated_after, last_login IS NOT NULL FROM user '
+        'WHERE token = ?', ('new',))
+    # the first sync follows a login, so the user is refreshed regularly
+    assert cur.fetchall() == [('2024-01-01T00:00:00.000000Z', 1)]
@@ -0,0 +1,208 @@
+import json
+import os
+import random
+
+import pytest
+
+from givematerial import recommendation
+from givematerial.corpus import CorpusIndex
+from givematerial.extractors import JapaneseKanjiExtractor
+
+KANJI = [chr(0x4e00 + i) for i in range(300)]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    corpus = CorpusIndex(tmp_path / 'texts')
+    yield corpus
+    corpus.close()
+
+
+@pytest.fixture
+def cache_folder(tmp_path):
+    return tmp_path / 'cache'
+
+
+def write_text(corpus: CorpusIndex, name: str, text: str, mtime_ns: int = 0):
+    text_file = corpus.texts_folder / f'{name}.json'
+    with open(text_file, 'w') as f:
+        json.dump({
+            'collection': 'test', 'title': name, 'text': text,
+            'language': 'jp', 'url': f'https://example.com/{name}'}, f)
+    if mtime_ns:
+        # a rewrite within the same tick must still be seen by the refresh
+        os.utime(text_file, ns=(mtime_ns, mtime_ns))
+
+
+def random_text(rng: random.Random) -> str:
+    return ''.join(rng.choice(KANJI) for _ in range(rng.randint(5, 40)))
+
+
+def change_corpus(corpus: CorpusIndex, rng: random.Random, name: int) -> int:
+    """Adds, modifies and deletes random texts, returns the next free name"""
+    for _ in range(rng.randint(0, 8)):
+        files = sorted(corpus.texts_folder.glob('*.json'))
+        operation = rng.random()
+        if operation < 0.4 or not files:
+            write_text(corpus, str(name), random_text(rng))
+            name += 1
+        elif operation < 0.7:
+            text_file = rng.choice(files)
+            write_text(
+                corpus, text_file.stem, random_text(rng),
+                rng.randint(1, 10 ** 15))
+        else:
+            rng.choice(files).unlink()
+
+    corpus.refresh()
+    return name
+
+
+def random_status(rng: random.Random):
+    known = rng.sample(KANJI, rng.randint(0, 200))
+    unknown = [learnable for learnable in KANJI if learnable not in known]
+    return known, rng.sample(unknown, 20)
+
+
+def titles(recommendations: recommendation.Recommendations):
+    return [text.title for text in recommendations.texts]
+
+
+def common_counts(recommendations: recommendation.Recommendations):
+    # learnables with the same count may be in any order
+    return sorted(count for _, count in recommendations.most_common_words)
+
+
+def test_corpus_changes(corpus):
+    write_text(corpus, 'kept', '一二')
+    write_text(corpus, 'modified', '三四')
+    write_text(corpus, 'deleted', '五六')
+    corpus.refresh()
+    version = corpus.version
+    ids = {text.title: text.id for text in corpus.texts('jp')}
+
+    assert corpus.changes('jp', version) == ([], [])
+
+    write_text(corpus, 'modified', '三七', 10 ** 15)
+    write_text(corpus, 'added', '八九')
+    (corpus.texts_folder / 'deleted.json').unlink()
+    corpus.refresh()
+
+    changed, removed = corpus.changes('jp', version)
+    assert sorted(text.title for text in changed) == ['added', 'modified']
+    assert removed == [ids['deleted']]
+    assert corpus.changes('jp', corpus.version) == ([], [])
+    assert corpus.changes('hr', version) == ([], [])
+
+
+def test_incremental_scores_match_recommend(corpus, cache_folder):
+    rng = random.Random(3)
+    extractor = JapaneseKanjiExtractor()
+    name = change_corpus(corpus, rng, 0)
+
+    index = recommendation.LearnableIndex.build(
+        corpus, 'jp', cache_folder, extractor)
+    count_scores = [
+        recommendation.UserTextScores(index),
+        recommendation.BitsetTextScores(index),
+    ]
+    frequency_scores = recommendation.UserTextScores(
+        index, recommendation.FrequencyRanking())
+
+    for step in range(15):
+        name = change_corpus(corpus, rng, name)
+        # skipped refreshes are applied together by the next one
+        if step % 4 == 3:
+            continue
+        index.refresh(corpus, 'jp', cache_folder, extractor)
+
+        fresh_index = recommendation.LearnableIndex(
+            corpus.texts('jp'), corpus.version)
+        assert index.texts.keys() == fresh_index.texts.keys()
+        assert {learnable: sorted(text_ids)
+                for learnable, text_ids in index.postings.items()} \
+            == {learnable: sorted(text_ids)
+                for learnable, text_ids in fresh_index.postings.items()}
+        assert all(
+            index.text_bitsets[text_id] == index.bitset(text.learnables)
+            for text_id, text in index.texts.items())
+
+        known, learning = random_status(rng)
+        expected = recommendation.recommend(
+            known, learning, cache_folder, corpus, 'jp', extractor,
+            count=10, common_words_count=20)
+        for scores in count_scores:
+            scores.update(known, learning)
+            result = scores.recommend(10, 20)
+            assert titles(result) == titles(expected)
+            assert common_counts(result) == common_counts(expected)
+
+        # weights are kept from the first build, so compare against new
+        # scores of the same index
+        frequency_scores.update(known, learning)
+        fresh_scores = recommendation.UserTextScores(
+            index, recommendation.FrequencyRanking())
+        fresh_scores.update(known, learning)
+        assert titles(frequency_scores.recommend(10, 20)) \
+            == titles(fresh_scores.recommend(10, 20))
+
+
+def test_scores_rebuilt_after_many_changes(
+        corpus, cache_folder, monkeypatch):
+    monkeypatch.setattr(recommendation.LearnableIndex, 'MAX_CHANGES', 2)
+    rng = random.Random(5)
+    extractor = JapaneseKanjiExtractor()
+    name = change_corpus(corpus, rng, 0)
+    index = recommendation.LearnableIndex.build(
+        corpus, 'jp', cache_folder, extractor)
+    scores = recommendation.UserTextScores(index)
+    known, learning = random_status(rng)
+    scores.update(known, learning)
+
+    for _ in range(4):
+        write_text(corpus, str(name), random_text(rng))
+        name = change_corpus(corpus, rng, name + 1)
+        index.refresh(corpus, 'jp', cache_folder, extractor)
+
+    assert index.changes(scores.index_version) is None
+    scores.update(known, learning)
+    expected = recommendation.recommend(
+        known, learning, cache_folder, corpus, 'jp', extractor, count=10)
+    assert titles(scores.recommend(10)) == titles(expected)
+
+
+@pytest.mark.parametrize('scores_class', [
+    recommendation.UserTextScores, recommendation.BitsetTextScores])
+def test_recommend_only_common_words(corpus, cache_folder, scores_class):
+    write_text(corpus, 'a', '一二三')
+    write_text(corpus, 'b', '一二')
+    corpus.refresh()
+    index = recommendation.LearnableIndex.build(
+        corpus, 'jp', cache_folder, JapaneseKanjiExtractor())
+    scores = scores_class(index)
+    scores.update(['三'], [])
+
+    result = scores.recommend(count=0, common_words_count=5)
+
+    assert result.texts == []
+    assert sorted(result.most_common_words) == [('一', 2), ('二', 2)]
+
+
+def test_skip_deleted_text_files(corpus, cache_folder):
+    extractor = JapaneseKanjiExtractor()
+    write_text(corpus, 'best', '一二三四五')
+    write_text(corpus, 'second', '一二三四')
+    write_text(corpus, 'third', '一二三')
+    corpus.refresh()
+    index = recommendation.LearnableIndex.build(
+        corpus, 'jp', cache_folder, extractor)
+    # deleted after the refresh, the index still contains the text
+    (corpus.texts_folder / 'best.json').unlink()
+
+    expected = ['second', 'third']
+    assert titles(recommendation.recommend(
+        [], [], cache_folder, corpus, 'jp', extractor, count=2)) == expected
+    for scores in (recommendation.UserTextScores(index),
+                   recommendation.BitsetTextScores(index)):
+        scores.update([], [])
+        assert titles(scores.recommend(2)) == expected
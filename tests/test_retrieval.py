@@ -0,0 +1,201 @@
+import http.server
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import pytest
+
+from givematerial.retrieval import CrawlState, HostLimiter, Retriever
+
+
+class FakeSite:
+    """Pages of the fake site and a log of the received requests"""
+    def __init__(self):
+        self.url = ''
+        # path -> (status, body, ETag)
+        self.pages: Dict[str, Tuple[int, str, str]] = {}
+        # seconds each request takes
+        self.latency = 0.0
+
+        self.lock = threading.Lock()
+        # path, If-None-Match header and start time of all requests
+        self.requests: List[Tuple[str, str, float]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add_page(
+            self, path: str, body: str, etag: str = '', status: int = 200):
+        self.pages[path] = (status, body, etag)
+
+    def requested(self, path: str) -> List[str]:
+        """If-None-Match headers of all requests of a path"""
+        return [etag for requested, etag, _ in self.requests
+                if requested == path]
+
+
+class FakeSiteHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        site = self.server.site
+        with site.lock:
+            site.requests.append((
+                self.path, self.headers.get('If-None-Match', ''),
+                time.monotonic()))
+            site.in_flight += 1
+            site.max_in_flight = max(site.max_in_flight, site.in_flight)
+
+        time.sleep(site.latency)
+        status, body, etag = site.pages.get(self.path, (404, '', ''))
+        if etag and self.headers.get('If-None-Match') == etag:
+            status, body = 304, ''
+
+        # the client may start its next request as soon as it receives the
+        # response, so the request counts as finished before sending it
+        with site.lock:
+            site.in_flight -= 1
+
+        content = body.encode('utf-8')
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    fake = FakeSite()
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), FakeSiteHandler)
+    server.site = fake
+    fake.url = f'http://127.0.0.1:{server.server_port}'
+
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05},
+        daemon=True)
+    thread.start()
+
+    yield fake
+
+    server.shutdown()
+    server.server_close()
+
+
+def parse_lines(response) -> List[str]:
+    return response.text.splitlines()
+
+
+def test_host_limiter_spaces_requests():
+    limiter = HostLimiter(max_concurrent=1, delay=0.05)
+    # measured from before the first request, so that a late measurement
+    # of one start cannot make the next one look too early
+    begin = time.monotonic()
+    starts = []
+    for _ in range(3):
+        with limiter:
+            starts.append(time.monotonic() - begin)
+
+    assert all(start >= i * 0.05 for i, start in enumerate(starts))
+
+
+def test_concurrent_requests_per_host(site):
+    site.latency = 0.1
+    for i in range(8):
+        site.add_page(f'/article/{i}', f'text {i}')
+    retriever = Retriever(workers=6, per_host=2, delay=0.05)
+    texts = []
+
+    def handle(url: str):
+        texts.append(retriever.get(url, conditional=False).text)
+
+    urls = [f'{site.url}/article/{i}' for i in range(8)]
+
+    assert retriever.run(urls, handle) == 8
+    assert sorted(texts) == [f'text {i}' for i in range(8)]
+    # more workers than allowed requests per host
+    assert site.max_in_flight == 2
+
+    starts = sorted(start for _, _, start in site.requests)
+    assert all(b - a >= 0.03 for a, b in zip(starts, starts[1:]))
+
+
+def test_links_not_modified(site, tmp_path):
+    state_file = tmp_path / 'state.json'
+    site.add_page('/index', 'a\nb', etag='"v1"')
+    parsed = []
+
+    def parse(response) -> List[str]:
+        parsed.append(response.url)
+        return parse_lines(response)
+
+    retriever = Retriever(state_file, delay=0)
+    assert retriever.links(f'{site.url}/index', parse) == ['a', 'b']
+
+    # a later run sends the ETag and reuses the stored links
+    retriever = Retriever(state_file, delay=0)
+    assert retriever.links(f'{site.url}/index', parse) == ['a', 'b']
+    assert site.requested('/index') == ['', '"v1"']
+    assert len(parsed) == 1
+
+    site.add_page('/index', 'a\nb\nc', etag='"v2"')
+    assert retriever.links(f'{site.url}/index', parse) == ['a', 'b', 'c']
+    assert len(parsed) == 2
+
+
+def test_links_without_stored_links_are_fetched(site, tmp_path):
+    state_file = tmp_path / 'state.json'
+    site.add_page('/index', 'a', etag='"v1"')
+
+    # validators without links, e.g. the page was fetched with `get`
+    retriever = Retriever(state_file, delay=0)
+    retriever.get(f'{site.url}/index')
+    retriever.state.save()
+
+    retriever = Retriever(state_file, delay=0)
+    assert retriever.links(f'{site.url}/index', parse_lines) == ['a']
+    assert site.requested('/index') == ['', '']
+
+
+def test_stored_urls_are_skipped(site):
+    for name in 'abc':
+        site.add_page(f'/{name}', name)
+    handled = []
+
+    def handle(url: str):
+        retriever.get(url, conditional=False)
+        handled.append(url)
+
+    retriever = Retriever(delay=0, stored_urls=[f'{site.url}/a'])
+    urls = [f'{site.url}/{name}' for name in 'abcb']
+
+    assert retriever.run(urls, handle) == 2
+    assert sorted(handled) == [f'{site.url}/b', f'{site.url}/c']
+    assert site.requested('/a') == []
+
+
+def test_resume_crawl(site, tmp_path):
+    state_file = tmp_path / 'state.json'
+    site.add_page('/a', 'a')
+    site.add_page('/b', 'b', status=500)
+    site.add_page('/c', 'c')
+    urls = [f'{site.url}/{name}' for name in 'abc']
+
+    def handle(url: str):
+        retriever.get(url, conditional=False)
+
+    retriever = Retriever(state_file, delay=0)
+    assert retriever.run(urls, handle) == 2
+    assert CrawlState(state_file).done == {urls[0], urls[2]}
+
+    # the next run only retries the failed page
+    site.add_page('/b', 'b')
+    site.requests.clear()
+    retriever = Retriever(state_file, delay=0)
+
+    assert retriever.run(urls, handle) == 1
+    assert [path for path, _, _ in site.requests] == ['/b']
+    assert CrawlState(state_file).done == set(urls)
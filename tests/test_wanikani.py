@@ -0,0 +1,205 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from givematerial.cache import SqliteLearnableCache
+from givematerial.db.sqlite import connect, create_tables
+from givematerial.learningstatus import SqliteBasedStatus, WanikaniStatus
+from givematerial.web.ingest import ingest
+
+TOKEN = 'test-token'
+
+
+def timestamp(day: int) -> str:
+    return f'2024-01-{day:02d}T00:00:00.000000Z'
+
+
+@pytest.fixture
+def subjects(wanikani):
+    for subject_id, kanji in enumerate('一二三四五六', start=1):
+        wanikani.add_subject(subject_id, kanji, timestamp(1))
+    return wanikani
+
+
+def fetches(fake, resource: str):
+    """Query parameters of the first page of each fetch of a resource"""
+    return [query for query in fake.requested(resource)
+            if 'page' not in query]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = connect(str(tmp_path / 'givematerial.sqlite'))
+    create_tables(conn)
+    yield conn
+    conn.close()
+
+
+def test_full_sync(subjects):
+    subjects.set_assignment(1, 1, timestamp(2))
+    subjects.set_assignment(2, 4, timestamp(3))
+    subjects.set_assignment(3, 5, timestamp(4))
+    subjects.set_assignment(4, 9, timestamp(5))
+    # lessons that were not started yet
+    subjects.set_assignment(5, 0, timestamp(6))
+
+    status = WanikaniStatus(TOKEN)
+
+    assert sorted(status.get_learning_learnables()) == ['一', '二']
+    assert sorted(status.get_known_learnables()) == ['三', '四']
+    assert status.get_removed_learnables() == []
+    assert not status.is_incremental
+    # stage 0 is filtered by the server, so it does not count as a change
+    assert status.data_updated_at == timestamp(5)
+
+    queries = subjects.requested('assignments')
+    # four assignments on two pages
+    assert len(queries) == 2
+    assert 'updated_after' not in queries[0]
+
+
+def test_incremental_sync(subjects, conn):
+    subjects.set_assignment(1, 2, timestamp(2))
+    subjects.set_assignment(2, 5, timestamp(2))
+    subjects.set_assignment(3, 6, timestamp(2))
+    subjects.set_assignment(4, 8, timestamp(2))
+
+    cache = SqliteLearnableCache(conn, TOKEN)
+    status = WanikaniStatus(TOKEN)
+    ingest(status, cache)
+    learning, known = cache.read_cache()
+    assert learning == ['一']
+    assert sorted(known) == ['三', '二', '四']
+    version = cache.status_version()
+
+    # a new lesson was learned, one kanji was reset by the user and a
+    # kanji was removed from Wanikani
+    subjects.set_assignment(5, 1, timestamp(3))
+    subjects.set_assignment(2, 0, timestamp(3))
+    subjects.set_assignment(3, 6, timestamp(4), hidden=True)
+    subjects.requests.clear()
+
+    status = WanikaniStatus(TOKEN, status.data_updated_at)
+    ingest(status, cache)
+
+    assert status.is_incremental
+    assert sorted(status.get_learning_learnables()) == ['五']
+    assert status.get_known_learnables() == []
+    assert sorted(status.get_removed_learnables()) == ['三', '二']
+    assert status.data_updated_at == timestamp(4)
+
+    queries = fetches(subjects, 'assignments')
+    assert [query['updated_after'] for query in queries] == [[timestamp(2)]]
+    # all stages are fetched, so that reset kanji are noticed
+    assert 'srs_stages' not in queries[0]
+
+    sqlite_status = SqliteBasedStatus(conn, TOKEN)
+    assert sorted(sqlite_status.get_learning_learnables()) == ['一', '五']
+    assert sorted(sqlite_status.get_known_learnables()) == ['四']
+    assert cache.status_version() == version + 1
+
+    # nothing changed since the last sync
+    status = WanikaniStatus(TOKEN, status.data_updated_at)
+    ingest(status, cache)
+
+    assert status.data_updated_at == timestamp(4)
+    assert cache.status_version() == version + 1
+
+
+def test_retry_rate_limit_and_server_errors(subjects):
+    subjects.set_assignment(1, 5, timestamp(2))
+    subjects.failures = [
+        (429, {'RateLimit-Remaining': '0',
+               'RateLimit-Reset': str(int(time.time()))}),
+        (503, {}),
+        (500, {}),
+    ]
+
+    status = WanikaniStatus(TOKEN)
+
+    assert status.get_known_learnables() == ['一']
+    # the first request of the assignments failed three times
+    assert len(fetches(subjects, 'assignments')) == 4
+    assert len(fetches(subjects, 'subjects')) == 1
+
+
+def test_retries_exhausted(subjects):
+    subjects.failures = [(502, {})] * (WanikaniStatus.MAX_RETRIES + 1)
+
+    status = WanikaniStatus(TOKEN)
+
+    with pytest.raises(requests.HTTPError):
+        status.get_known_learnables()
+    assert len(subjects.requests) == WanikaniStatus.MAX_RETRIES + 1
+
+
+def test_invalid_token_is_not_retried(subjects):
+    subjects.failures = [(401, {})]
+
+    with pytest.raises(requests.HTTPError):
+        WanikaniStatus(TOKEN).get_known_learnables()
+    assert len(subjects.requests) == 1
+
+
+def cache_file() -> Path:
+    return Path(tempfile.gettempdir()) / 'givematerial_wanikani.json'
+
+
+def test_subjects_cache_refresh(subjects):
+    subjects.set_assignment(1, 5, timestamp(2))
+    WanikaniStatus(TOKEN).get_known_learnables()
+    assert len(fetches(subjects, 'subjects')) == 1
+
+    # a fresh cache is used by the next sync
+    WanikaniStatus(TOKEN).get_known_learnables()
+    assert len(fetches(subjects, 'subjects')) == 1
+
+    # an outdated cache is updated with the changed subjects only
+    with open(cache_file()) as f:
+        data = json.load(f)
+    data['fetched'] -= WanikaniStatus.SUBJECTS_MAX_AGE + 1
+    with open(cache_file(), 'w') as f:
+        json.dump(data, f)
+    subjects.add_subject(1, '壱', timestamp(5))
+
+    status = WanikaniStatus(TOKEN)
+    assert status.get_known_learnables() == ['壱']
+    assert fetches(subjects, 'subjects')[-1]['updated_after'] == \
+        [timestamp(1)]
+    assert len(status.subjects) == 6
+
+    with open(cache_file()) as f:
+        data = json.load(f)
+    assert data['updated_after'] == timestamp(5)
+    assert data['fetched'] > time.time() - 60
+
+
+def test_unknown_subject_refreshes_cache(subjects):
+    subjects.set_assignment(1, 5, timestamp(2))
+    WanikaniStatus(TOKEN).get_known_learnables()
+
+    # a subject added after the cache was written
+    subjects.add_subject(7, '七', timestamp(6))
+    subjects.set_assignment(7, 1, timestamp(6))
+
+    status = WanikaniStatus(TOKEN)
+
+    assert status.get_learning_learnables() == ['七']
+    assert fetches(subjects, 'subjects')[-1]['updated_after'] == \
+        [timestamp(1)]
+
+
+def test_legacy_subjects_cache(subjects):
+    # older versions only stored the subjects
+    with open(cache_file(), 'w') as f:
+        json.dump({'1': '一', '2': '二'}, f)
+    subjects.set_assignment(2, 5, timestamp(2))
+
+    status = WanikaniStatus(TOKEN)
+
+    assert status.get_known_learnables() == ['二']
+    assert subjects.requested('subjects') == []
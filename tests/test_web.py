@@ -0,0 +1,140 @@
+import gzip
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+    """The web app with its database and data in a temporary folder"""
+    cwd = os.getcwd()
+    # the app opens its database relative to the working directory
+    os.chdir(tmp_path_factory.mktemp('web'))
+    os.environ.setdefault('FLASK_SECRET', 'test')
+    from givematerial.web import main
+
+    yield main
+
+    main.db_pool.close()
+    for corpus in main.corpus_indexes.values():
+        corpus.close()
+    main.corpus_indexes.clear()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
+
+
+@pytest.fixture
+def conn(main):
+    conn = main.db_pool.acquire()
+    yield conn
+    main.db_pool.release(conn)
+
+
+def user_exists(conn, token: str) -> bool:
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) FROM user WHERE token = ?', (token,))
+    return cur.fetchone()[0] > 0
+
+
+def push(client, token: str):
+    return client.post('/learning-status', json={
+        'token': token, 'full': True, 'known': ['一'], 'learning': []})
+
+
+def test_login_does_not_create_user(client, conn):
+    assert client.post('/', data={'wktoken': 'typed'}).status_code == 302
+
+    assert not user_exists(conn, 'typed')
+    # the download of the Wanikani status creates the user
+    cur = conn.cursor()
+    cur.execute('SELECT token FROM token_requests WHERE token = ?', ('typed',))
+    assert cur.fetchall() == [('typed',)]
+
+    assert push(client, 'typed').status_code == 401
+
+
+def test_mark_read_does_not_create_user(client, conn):
+    with client.session_transaction() as session:
+        session['wktoken'] = 'unknown'
+
+    response = client.get(
+        '/redirect/read?url=https://example.com/1&mark_read=1')
+
+    assert response.status_code == 302
+    assert not user_exists(conn, 'unknown')
+    assert push(client, 'unknown').status_code == 401
+
+
+def test_push_registered_user(client, conn):
+    conn.execute(
+        'INSERT INTO user (token, language) VALUES (?, ?)',
+        ('registered', 'jp'))
+    conn.commit()
+
+    response = push(client, 'registered')
+
+    assert response.status_code == 200
+    assert response.json == {'version': 1}
+
+
+def push_gzip(client, body: bytes):
+    return client.post(
+        '/learning-status', data=body,
+        headers={'Content-Type': 'application/json',
+                 'Content-Encoding': 'gzip'})
+
+
+def test_push_gzip(client, conn):
+    conn.execute(
+        'INSERT INTO user (token, language) VALUES (?, ?)', ('gzip', 'jp'))
+    conn.commit()
+    message = {'token': 'gzip', 'full': True, 'known': ['一'], 'learning': []}
+
+    response = push_gzip(client, gzip.compress(json.dumps(message).encode()))
+
+    assert response.status_code == 200
+
+
+def test_push_gzip_too_large(client, main, monkeypatch):
+    monkeypatch.setattr(main, 'MAX_STATUS_SIZE', 1000)
+    # compresses to about 1 KB
+    body = gzip.compress(b' ' * 1024 * 1024)
+
+    assert push_gzip(client, body).status_code == 413
+
+
+@pytest.mark.parametrize('body', [
+    b'not gzip',
+    gzip.compress(b'{"token": "gzip"}')[:-10],
+    gzip.compress(b'not json'),
+])
+def test_push_invalid_body(client, body):
+    assert push_gzip(client, body).status_code == 400
+
+
+def test_home_reuses_result(client, main, conn):
+    texts_folder = Path('data') / 'texts'
+    texts_folder.mkdir(parents=True, exist_ok=True)
+    for name, text in [('a', '一二三'), ('b', '一四五六七')]:
+        with open(texts_folder / f'{name}.json', 'w') as f:
+            json.dump({'collection': 'test', 'title': name, 'text': text,
+                       'language': 'jp', 'url': f'https://example.com/{name}'},
+                      f)
+    conn.execute(
+        'INSERT INTO user (token, language) VALUES (?, ?)', ('home', 'jp'))
+    conn.commit()
+    with client.session_transaction() as session:
+        session['wktoken'] = 'home'
+
+    assert client.get('/').status_code == 200
+    hits = main.result_cache.hits
+    # the first view extracts the learnables of the new texts
+    assert client.get('/').status_code == 200
+
+    assert main.result_cache.hits == hits + 1